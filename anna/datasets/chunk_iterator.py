@@ -0,0 +1,65 @@
+import threading
+import Queue
+
+import numpy as np
+
+
+class ChunkIterator(object):
+    # Groups the minibatches of an iterator into chunks for
+    # model.set_chunk. The next chunk is assembled in a background thread
+    # while the model trains on the current one.
+
+    def __init__(self, iterator, batches_per_chunk, batch_axes=None,
+                 transform=None, prefetch=1):
+        # iterator: yields minibatches, either a single array or a tuple of
+        #   arrays (e.g. (x, y)).
+        # batch_axes: axis along which each array of a minibatch is
+        #   concatenated (default 0 for all; 3 for c01b inputs).
+        # transform: optional function applied to every minibatch (as a
+        #   tuple) before it is added to a chunk, e.g. a transpose to c01b
+        #   or augmentation.
+        self.iterator = iterator
+        self.batches_per_chunk = batches_per_chunk
+        self.batch_axes = batch_axes
+        self.transform = transform
+
+        self.queue = Queue.Queue(maxsize=prefetch)
+        self.thread = threading.Thread(target=self._fill)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        chunk = self.queue.get()
+        # StopIteration at the end, or an error raised in the thread.
+        if isinstance(chunk, Exception):
+            raise chunk
+        return chunk
+
+    def _fill(self):
+        try:
+            batches = []
+            for batch in self.iterator:
+                if not isinstance(batch, tuple):
+                    batch = (batch,)
+                if self.transform is not None:
+                    batch = tuple(self.transform(*batch))
+                batches.append(batch)
+                if len(batches) == self.batches_per_chunk:
+                    self.queue.put(self._concatenate(batches))
+                    batches = []
+            if batches:
+                self.queue.put(self._concatenate(batches))
+            self.queue.put(StopIteration())
+        except Exception, e:
+            # Re-raised in the consumer thread.
+            self.queue.put(e)
+
+    def _concatenate(self, batches):
+        axes = self.batch_axes
+        if axes is None:
+            axes = (0,) * len(batches[0])
+        return tuple(np.concatenate(arrays, axis=axis)
+                     for arrays, axis in zip(zip(*batches), axes))
@@ -134,6 +134,16 @@ class BasicIterator(object):
         self.sample_count = 0
         self.last = 0
 
+    def get_state(self):
+        return {'batch_count': self.batch_count,
+                'sample_count': self.sample_count,
+                'last': self.last}
+
+    def set_state(self, state):
+        self.batch_count = state['batch_count']
+        self.sample_count = state['sample_count']
+        self.last = state['last']
+
 
 class DatasetIteratorSequential(BasicIterator):
 
@@ -235,6 +245,15 @@ class DatasetIteratorRandomUniformNoRep(BasicIterator):
             self.batch_count += 1
             return self.X[self.last, :, :, :]
 
+    def get_state(self):
+        state = super(DatasetIteratorRandomUniformNoRep, self).get_state()
+        state['remain_samples'] = self.remain_samples.copy()
+        return state
+
+    def set_state(self, state):
+        super(DatasetIteratorRandomUniformNoRep, self).set_state(state)
+        self.remain_samples = state['remain_samples'].copy()
+
 
 if __name__ == "__main__":
     # print('Making Datset Object')
@@ -0,0 +1,217 @@
+"""Exports a trained model for the NumPy runtime (anna.inference.runtime).
+
+The layer graph below the model's output layer is written to a single .npz
+file: the architecture as JSON, one entry per layer in evaluation order,
+and every parameter array once (layers that mirror another layer's weights
+refer to the same array). The runtime only needs numpy to load and run it.
+
+    exporter.export_model(model, 'model.npz')
+"""
+import json
+
+import numpy
+
+from anna.layers import layers, cc_layers
+
+_NONLINEARITIES = [(layers.identity, 'identity'),
+                   (layers.rectify, 'rectify'),
+                   (layers.trec, 'trec'),
+                   (layers.softmax, 'softmax'),
+                   (layers.sigmoid, 'sigmoid'),
+                   (layers.tanh, 'tanh')]
+
+
+def _nonlinearity_name(nonlinearity):
+    for function, name in _NONLINEARITIES:
+        if nonlinearity is function:
+            return name
+    raise ValueError('Nonlinearity %r cannot be exported.' % nonlinearity)
+
+
+def _input_layers(layer):
+    if isinstance(layer, layers.ConcatenateLayer):
+        return list(layer.input_layers)
+    if isinstance(layer, cc_layers.Deconv2DNoBiasLayerGuidedBackProp):
+        # Masked by the input of the layer it mirrors.
+        return [layer.input_layer, layer.mirror_layer.input_layer]
+    if hasattr(layer, 'input_layer'):
+        return [layer.input_layer]
+    return []
+
+
+def _dnn_pad(pad, filter_size):
+    # dnn_conv border modes as explicit padding.
+    if pad == 'valid':
+        return [0, 0]
+    elif pad == 'full':
+        return [filter_size - 1] * 2
+    elif pad == 'half':
+        return [filter_size // 2] * 2
+    return list(pad)
+
+
+def _spatial(shape, data_order):
+    # Height and width of a 4D output shape.
+    if data_order == 'c01b':
+        return list(shape[1:3])
+    return list(shape[2:4])
+
+
+class _Exporter(object):
+    def __init__(self):
+        self.specs = []
+        self.arrays = {}
+        self.layer_index = {}
+        self.param_names = {}
+
+    def add_layer(self, layer):
+        # Post-order walk, so inputs always come before the layer.
+        if id(layer) in self.layer_index:
+            return self.layer_index[id(layer)]
+        inputs = [self.add_layer(input_layer)
+                  for input_layer in _input_layers(layer)]
+        spec = self.describe(layer)
+        spec['inputs'] = inputs
+        spec['class'] = '%s.%s' % (type(layer).__module__,
+                                   type(layer).__name__)
+        self.specs.append(spec)
+        index = len(self.specs) - 1
+        self.layer_index[id(layer)] = index
+        return index
+
+    def add_param(self, param):
+        if id(param) not in self.param_names:
+            name = 'param_%d' % len(self.param_names)
+            self.param_names[id(param)] = name
+            self.arrays[name] = param.get_value()
+        return self.param_names[id(param)]
+
+    def describe(self, layer):
+        shape = list(layer.get_output_shape())
+
+        # cuda-convnet layers (c01b)
+        if isinstance(layer, cc_layers.Input2DLayer):
+            return {'type': 'input', 'order': 'c01b', 'shape': shape}
+        if isinstance(layer, cc_layers.DropoutLayer):
+            return {'type': 'identity'}
+        if isinstance(layer, (cc_layers.Conv2DLayer,
+                              cc_layers.Conv2DNoBiasLayer)):
+            bias = getattr(layer, 'b', None)
+            return {'type': 'conv',
+                    'order': 'c01b',
+                    'W': self.add_param(layer.W),
+                    'b': self.add_param(bias) if bias is not None else None,
+                    'untie_biases': getattr(layer, 'untie_biases', False),
+                    'filter_size': [layer.filter_size] * 2,
+                    'stride': [layer.stride] * 2,
+                    'pad': [layer.pad] * 2,
+                    'flip': False,
+                    'output_size': _spatial(shape, 'c01b'),
+                    'nonlinearity': _nonlinearity_name(layer.nonlinearity)}
+        if isinstance(layer, cc_layers.Pooling2DLayer):
+            return {'type': 'maxpool',
+                    'order': 'c01b',
+                    'pool_size': [layer.pool_size] * 2,
+                    'stride': [layer.stride] * 2,
+                    'output_size': _spatial(shape, 'c01b')}
+        if isinstance(layer, (cc_layers.Deconv2DLayer,
+                              cc_layers.DeconvUntied2DLayer,
+                              cc_layers.Deconv2DNoBiasLayer)):
+            guided = isinstance(layer,
+                                cc_layers.Deconv2DNoBiasLayerGuidedBackProp)
+            bias = getattr(layer, 'b', None)
+            return {'type': 'deconv',
+                    'W': self.add_param(layer.W),
+                    'b': self.add_param(bias) if bias is not None else None,
+                    'untie_biases': getattr(layer, 'untie_biases', False),
+                    'stride': [layer.stride] * 2,
+                    'pad': [layer.pad] * 2,
+                    'output_size': _spatial(shape, 'c01b'),
+                    'guided': guided,
+                    'nonlinearity': ('identity' if guided else
+                                     _nonlinearity_name(layer.nonlinearity))}
+        if isinstance(layer, cc_layers.Unpooling2DLayer):
+            # The runtime routes every value to the position that was the
+            # max of its window, as recorded by the pooling layer.
+            pooling = self.add_layer(layer.pooling_layer)
+            self.specs[pooling]['record_switches'] = True
+            return {'type': 'unpool',
+                    'pooling': pooling,
+                    'output_size': _spatial(shape, 'c01b')}
+        if isinstance(layer, cc_layers.ShuffleC01BToBC01Layer):
+            return {'type': 'transpose', 'axes': [3, 0, 1, 2]}
+        if isinstance(layer, cc_layers.ShuffleBC01ToC01BLayer):
+            return {'type': 'transpose', 'axes': [1, 2, 3, 0]}
+
+        # Theano / cuDNN layers (bc01 or flat)
+        if isinstance(layer, (layers.InputLayer, layers.Input2DLayer)):
+            return {'type': 'input', 'order': 'bc01', 'shape': shape}
+        if isinstance(layer, layers.DenseLayer):
+            return {'type': 'dense',
+                    'W': self.add_param(layer.W),
+                    'b': self.add_param(layer.b),
+                    'nonlinearity': _nonlinearity_name(layer.nonlinearity)}
+        if isinstance(layer, layers.DenseNoBiasLayer):
+            return {'type': 'dense',
+                    'W': self.add_param(layer.W),
+                    'b': None,
+                    'nonlinearity': _nonlinearity_name(layer.nonlinearity)}
+        if isinstance(layer, layers.Conv2DLayer):
+            # dnn_conv convolves, i.e. flips the filters.
+            return {'type': 'conv',
+                    'order': 'bc01',
+                    'W': self.add_param(layer.W),
+                    'b': None,
+                    'untie_biases': False,
+                    'filter_size': [layer.filter_size] * 2,
+                    'stride': list(layer.stride),
+                    'pad': _dnn_pad(layer.pad, layer.filter_size),
+                    'flip': True,
+                    'output_size': _spatial(shape, 'bc01'),
+                    'nonlinearity': 'identity'}
+        if isinstance(layer, layers.Pool2DLayer):
+            return {'type': 'maxpool',
+                    'order': 'bc01',
+                    'pool_size': [layer.filter_size] * 2,
+                    'stride': list(layer.stride),
+                    'output_size': _spatial(shape, 'bc01')}
+        if isinstance(layer, layers.PoolingLayer):
+            return {'type': 'maxpool1d',
+                    'pool_size': layer.ds_factor,
+                    'ignore_border': layer.ignore_border}
+        if isinstance(layer, layers.GlobalPooling2DLayer):
+            return {'type': 'globalpool',
+                    'function': layer.pooling_function,
+                    'nonlinearity': _nonlinearity_name(layer.nonlinearity)}
+        if isinstance(layer, (layers.DenseBatchNormLayer,
+                              layers.ConvBatchNormLayer)):
+            # Normalized with the statistics of the batch, as in training.
+            axes = [0] if len(shape) == 2 else [0, 2, 3]
+            return {'type': 'batchnorm',
+                    'gamma': self.add_param(layer.gamma),
+                    'beta': self.add_param(layer.beta),
+                    'axes': axes,
+                    'epsilon': layer.epsilon}
+        if isinstance(layer, layers.ConcatenateLayer):
+            return {'type': 'concatenate',
+                    'nonlinearity': _nonlinearity_name(layer.nonlinearity)}
+        if isinstance(layer, layers.NonlinearityLayer):
+            return {'type': 'nonlinearity',
+                    'nonlinearity': _nonlinearity_name(layer.nonlinearity)}
+        if isinstance(layer, layers.TimeMaxPoolLayer):
+            return {'type': 'timemaxpool'}
+
+        raise ValueError('%s cannot be exported.' % type(layer).__name__)
+
+
+def export_layers(output_layer, path):
+    """Writes the graph below output_layer and its parameters to path."""
+    exporter = _Exporter()
+    exporter.add_layer(output_layer)
+    architecture = {'version': 1, 'layers': exporter.specs}
+    numpy.savez(path, architecture=numpy.array(json.dumps(architecture)),
+                **exporter.arrays)
+
+
+def export_model(model, path):
+    export_layers(model._get_output_layer(), path)
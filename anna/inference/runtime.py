@@ -0,0 +1,450 @@
+"""NumPy runtime for models exported with anna.inference.exporter.
+
+Only needs numpy, so trained models run on machines without Theano, pylearn2
+or CUDA:
+
+    network = runtime.load('model.npz')
+    predictions = network.predict(x)
+
+x is laid out like the model's input (bc01 or c01b, any batch size).
+Convolutions are im2col followed by one BLAS GEMM, pooling is a max over a
+strided view of the input. Every layer keeps its work buffers (padded
+input, columns, output) between calls, so steady-state prediction with a
+fixed batch size does not allocate large arrays.
+
+The deconvolutional layers of cc_layers run here too: deconvolution is the
+transposed GEMM followed by col2im, and unpooling routes values to the
+argmax positions the matching pooling layer recorded in its forward pass
+(instead of comparing the pooled output with its input again, as
+MaxPoolGrad does). Network.forward returns the output of every layer, e.g.
+for feature extraction.
+"""
+import json
+
+import numpy
+from numpy.lib.stride_tricks import as_strided
+
+
+def _softmax(x):
+    e = numpy.exp(x - x.max(axis=1, keepdims=True))
+    e /= e.sum(axis=1, keepdims=True)
+    return e
+
+
+def _rectify(x):
+    return numpy.maximum(x, 0.0, out=x)
+
+
+def _trec(x):
+    x *= x > 1
+    return x
+
+
+def _sigmoid(x):
+    return 1.0 / (1.0 + numpy.exp(-x))
+
+
+NONLINEARITIES = {'identity': lambda x: x,
+                  'rectify': _rectify,
+                  'trec': _trec,
+                  'softmax': _softmax,
+                  'sigmoid': _sigmoid,
+                  'tanh': numpy.tanh}
+
+
+class Op(object):
+    def __init__(self, spec, arrays):
+        self.spec = spec
+        self.inputs = spec['inputs']
+        self._buffers = {}
+
+    def buffer(self, name, shape, fill=0.):
+        # Work array kept between calls while its shape does not change.
+        array = self._buffers.get(name)
+        if array is None or array.shape != shape:
+            array = numpy.empty(shape, dtype=numpy.float32)
+            array.fill(fill)
+            self._buffers[name] = array
+        return array
+
+    def link(self, ops):
+        # Called once all ops of the network exist.
+        pass
+
+    def forward(self, *inputs):
+        raise NotImplementedError(str(type(self)) +
+                                  " does not implement forward.")
+
+
+class InputOp(Op):
+    def forward(self, x):
+        return numpy.asarray(x, dtype=numpy.float32)
+
+
+class IdentityOp(Op):
+    def forward(self, x):
+        return x
+
+
+class TransposeOp(Op):
+    def forward(self, x):
+        return x.transpose(self.spec['axes'])
+
+
+class NonlinearityOp(Op):
+    def __init__(self, spec, arrays):
+        super(NonlinearityOp, self).__init__(spec, arrays)
+        self.nonlinearity = NONLINEARITIES[spec['nonlinearity']]
+
+    def forward(self, x):
+        out = self.buffer('out', x.shape)
+        out[...] = x
+        return self.nonlinearity(out)
+
+
+class DenseOp(NonlinearityOp):
+    def __init__(self, spec, arrays):
+        super(DenseOp, self).__init__(spec, arrays)
+        self.W = arrays[spec['W']]
+        self.b = arrays[spec['b']] if spec['b'] is not None else None
+
+    def forward(self, x):
+        x = numpy.ascontiguousarray(x).reshape(x.shape[0], -1)
+        out = self.buffer('out', (x.shape[0], self.W.shape[1]))
+        numpy.dot(x, self.W, out=out)
+        if self.b is not None:
+            out += self.b
+        return self.nonlinearity(out)
+
+
+def _pad_shape(size, pad, filter_size, stride, output_size):
+    # cuda-convnet windows may run past the padded input (its output sizes
+    # round up), the rest is filled like padding.
+    return max(size + 2 * pad, (output_size - 1) * stride + filter_size)
+
+
+class _WindowOp(Op):
+    # Shared by convolution and pooling: pads the input and returns a
+    # strided view of the (fh, fw) windows at every output position.
+    # bc01 windows have shape (b, c, oh, ow, fh, fw),
+    # c01b windows have shape (c, oh, ow, b, fh, fw).
+
+    def __init__(self, spec, arrays, window, stride, pad, fill=0.):
+        super(_WindowOp, self).__init__(spec, arrays)
+        self.order = spec['order']
+        self.window = window
+        self.stride = stride
+        self.pad = pad
+        self.fill = fill
+        self.output_size = spec['output_size']
+
+    def windows(self, x):
+        if self.order == 'c01b':
+            spatial = (1, 2)
+        else:
+            spatial = (2, 3)
+        padded_shape = list(x.shape)
+        for axis, size, pad, window, stride, output in zip(
+                spatial, [x.shape[a] for a in spatial], self.pad,
+                self.window, self.stride, self.output_size):
+            padded_shape[axis] = _pad_shape(size, pad, window, stride,
+                                            output)
+        padded_shape = tuple(padded_shape)
+
+        if padded_shape != x.shape:
+            padded = self.buffer('padded', padded_shape, fill=self.fill)
+            index = [slice(None)] * 4
+            for axis, pad in zip(spatial, self.pad):
+                index[axis] = slice(pad, pad + x.shape[axis])
+            padded[tuple(index)] = x
+            x = padded
+
+        (fh, fw), (sh, sw), (oh, ow) = (self.window, self.stride,
+                                        self.output_size)
+        s = x.strides
+        if self.order == 'c01b':
+            c, _, _, b = x.shape
+            return as_strided(x, shape=(c, oh, ow, b, fh, fw),
+                              strides=(s[0], s[1] * sh, s[2] * sw, s[3],
+                                       s[1], s[2]))
+        b, c, _, _ = x.shape
+        return as_strided(x, shape=(b, c, oh, ow, fh, fw),
+                          strides=(s[0], s[1], s[2] * sh, s[3] * sw,
+                                   s[2], s[3]))
+
+
+class ConvOp(_WindowOp):
+    def __init__(self, spec, arrays):
+        super(ConvOp, self).__init__(spec, arrays, spec['filter_size'],
+                                     spec['stride'], spec['pad'])
+        self.nonlinearity = NONLINEARITIES[spec['nonlinearity']]
+        W = arrays[spec['W']]
+        if spec['flip']:
+            W = W[:, :, ::-1, ::-1]
+        # GEMM operands, laid out once so that the product is directly in
+        # the output order.
+        if self.order == 'c01b':
+            # W is (c, fh, fw, f): out (f, oh*ow*b) = W^T cols
+            self.n_filters = W.shape[3]
+            self.W = numpy.ascontiguousarray(
+                W.reshape(-1, self.n_filters).T)
+        else:
+            # W is (f, c, fh, fw): out (b*oh*ow, f) = cols W^T
+            self.n_filters = W.shape[0]
+            self.W = numpy.ascontiguousarray(
+                W.reshape(self.n_filters, -1).T)
+
+        self.b = arrays[spec['b']] if spec['b'] is not None else None
+        if self.b is not None:
+            if spec['untie_biases']:
+                self.b = self.b[:, :, :, None]
+            else:
+                self.b = self.b[:, None, None, None]
+
+    def forward(self, x):
+        windows = self.windows(x)
+        fh, fw = self.window
+        oh, ow = self.output_size
+        if self.order == 'c01b':
+            c, _, _, b = windows.shape[:4]
+            # cols (c, fh, fw, oh, ow, b)
+            cols = self.buffer('cols', (c, fh, fw, oh, ow, b))
+            cols[...] = windows.transpose(0, 4, 5, 1, 2, 3)
+            out = self.buffer('out', (self.n_filters, oh, ow, b))
+            numpy.dot(self.W, cols.reshape(c * fh * fw, -1),
+                      out=out.reshape(self.n_filters, -1))
+        else:
+            b, c = windows.shape[:2]
+            # cols (b, oh, ow, c, fh, fw)
+            cols = self.buffer('cols', (b, oh, ow, c, fh, fw))
+            cols[...] = windows.transpose(0, 2, 3, 1, 4, 5)
+            gemm = self.buffer('gemm', (b, oh, ow, self.n_filters))
+            numpy.dot(cols.reshape(b * oh * ow, -1), self.W,
+                      out=gemm.reshape(b * oh * ow, self.n_filters))
+            out = self.buffer('out', (b, self.n_filters, oh, ow))
+            out[...] = gemm.transpose(0, 3, 1, 2)
+
+        if self.b is not None:
+            out += self.b
+        return self.nonlinearity(out)
+
+
+class MaxPoolOp(_WindowOp):
+    def __init__(self, spec, arrays):
+        # Windows running past the input take the max of what is inside.
+        super(MaxPoolOp, self).__init__(spec, arrays, spec['pool_size'],
+                                        spec['stride'], [0, 0],
+                                        fill=-numpy.inf)
+
+    def forward(self, x):
+        windows = self.windows(x)
+        out = self.buffer('out', windows.shape[:4])
+        if not self.spec.get('record_switches'):
+            return windows.max(axis=(4, 5), out=out)
+
+        # Keep the position of the max in every window for unpooling.
+        shape = windows.shape
+        cols = self.buffer('cols', shape[:4] + (shape[4] * shape[5],))
+        cols.reshape(shape)[...] = windows
+        self.switches = cols.argmax(axis=-1)
+        return cols.max(axis=-1, out=out)
+
+
+def _col2im(cols, padded, stride):
+    # Adds the values of every window offset (u, v) of cols,
+    # (c, fh, fw, oh, ow, b), into the c01b image padded.
+    _, fh, fw, oh, ow, _ = cols.shape
+    sh, sw = stride
+    for u in range(fh):
+        for v in range(fw):
+            padded[:, u:u + sh * (oh - 1) + 1:sh,
+                   v:v + sw * (ow - 1) + 1:sw] += cols[:, u, v]
+
+
+class DeconvOp(Op):
+    # cuda-convnet ImageActs, the transpose of the c01b convolution.
+    def __init__(self, spec, arrays):
+        super(DeconvOp, self).__init__(spec, arrays)
+        self.nonlinearity = NONLINEARITIES[spec['nonlinearity']]
+        W = arrays[spec['W']]
+        self.n_channels, fh, fw, self.n_filters = W.shape
+        self.window = (fh, fw)
+        self.W = numpy.ascontiguousarray(W.reshape(-1, self.n_filters))
+        self.stride = spec['stride']
+        self.pad = spec['pad']
+        self.output_size = spec['output_size']
+
+        self.b = arrays[spec['b']] if spec['b'] is not None else None
+        if self.b is not None:
+            if spec['untie_biases']:
+                self.b = self.b[:, :, :, None]
+            else:
+                self.b = self.b[:, None, None, None]
+
+    def forward(self, x, mirror_input=None):
+        f, oh, ow, b = x.shape
+        if self.b is not None:
+            unbiased = self.buffer('unbiased', x.shape)
+            x = numpy.subtract(x, self.b, out=unbiased)
+        else:
+            x = numpy.ascontiguousarray(x)
+
+        (fh, fw), (h, w) = self.window, self.output_size
+        cols = self.buffer('cols', (self.n_channels, fh, fw, oh, ow, b))
+        numpy.dot(self.W, x.reshape(f, -1),
+                  out=cols.reshape(self.n_channels * fh * fw, -1))
+
+        padded_shape = (self.n_channels,) + tuple(
+            _pad_shape(size, pad, window, stride, output)
+            for size, pad, window, stride, output in zip(
+                (h, w), self.pad, self.window, self.stride, (oh, ow))) + (b,)
+        padded = self.buffer('padded', padded_shape)
+        padded.fill(0.)
+        _col2im(cols, padded, self.stride)
+
+        ph, pw = self.pad
+        out = self.buffer('out', (self.n_channels, h, w, b))
+        out[...] = padded[:, ph:ph + h, pw:pw + w]
+        if self.spec['guided']:
+            # Guided backpropagation: keep what is positive both here and
+            # in the input of the mirrored layer.
+            out *= (out > 0) & (mirror_input > 0)
+            return out
+        return self.nonlinearity(out)
+
+
+class UnpoolOp(Op):
+    def link(self, ops):
+        self.pool = ops[self.spec['pooling']]
+
+    def forward(self, x):
+        c, oh, ow, b = x.shape
+        (ph, pw), (h, w) = self.pool.window, self.spec['output_size']
+        sh, sw = self.pool.stride
+        padded_shape = (c, max(h, (oh - 1) * sh + ph),
+                        max(w, (ow - 1) * sw + pw), b)
+        padded = self.buffer('padded', padded_shape)
+        padded.fill(0.)
+        routed = self.buffer('routed', x.shape)
+        switches = self.pool.switches
+        for u in range(ph):
+            for v in range(pw):
+                numpy.multiply(x, switches == u * pw + v, out=routed)
+                padded[:, u:u + sh * (oh - 1) + 1:sh,
+                       v:v + sw * (ow - 1) + 1:sw] += routed
+        return padded[:, :h, :w]
+
+
+class MaxPool1DOp(Op):
+    # Max over non-overlapping windows along the last axis.
+    def forward(self, x):
+        ds = self.spec['pool_size']
+        size = x.shape[-1]
+        if self.spec['ignore_border']:
+            n = size // ds
+            x = x[..., :n * ds]
+        else:
+            n = -(-size // ds)
+            if n * ds != size:
+                padded = self.buffer('padded', x.shape[:-1] + (n * ds,),
+                                     fill=-numpy.inf)
+                padded[..., :size] = x
+                x = padded
+        return x.reshape(x.shape[:-1] + (n, ds)).max(axis=-1)
+
+
+class GlobalPoolOp(NonlinearityOp):
+    def forward(self, x):
+        function = self.spec['function']
+        if function == 'mean':
+            out = x.mean(axis=(2, 3))
+        elif function == 'max':
+            out = x.max(axis=(2, 3))
+        elif function == 'l2':
+            out = numpy.sqrt((x ** 2).mean(axis=(2, 3)))
+        return self.nonlinearity(out)
+
+
+class BatchNormOp(Op):
+    # Uses the statistics of the batch, like the Theano layers.
+    def __init__(self, spec, arrays):
+        super(BatchNormOp, self).__init__(spec, arrays)
+        self.axes = tuple(spec['axes'])
+        shape = [1, -1] + [1] * (len(self.axes) - 1)
+        self.gamma = arrays[spec['gamma']].reshape(shape)
+        self.beta = arrays[spec['beta']].reshape(shape)
+        self.epsilon = spec['epsilon']
+
+    def forward(self, x):
+        mean = x.mean(axis=self.axes, keepdims=True)
+        std = x.std(axis=self.axes, keepdims=True)
+        out = self.buffer('out', x.shape)
+        numpy.subtract(x, mean, out=out)
+        out /= std + self.epsilon
+        out *= self.gamma
+        out += self.beta
+        return out
+
+
+class ConcatenateOp(NonlinearityOp):
+    def forward(self, *inputs):
+        return self.nonlinearity(numpy.concatenate(inputs, axis=1))
+
+
+class TimeMaxPoolOp(Op):
+    def forward(self, x):
+        return x.max(axis=0, keepdims=True)
+
+
+OPS = {'input': InputOp,
+       'identity': IdentityOp,
+       'transpose': TransposeOp,
+       'nonlinearity': NonlinearityOp,
+       'dense': DenseOp,
+       'conv': ConvOp,
+       'deconv': DeconvOp,
+       'unpool': UnpoolOp,
+       'maxpool': MaxPoolOp,
+       'maxpool1d': MaxPool1DOp,
+       'globalpool': GlobalPoolOp,
+       'batchnorm': BatchNormOp,
+       'concatenate': ConcatenateOp,
+       'timemaxpool': TimeMaxPoolOp}
+
+
+class Network(object):
+    def __init__(self, architecture, arrays):
+        self.specs = architecture['layers']
+        self.ops = []
+        for spec in self.specs:
+            if spec['type'] not in OPS:
+                raise ValueError('Unknown layer type %r (%s).' %
+                                 (spec['type'], spec.get('class')))
+            self.ops.append(OPS[spec['type']](spec, arrays))
+        for op in self.ops:
+            op.link(self.ops)
+
+    def forward(self, x):
+        """Outputs of every layer, in the order of the exported graph. They
+        are work buffers, overwritten by the next call.
+        """
+        outputs = []
+        for op in self.ops:
+            if isinstance(op, InputOp):
+                inputs = [x]
+            else:
+                inputs = [outputs[i] for i in op.inputs]
+            outputs.append(op.forward(*inputs))
+        return outputs
+
+    def predict(self, x):
+        return numpy.array(self.forward(x)[-1])
+
+
+def load(path):
+    f = numpy.load(path)
+    arrays = dict((name, f[name].astype(numpy.float32)) for name in f.files
+                  if name != 'architecture')
+    architecture = json.loads(str(f['architecture']))
+    f.close()
+    return Network(architecture, arrays)
@@ -1,5 +1,11 @@
 """
 Layers using the cuda-convnet Theano wrappers that are part of pylearn2.
+
+Unlike the layers of layers.py, the convolution, deconvolution and pooling
+layers only run batches whose size is a multiple of BATCH_MULTIPLE (32),
+for training as well as for prediction and evaluation. Pad smaller batches,
+as StreamingEvaluator and the prediction server do. Building one of these
+layers with another mb_size raises a ValueError.
 """
 
 import theano
@@ -19,6 +25,16 @@ import layers
 
 # TODO(tpaine) refactor the convolution layers to get rid of code repitition.
 
+# The cuda-convnet kernels only run batches whose size is a multiple of this.
+BATCH_MULTIPLE = 32
+
+
+def check_batch_size(batch_size):
+    if batch_size % BATCH_MULTIPLE != 0:
+        raise ValueError('cuda-convnet layers need a batch size that is a '
+                         'multiple of %d, not %d.' % (BATCH_MULTIPLE,
+                                                      batch_size))
+
 
 class Input2DLayer(layers.Input2DLayer):
     def __init__(self, mb_size, n_features, width, height):
@@ -67,9 +83,11 @@ class DropoutLayer(object):
         return self.input_shape
 
     def output(self, input=None, dropout_active=True, *args, **kwargs):
-        input = self.input_layer.output()
+        if input is None:
+            input = self.input_layer.output(dropout_active=dropout_active,
+                                            *args, **kwargs)
 
-        if self.dropout > 0.:
+        if dropout_active and (self.dropout > 0.):
             retain_prob = 1 - self.dropout
             mask = layers.srng.binomial(input.shape, p=retain_prob,
                                         dtype='int32').astype('float32')
@@ -80,6 +98,8 @@ class DropoutLayer(object):
 
 
 class Conv2DLayer(object):
+    fixed_batch_size = True
+
     def __init__(self,
                  input_layer,
                  n_filters,
@@ -116,6 +136,7 @@ class Conv2DLayer(object):
         # bias (as opposed to having the same bias everywhere for a given
         # filter)
         self.mb_size = self.input_layer.mb_size
+        check_batch_size(self.mb_size)
 
         self.filter_shape = (n_channels, filter_size, filter_size, n_filters)
 
@@ -194,6 +215,8 @@ class Conv2DLayer(object):
 
 
 class Conv2DNoBiasLayer(object):
+    fixed_batch_size = True
+
     def __init__(self,
                  input_layer,
                  n_filters,
@@ -223,6 +246,7 @@ class Conv2DNoBiasLayer(object):
         self.partial_sum = partial_sum
         self.pad = pad
         self.mb_size = self.input_layer.mb_size
+        check_batch_size(self.mb_size)
 
         self.data_order = layers.data_order.type2
 
@@ -281,6 +305,8 @@ class Conv2DNoBiasLayer(object):
 
 
 class Deconv2DLayer(object):
+    fixed_batch_size = True
+
     def __init__(self,
                  input_layer,
                  mirror_layer,
@@ -315,6 +341,7 @@ class Deconv2DLayer(object):
         # if untie_biases == True, each position in the output map has its own
         # bias (as opposed to having the same bias everywhere for a filter)
         self.mb_size = self.input_layer.mb_size
+        check_batch_size(self.mb_size)
 
         self.filter_shape = mirror_layer.filter_shape
 
@@ -374,6 +401,8 @@ class Deconv2DLayer(object):
 
 
 class DeconvUntied2DLayer(object):
+    fixed_batch_size = True
+
     def __init__(self,
                  input_layer,
                  mirror_layer,
@@ -407,6 +436,7 @@ class DeconvUntied2DLayer(object):
         self.untie_biases = mirror_layer.untie_biases
 
         self.mb_size = self.input_layer.mb_size
+        check_batch_size(self.mb_size)
 
         self.filter_shape = mirror_layer.filter_shape
 
@@ -483,6 +513,8 @@ class DeconvUntied2DLayer(object):
 
 
 class Deconv2DNoBiasLayer(object):
+    fixed_batch_size = True
+
     def __init__(self,
                  input_layer,
                  mirror_layer,
@@ -513,6 +545,7 @@ class Deconv2DNoBiasLayer(object):
         self.partial_sum = mirror_layer.partial_sum
         self.pad = mirror_layer.pad
         self.mb_size = self.input_layer.mb_size
+        check_batch_size(self.mb_size)
 
         self.filter_shape = mirror_layer.filter_shape
 
@@ -563,6 +596,8 @@ class Deconv2DNoBiasLayer(object):
 
 
 class Pooling2DLayer(object):
+    fixed_batch_size = True
+
     def __init__(self, input_layer, pool_size, stride=None):
         """
         pool_size is an INTEGER, not a tuple. We can only do square pooling.
@@ -577,6 +612,7 @@ class Pooling2DLayer(object):
         self.params = []
         self.bias_params = []
         self.mb_size = self.input_layer.mb_size
+        check_batch_size(self.mb_size)
 
         self.data_order = layers.data_order.type2
 
@@ -606,6 +642,8 @@ class Pooling2DLayer(object):
 
 
 class Unpooling2DLayer(object):
+    fixed_batch_size = True
+
     def __init__(self, input_layer, pooling_layer):
         """
         pool_size is an INTEGER, not a tuple. We can only do square pooling.
@@ -621,6 +659,7 @@ class Unpooling2DLayer(object):
         self.params = []
         self.bias_params = []
         self.mb_size = self.input_layer.mb_size
+        check_batch_size(self.mb_size)
 
         self.data_order = layers.data_order.type2
 
@@ -638,9 +677,9 @@ class Unpooling2DLayer(object):
         return shape
 
     def output(self, *args, **kwargs):
-        input = self.input_layer.output()
-        max_out = self.pooling_layer.output()
-        orig_input = self.pooling_layer.input_layer.output()
+        input = self.input_layer.output(*args, **kwargs)
+        max_out = self.pooling_layer.output(*args, **kwargs)
+        orig_input = self.pooling_layer.input_layer.output(*args, **kwargs)
         return self.unpool_op(orig_input, max_out, input)
 
 
@@ -725,5 +764,7 @@ class Deconv2DNoBiasLayerGuidedBackProp(Deconv2DNoBiasLayer):
             _, x, y, _ = self.get_output_shape()
             deconved = self.image_acts_op(contiguous_input, contiguous_filters,
                                           as_tensor_variable((x, y)))
-        mask = (deconved > 0.0) * (self.mirror_layer.input_layer.output() > 0.0)
+        mirror_input = self.mirror_layer.input_layer.output(
+            dropout_active=dropout_active, *args, **kwargs)
+        mask = (deconved > 0.0) * (mirror_input > 0.0)
         return mask * deconved
@@ -13,6 +13,8 @@ from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
 from theano.sandbox.cuda.basic_ops import gpu_contiguous
 from theano.sandbox.cuda.dnn import GpuDnnConv
 
+from anna.layers import optimizers
+
 srng = RandomStreams()
 
 
@@ -63,6 +65,29 @@ def all_layers(layer):
         return [layer] + all_layers(layer.input_layer)
 
 
+def get_batch_axis(layer):
+    """
+    Index of the minibatch dimension of the layer's output: 0 for flat and
+    bc01 outputs, 3 for c01b outputs (cuda-convnet layers).
+    """
+    if len(layer.get_output_shape()) != 4:
+        return 0
+    while not hasattr(layer, 'data_order'):
+        if not hasattr(layer, 'input_layer'):
+            return 0
+        layer = layer.input_layer
+    return list(layer.data_order).index(data_order._MINIBATCH_SIZE)
+
+
+def has_fixed_batch_size(layer):
+    """
+    Whether the layer, or a layer below it, only runs batches of the size it
+    was built for (cuda-convnet layers, see cc_layers.check_batch_size).
+    """
+    return any(getattr(l, 'fixed_batch_size', False)
+               for l in all_layers(layer))
+
+
 def all_parameters(layer):
     """
     Recursive function to gather all parameters, starting from the output layer
@@ -145,44 +170,23 @@ def reset_all_params(layer):
             l.reset_params()
 
 
+# The gen_updates_* functions are kept for existing experiment files, see
+# anna.layers.optimizers for the optimizer classes models use.
+
 def gen_updates_regular_momentum(loss, all_parameters, learning_rate, momentum,
                                  weight_decay):
-    all_grads = [theano.grad(loss, param) for param in all_parameters]
-    updates = []
-    for param_i, grad_i in zip(all_parameters, all_grads):
-        mparam_i = theano.shared(param_i.get_value() * 0.)
-        v = (momentum * mparam_i - weight_decay * learning_rate * param_i -
-             learning_rate * grad_i)
-        updates.append((mparam_i, v))
-        updates.append((param_i, param_i + v))
-    return updates
-
-
-# using the alternative formulation of nesterov momentum described at
-# https://github.com/lisa-lab/pylearn2/pull/136
-# such that the gradient can be evaluated at the current parameters.
+    return optimizers.Momentum(momentum, weight_decay).get_updates(
+        loss, all_parameters, learning_rate)
+
+
 def gen_updates_nesterov_momentum(loss, all_parameters, learning_rate,
                                   momentum, weight_decay):
-    all_grads = [theano.grad(loss, param) for param in all_parameters]
-    updates = []
-    for param_i, grad_i in zip(all_parameters, all_grads):
-        mparam_i = theano.shared(param_i.get_value() * 0.)
-        full_grad = grad_i + weight_decay * param_i
-        # new momemtum
-        v = momentum * mparam_i - learning_rate * full_grad
-        # new parameter values
-        w = param_i + momentum * v - learning_rate * full_grad
-        updates.append((mparam_i, v))
-        updates.append((param_i, w))
-    return updates
+    return optimizers.NesterovMomentum(momentum, weight_decay).get_updates(
+        loss, all_parameters, learning_rate)
 
 
 def gen_updates_sgd(loss, all_parameters, learning_rate):
-    all_grads = [theano.grad(loss, param) for param in all_parameters]
-    updates = []
-    for param_i, grad_i in zip(all_parameters, all_grads):
-        updates.append((param_i, param_i - learning_rate * grad_i))
-    return updates
+    return optimizers.SGD().get_updates(loss, all_parameters, learning_rate)
 
 
 def gen_updates_adagrad(loss, all_parameters, learning_rate=1.0, epsilon=1e-6):
@@ -191,21 +195,8 @@ def gen_updates_adagrad(loss, all_parameters, learning_rate=1.0, epsilon=1e-6):
 
     See "Notes on AdaGrad" by Chris Dyer for more info.
     """
-    all_grads = [theano.grad(loss, param) for param in all_parameters]
-    # initialise to zeroes with the right shape
-    all_accumulators = [theano.shared(param.get_value() * 0.)
-                        for param in all_parameters]
-
-    updates = []
-    for param_i, grad_i, acc_i in zip(all_parameters, all_grads,
-                                      all_accumulators):
-        acc_i_new = acc_i + grad_i ** 2
-        updates.append((acc_i, acc_i_new))
-        updates.append(
-            (param_i,
-             param_i - learning_rate * grad_i / T.sqrt(acc_i_new + epsilon)))
-
-    return updates
+    return optimizers.Adagrad(epsilon).get_updates(
+        loss, all_parameters, learning_rate)
 
 
 def gen_updates_rmsprop(loss, all_parameters,
@@ -221,21 +212,8 @@ def gen_updates_rmsprop(loss, all_parameters,
 
     also check http://climin.readthedocs.org/en/latest/rmsprop.html
     """
-    all_grads = [theano.grad(loss, param) for param in all_parameters]
-    # initialise to zeroes with the right shape
-    all_accumulators = [theano.shared(param.get_value() * 0.)
-                        for param in all_parameters]
-
-    updates = []
-    for param_i, grad_i, acc_i in zip(all_parameters, all_grads,
-                                      all_accumulators):
-        acc_i_new = rho * acc_i + (1 - rho) * grad_i ** 2
-        updates.append((acc_i, acc_i_new))
-        updates.append(
-            (param_i,
-             param_i - learning_rate * grad_i / T.sqrt(acc_i_new + epsilon)))
-
-    return updates
+    return optimizers.RMSProp(rho, epsilon).get_updates(
+        loss, all_parameters, learning_rate)
 
 
 def gen_updates_adadelta(loss, all_parameters,
@@ -253,31 +231,8 @@ def gen_updates_adadelta(loss, all_parameters,
     see "Adadelta: an adaptive learning rate method" by Matthew Zeiler for more
     info.
     """
-    all_grads = [theano.grad(loss, param) for param in all_parameters]
-    # initialise to zeroes with the right shape
-    all_accumulators = [theano.shared(param.get_value() * 0.)
-                        for param in all_parameters]
-    all_delta_accumulators = [theano.shared(param.get_value() * 0.)
-                              for param in all_parameters]
-
-    # all_accumulators: accumulate gradient magnitudes
-    # all_delta_accumulators: accumulate update magnitudes (recursive!)
-
-    updates = []
-    for param_i, grad_i, acc_i, acc_delta_i in zip(all_parameters, all_grads,
-                                                   all_accumulators,
-                                                   all_delta_accumulators):
-        acc_i_new = rho * acc_i + (1 - rho) * grad_i ** 2
-        updates.append((acc_i, acc_i_new))
-
-        update_i = (grad_i * T.sqrt(acc_delta_i + epsilon) /
-                    T.sqrt(acc_i_new + epsilon))
-        updates.append((param_i, param_i - learning_rate * update_i))
-
-        acc_delta_i_new = rho * acc_delta_i + (1 - rho) * update_i ** 2
-        updates.append((acc_delta_i, acc_delta_i_new))
-
-    return updates
+    return optimizers.Adadelta(rho, epsilon).get_updates(
+        loss, all_parameters, learning_rate)
 
 
 def shared_single(dim=2):
@@ -426,7 +381,8 @@ class Pool2DLayer(object):
                                         self.stride)
 
     def output(self, input=None, dropout_active=True, *args, **kwargs):
-        input = self.input_layer.output()
+        input = self.input_layer.output(dropout_active=dropout_active,
+                                        *args, **kwargs)
         ws = (self.filter_size, self.filter_size)
 
         contiguous_input = gpu_contiguous(input)
@@ -517,7 +473,9 @@ class DenseLayer(Layer):
             input = self.input_layer.output(dropout_active=dropout_active,
                                             *args, **kwargs)
         if len(self.input_layer.get_output_shape()) > 2:
-            input = input.reshape(self.flatinput_shape)
+            # Keep the batch dimension symbolic so that any batch size can
+            # be fed, not only mb_size.
+            input = input.reshape((input.shape[0], self.n_inputs))
 
         if dropout_active and (self.dropout > 0.):
             retain_prob = 1 - self.dropout
@@ -568,7 +526,9 @@ class DenseNoBiasLayer(Layer):
             input = self.input_layer.output(dropout_active=dropout_active,
                                             *args, **kwargs)
         if len(self.input_layer.get_output_shape()) > 2:
-            input = input.reshape(self.flatinput_shape)
+            # Keep the batch dimension symbolic so that any batch size can
+            # be fed, not only mb_size.
+            input = input.reshape((input.shape[0], self.n_inputs))
 
         if dropout_active and (self.dropout > 0.):
             retain_prob = 1 - self.dropout
@@ -601,9 +561,10 @@ class DenseBatchNormLayer(Layer):
         return self.input_layer.get_output_shape()
 
     def output(self, input=None, *args, **kwargs):
-        mean = T.mean(self.input_layer.output(), axis=0, keepdims=True)
-        std = T.std(self.input_layer.output(), axis=0, keepdims=True)
-        x = (self.input_layer.output() - mean)/(std + self.epsilon)
+        input = self.input_layer.output(*args, **kwargs)
+        mean = T.mean(input, axis=0, keepdims=True)
+        std = T.std(input, axis=0, keepdims=True)
+        x = (input - mean)/(std + self.epsilon)
 
         gamma = self.gamma.dimshuffle('x', 0)
         beta = self.beta.dimshuffle('x', 0)
@@ -666,7 +627,8 @@ class Conv2DLayer(object):
                                         self.stride)
 
     def output(self, input=None, dropout_active=True, *args, **kwargs):
-        input = self.input_layer.output()
+        input = self.input_layer.output(dropout_active=dropout_active,
+                                        *args, **kwargs)
         contiguous_input = gpu_contiguous(input)
         contiguous_filters = gpu_contiguous(self.W)
 
@@ -704,9 +666,11 @@ class ConvBatchNormLayer(Layer):
         return self.input_layer.get_output_shape()
 
     def output(self, input=None, dropout_active=True, *args, **kwargs):
-        mean = T.mean(self.input_layer.output(), axis=(0, 2, 3), keepdims=True)
-        std = T.std(self.input_layer.output(), axis=(0, 2, 3), keepdims=True)
-        x = (self.input_layer.output() - mean)/(std + self.epsilon)
+        input = self.input_layer.output(dropout_active=dropout_active,
+                                        *args, **kwargs)
+        mean = T.mean(input, axis=(0, 2, 3), keepdims=True)
+        std = T.std(input, axis=(0, 2, 3), keepdims=True)
+        x = (input - mean)/(std + self.epsilon)
 
         gamma = self.gamma.dimshuffle('x', 0, 'x', 'x')
         beta = self.beta.dimshuffle('x', 0, 'x', 'x')
@@ -756,7 +720,7 @@ class NonlinearityLayer(Layer):
         return self.input_layer.get_output_shape()
 
     def output(self, *args, **kwargs):
-        input = self.input_layer.output()
+        input = self.input_layer.output(*args, **kwargs)
         return self.nonlinearity(input)
 
 
@@ -776,6 +740,6 @@ class TimeMaxPoolLayer(Layer):
         return out_shape
 
     def output(self, *args, **kwargs):
-        input = self.input_layer.output()
+        input = self.input_layer.output(*args, **kwargs)
         output = T.max(input, axis=0, keepdims=True)
         return output
\ No newline at end of file
@@ -0,0 +1,176 @@
+"""Optimizers generating the training updates of a model.
+
+An optimizer takes the gradient of the loss with respect to all parameters
+in a single theano.grad call and turns it into updates, keeping per
+parameter state (momentum, accumulators) in n_slots shared variables per
+parameter, created directly at the right shape.
+
+With flat=True the slots are single flat buffers and the update is
+computed on the concatenation of all parameters and gradients. The
+parameters are still separate shared variables owned by their layers, so
+every step concatenates them and splits the new values back per parameter.
+This costs an extra copy of the parameters and gradients per step and is
+not faster than the default; use it when the optimizer state is wanted as
+one vector per slot.
+
+Models take an optimizer instance, e.g.
+    Model('name', path, optimizer=optimizers.RMSProp(rho=0.95))
+"""
+import numpy
+import theano
+import theano.tensor as T
+
+
+def zeros_like(param):
+    """Shared variable of zeros with the shape and broadcast pattern of
+    param, without copying param's value to the host.
+    """
+    value = param.get_value(borrow=True, return_internal_type=True)
+    return theano.shared(numpy.zeros(value.shape, dtype=param.dtype),
+                         broadcastable=param.broadcastable)
+
+
+def _flat_zeros(size, dtype):
+    return theano.shared(numpy.zeros(size, dtype=dtype))
+
+
+class Optimizer(object):
+    # Number of state buffers per parameter.
+    n_slots = 0
+
+    def __init__(self, flat=False):
+        self.flat = flat
+
+    def __repr__(self):
+        # Part of the function cache key, so it lists every hyperparameter.
+        return '%s(%s)' % (type(self).__name__, ', '.join(
+            '%s=%r' % item for item in sorted(vars(self).items())))
+
+    def get_updates(self, loss, all_parameters, learning_rate):
+        all_grads = theano.grad(loss, all_parameters)
+        return self.get_updates_from_grads(all_grads, all_parameters,
+                                           learning_rate)
+
+    def get_updates_from_grads(self, all_grads, all_parameters,
+                               learning_rate):
+        """Updates for the given gradients, e.g. averaged over workers or
+        clipped. Slots come before their parameter in the list.
+        """
+        if self.flat:
+            return self._get_flat_updates(all_grads, all_parameters,
+                                          learning_rate)
+        updates = []
+        for param, grad in zip(all_parameters, all_grads):
+            slots = [zeros_like(param) for _ in range(self.n_slots)]
+            new_param, new_slots = self.update(param, grad, slots,
+                                               learning_rate)
+            updates.extend(zip(slots, new_slots))
+            updates.append((param, new_param))
+        return updates
+
+    def _get_flat_updates(self, all_grads, all_parameters, learning_rate):
+        sizes = [param.get_value(borrow=True,
+                                 return_internal_type=True).size
+                 for param in all_parameters]
+        flat_param = T.concatenate([param.flatten()
+                                    for param in all_parameters])
+        flat_grad = T.concatenate([grad.flatten() for grad in all_grads])
+        slots = [_flat_zeros(sum(sizes), theano.config.floatX)
+                 for _ in range(self.n_slots)]
+        new_flat_param, new_slots = self.update(flat_param, flat_grad, slots,
+                                                learning_rate)
+
+        updates = zip(slots, new_slots)
+        offset = 0
+        for param, size in zip(all_parameters, sizes):
+            new_param = new_flat_param[offset:offset + size].reshape(
+                param.shape, ndim=param.ndim)
+            updates.append((param, T.patternbroadcast(new_param,
+                                                      param.broadcastable)))
+            offset += size
+        return updates
+
+    def update(self, param, grad, slots, learning_rate):
+        """New value of param and of its slots."""
+        raise NotImplementedError(str(type(self)) +
+                                  " does not implement update.")
+
+
+class SGD(Optimizer):
+    def update(self, param, grad, slots, learning_rate):
+        return param - learning_rate * grad, []
+
+
+class Momentum(Optimizer):
+    n_slots = 1
+
+    def __init__(self, momentum=0.9, weight_decay=0., flat=False):
+        super(Momentum, self).__init__(flat=flat)
+        self.momentum = momentum
+        self.weight_decay = weight_decay
+
+    def update(self, param, grad, slots, learning_rate):
+        velocity, = slots
+        v = (self.momentum * velocity -
+             self.weight_decay * learning_rate * param -
+             learning_rate * grad)
+        return param + v, [v]
+
+
+# using the alternative formulation of nesterov momentum described at
+# https://github.com/lisa-lab/pylearn2/pull/136
+# such that the gradient can be evaluated at the current parameters.
+class NesterovMomentum(Momentum):
+    def update(self, param, grad, slots, learning_rate):
+        velocity, = slots
+        full_grad = grad + self.weight_decay * param
+        v = self.momentum * velocity - learning_rate * full_grad
+        return param + self.momentum * v - learning_rate * full_grad, [v]
+
+
+class Adagrad(Optimizer):
+    n_slots = 1
+
+    def __init__(self, epsilon=1e-6, flat=False):
+        super(Adagrad, self).__init__(flat=flat)
+        self.epsilon = epsilon
+
+    def update(self, param, grad, slots, learning_rate):
+        acc, = slots
+        acc_new = acc + grad ** 2
+        return (param - learning_rate * grad / T.sqrt(acc_new + self.epsilon),
+                [acc_new])
+
+
+class RMSProp(Optimizer):
+    n_slots = 1
+
+    def __init__(self, rho=0.9, epsilon=1e-6, flat=False):
+        super(RMSProp, self).__init__(flat=flat)
+        self.rho = rho
+        self.epsilon = epsilon
+
+    def update(self, param, grad, slots, learning_rate):
+        acc, = slots
+        acc_new = self.rho * acc + (1 - self.rho) * grad ** 2
+        return (param - learning_rate * grad / T.sqrt(acc_new + self.epsilon),
+                [acc_new])
+
+
+class Adadelta(Optimizer):
+    n_slots = 2
+
+    def __init__(self, rho=0.95, epsilon=1e-6, flat=False):
+        super(Adadelta, self).__init__(flat=flat)
+        self.rho = rho
+        self.epsilon = epsilon
+
+    def update(self, param, grad, slots, learning_rate):
+        # acc: accumulated gradient magnitudes, acc_delta: accumulated
+        # update magnitudes.
+        acc, acc_delta = slots
+        acc_new = self.rho * acc + (1 - self.rho) * grad ** 2
+        update = (grad * T.sqrt(acc_delta + self.epsilon) /
+                  T.sqrt(acc_new + self.epsilon))
+        acc_delta_new = self.rho * acc_delta + (1 - self.rho) * update ** 2
+        return param - learning_rate * update, [acc_new, acc_delta_new]
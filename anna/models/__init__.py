@@ -1,30 +1,284 @@
+import os
+from collections import OrderedDict
+
 import numpy
 
 import theano
 import theano.tensor as T
+from theano.ifelse import ifelse
 # TODO(tpaine) remove this dependency, can be done
 # by factoring out the cost theano equation
 
-from anna.layers import layers, cc_layers
+from anna.layers import layers, cc_layers, optimizers
+from anna.models import function_cache
 
 theano.config.floatX = 'float32'
 
 
+def _unique(variables):
+    # Removes duplicates but keeps the order, so that checkpoints line up
+    # between runs (a set would order by id).
+    seen = set()
+    unique = []
+    for variable in variables:
+        if variable not in seen:
+            seen.add(variable)
+            unique.append(variable)
+    return unique
+
+
+def inference_model(model_class, *args, **kwargs):
+    """Builds model_class in inference-only mode, for model classes whose
+    __init__ does not pass inference_only on.
+    """
+    inference_class = type(model_class.__name__, (model_class,),
+                           {'inference_only': True})
+    return inference_class(*args, **kwargs)
+
+
 class AbstractModel(object):
     # Abstract Model
 
-    def __init__(self, name, path, learning_rate=0.000001):
+    # In inference-only mode no gradients, optimizer buffers or training
+    # functions are ever built, only what prediction and eval need.
+    inference_only = False
+
+    def __init__(self, name, path, learning_rate=0.000001,
+                 inference_only=None, optimizer=None):
         self.name = name
         self.path = path
+        if inference_only is not None:
+            self.inference_only = inference_only
+        # See anna.layers.optimizers.
+        if optimizer is None:
+            optimizer = optimizers.Momentum(momentum=0.9, weight_decay=1e-5)
+        self.optimizer = optimizer
+        # Whether graphs are currently being built with dropout, see
+        # _without_dropout.
+        self.dropout_active = True
         self.learning_rate_symbol = theano.shared(
             numpy.array(learning_rate, dtype=theano.config.floatX))
+        # Directory shared by identical models to reuse compiled functions,
+        # see function_cache. Set by scripts/launcher.py.
+        self.function_cache_dir = os.environ.get('ANNA_FUNCTION_CACHE')
 
-        # Automatically compile theano functions needed for model.
+        # Gather the parameters. Theano functions are compiled on first use.
         self._compile()
 
+    def __getattr__(self, name):
+        # Only called when the attribute does not exist yet. Anything with a
+        # _build_<name> method (compiled functions, the update graph) is
+        # built the first time it is used and then kept on the instance, so
+        # e.g. a model that only predicts never builds the gradient graph.
+        builder = getattr(type(self), '_build_' + name, None)
+        if builder is None:
+            raise AttributeError("'%s' object has no attribute '%s'" %
+                                 (type(self).__name__, name))
+        value = builder(self)
+        setattr(self, name, value)
+        return value
+
     def _compile(self):
-        raise NotImplementedError(str(type(self)) +
-                                  " does not implement _compile.")
+        self.all_trainable_parameters_symbol = layers.all_trainable_parameters(
+            self._get_output_layer())
+
+        self.all_save_parameters_symbol = layers.all_parameters(
+            self._get_output_layer())
+
+        # Forget functions built from the previous graph (e.g. after layers
+        # were changed), they are rebuilt on next use.
+        for name in self.__dict__.keys():
+            if hasattr(type(self), '_build_' + name):
+                del self.__dict__[name]
+
+    def _function(self, name, inputs, outputs, updates=None, givens=None):
+        # theano.function, going through the on-disk cache when enabled.
+        if not self.function_cache_dir:
+            return theano.function(inputs, outputs, updates=updates,
+                                   givens=givens)
+
+        cache = function_cache.FunctionCache(self.function_cache_dir)
+        key = cache.get_key(self, name)
+        shared_variables = function_cache.get_shared_variables(
+            outputs, updates, givens)
+        func = cache.load(key, shared_variables)
+        if func is None:
+            func = theano.function(inputs, outputs, updates=updates,
+                                   givens=givens)
+            cache.store(key, func, shared_variables)
+        return func
+
+    def _build_updates_symbol(self):
+        if self.inference_only:
+            raise RuntimeError('%s was built in inference-only mode and '
+                               'cannot be trained.' % self.name)
+        return self.optimizer.get_updates(
+            self._get_cost_symbol(),
+            self.all_trainable_parameters_symbol,
+            self.learning_rate_symbol)
+
+    def _clone_updates(self, replace):
+        # updates_symbol with the variables of replace substituted, for
+        # fused steps that compute some training inputs in the graph.
+        return OrderedDict(
+            (variable, theano.clone(update, replace=replace))
+            for variable, update in self.updates_symbol)
+
+    def _build_train_func(self):
+        return self._function(
+            'train_func',
+            self._get_train_inputs_symbol(),
+            self._get_train_outputs_symbol(),
+            updates=self.updates_symbol)
+
+    def _build_eval_func(self, name='eval_func'):
+        return self._function(
+            name,
+            self._get_train_inputs_symbol(),
+            self._get_eval_outputs_symbol())
+
+    def _build_prediction_func(self, name='prediction_func'):
+        return self._function(
+            name,
+            [self._get_input_symbol()],
+            self._get_output_symbol())
+
+    def _build_train_many_func(self):
+        # Runs one training step per minibatch of a stacked block inside a
+        # single scan, applying the updates after every step, so Python
+        # dispatch and the host to device copy are paid once per block.
+        inputs = self._get_train_inputs_symbol()
+        outputs = self._get_train_outputs_symbol()
+        if not isinstance(outputs, (list, tuple)):
+            outputs = [outputs]
+
+        blocks = [T.TensorType(input.dtype, (False,) + input.broadcastable)(
+            'block') for input in inputs]
+
+        def step(*batch):
+            replace = dict(zip(inputs, batch))
+            step_outputs = theano.clone(outputs, replace=replace)
+            return step_outputs, self._clone_updates(replace)
+
+        step_outputs, scan_updates = theano.scan(step, sequences=blocks)
+        return self._function(
+            'train_many_func',
+            blocks,
+            step_outputs,
+            updates=scan_updates)
+
+    # Training on a chunk of the dataset held in shared variables (see
+    # set_chunk). Minibatches are selected with givens, by batch index or by
+    # an index vector, so no data is copied in per step.
+
+    def _build_chunk_symbol(self):
+        return [theano.shared(numpy.zeros((0,) * input.ndim,
+                                          dtype=input.dtype),
+                              broadcastable=input.broadcastable)
+                for input in self._get_train_inputs_symbol()]
+
+    def _get_train_batch_axes(self):
+        # The input may be c01b, everything else has the batch first.
+        axes = [0] * len(self._get_train_inputs_symbol())
+        axes[0] = layers.get_batch_axis(self.input)
+        return axes
+
+    def _get_chunk_givens(self, select):
+        # select(chunk, axis) returns the minibatch taken from the chunk.
+        return [(input, select(chunk, axis)) for input, chunk, axis in
+                zip(self._get_train_inputs_symbol(), self.chunk_symbol,
+                    self._get_train_batch_axes())]
+
+    def _get_slice_givens(self, index):
+        batch_size = self.input.mb_size
+        batch = slice(index * batch_size, (index + 1) * batch_size)
+        return self._get_chunk_givens(
+            lambda chunk, axis: chunk[(slice(None),) * axis + (batch,)])
+
+    def _get_indexed_givens(self, indices):
+        return self._get_chunk_givens(
+            lambda chunk, axis: T.take(chunk, indices, axis=axis))
+
+    def _build_train_chunk_func(self):
+        index = T.lscalar('index')
+        return self._function(
+            'train_chunk_func',
+            [index],
+            self._get_train_outputs_symbol(),
+            updates=self.updates_symbol,
+            givens=self._get_slice_givens(index))
+
+    def _build_eval_chunk_func(self, name='eval_chunk_func'):
+        index = T.lscalar('index')
+        return self._function(
+            name,
+            [index],
+            self._get_eval_outputs_symbol(),
+            givens=self._get_slice_givens(index))
+
+    def _build_train_indexed_func(self):
+        indices = T.lvector('indices')
+        return self._function(
+            'train_indexed_func',
+            [indices],
+            self._get_train_outputs_symbol(),
+            updates=self.updates_symbol,
+            givens=self._get_indexed_givens(indices))
+
+    def _build_eval_indexed_func(self, name='eval_indexed_func'):
+        indices = T.lvector('indices')
+        return self._function(
+            name,
+            [indices],
+            self._get_eval_outputs_symbol(),
+            givens=self._get_indexed_givens(indices))
+
+    # Inference-time graphs, with dropout compiled out (no random masks).
+    # They have names of their own, which keep them apart from the
+    # train-time graphs in the function cache.
+
+    def _build_inference_eval_func(self):
+        return self._without_dropout(self._build_eval_func,
+                                     'inference_eval_func')
+
+    def _build_inference_eval_chunk_func(self):
+        return self._without_dropout(self._build_eval_chunk_func,
+                                     'inference_eval_chunk_func')
+
+    def _build_inference_eval_indexed_func(self):
+        return self._without_dropout(self._build_eval_indexed_func,
+                                     'inference_eval_indexed_func')
+
+    def _build_inference_prediction_func(self):
+        return self._without_dropout(self._build_prediction_func,
+                                     'inference_prediction_func')
+
+    def _without_dropout(self, build, *args):
+        # Runs a builder with every layer's output built with
+        # dropout_active=False.
+        self.dropout_active = False
+        try:
+            return build(*args)
+        finally:
+            self.dropout_active = True
+
+    def _select(self, name, dropout_active):
+        # Picks the train-time or the inference-time version of a function.
+        # Prediction and evaluation run without dropout by default, the
+        # train-time graph (with random masks) only when asked for.
+        if dropout_active:
+            return getattr(self, name)
+        return getattr(self, 'inference_' + name)
+
+    def _get_train_inputs_symbol(self):
+        raise NotImplementedError(str(type(self)) + " does not implement "
+                                  "_get_train_inputs_symbol.")
+
+    def _get_train_outputs_symbol(self):
+        return self._get_cost_symbol()
+
+    def _get_eval_outputs_symbol(self):
+        return self._get_cost_symbol()
 
     def _get_cost_symbol(self):
         raise NotImplementedError(str(type(self)) +
@@ -34,6 +288,41 @@ class AbstractModel(object):
         raise NotImplementedError(str(type(self)) +
                                   " does not implement train.")
 
+    def set_chunk(self, *arrays):
+        '''Copies a chunk of the dataset to the device: the arguments of
+        train for many minibatches, concatenated along their batch axis.
+        Returns the number of full minibatches in the chunk.
+        '''
+        if len(arrays) != len(self.chunk_symbol):
+            raise ValueError('set_chunk takes %d arrays (the arguments of '
+                             'train), not %d.' % (len(self.chunk_symbol),
+                                                  len(arrays)))
+        for chunk, array in zip(self.chunk_symbol, arrays):
+            chunk.set_value(array, borrow=True)
+        axis = self._get_train_batch_axes()[0]
+        return arrays[0].shape[axis] // self.input.mb_size
+
+    def train_chunk(self, batch_index):
+        '''Trains on minibatch batch_index of the current chunk.'''
+        return self.train_chunk_func(batch_index)
+
+    def eval_chunk(self, batch_index, dropout_active=False):
+        return self._select('eval_chunk_func', dropout_active)(batch_index)
+
+    def train_indexed(self, indices):
+        '''Trains on the samples of the current chunk at indices.'''
+        return self.train_indexed_func(indices)
+
+    def eval_indexed(self, indices, dropout_active=False):
+        return self._select('eval_indexed_func', dropout_active)(indices)
+
+    def train_many(self, *blocks):
+        '''K training steps in one call. Takes the arguments of train, each
+        stacked along a new leading axis of length K, and returns the
+        outputs of train for every step, stacked the same way.
+        '''
+        return self.train_many_func(*blocks)
+
     def eval(self, batch):
         raise NotImplementedError(str(type(self)) +
                                   " does not implement eval.")
@@ -47,61 +336,55 @@ class AbstractModel(object):
         return self.input.output()
 
     def _get_output_symbol(self):
-        # Last layer of Model must be called output
-        return self.output.output()
+        # Last layer of Model must be called output. The output is built once
+        # per dropout setting, so that every symbol of a function (cost,
+        # clusters, actions) shares one forward pass and one dropout mask.
+        if self.dropout_active:
+            return self.output_symbol
+        return self.inference_output_symbol
+
+    def _build_output_symbol(self):
+        return self.output.output(dropout_active=True)
+
+    def _build_inference_output_symbol(self):
+        return self.output.output(dropout_active=False)
 
     def _get_output_layer(self):
         # Last layer of Model must be called output
         return self.output
 
+    def _get_optimizer_parameters_symbol(self):
+        # Shared variables the updates write to that are not parameters,
+        # i.e. momentum buffers and adaptive learning rate accumulators.
+        # Their order follows updates_symbol, so it is stable across runs.
+        trainable = set(self.all_trainable_parameters_symbol)
+        return [var for var, _ in self.updates_symbol if var not in trainable]
+
 
 class UnsupervisedModel(AbstractModel):
     # def __init__(self, name, path, learning_rate=0.000001):
     #    super(UnsupervisedModel, self).__init__(
     #        name, path, learning_rate=learning_rate)
 
-    def _compile(self):
-        self.all_trainable_parameters_symbol = layers.all_trainable_parameters(
-            self._get_output_layer())
-
-        self.all_save_parameters_symbol = layers.all_parameters(
-            self._get_output_layer())
-
-        # can switch to gen_updates_regular_momentum
-        self.updates_symbol = layers.gen_updates_regular_momentum(
-            self._get_cost_symbol(),
-            self.all_trainable_parameters_symbol,
-            learning_rate=self.learning_rate_symbol,
-            momentum=0.9,
-            weight_decay=1e-5)
-
-        self.train_func = theano.function(
-            [self._get_input_symbol()],
-            self._get_cost_symbol(),
-            updates=self.updates_symbol)
-
-        self.eval_func = theano.function(
-            [self._get_input_symbol()],
-            self._get_cost_symbol())
-
-        self.prediction_func = theano.function(
-            [self._get_input_symbol()],
-            self._get_output_symbol())
+    def _get_train_inputs_symbol(self):
+        return [self._get_input_symbol()]
 
     def _get_cost_symbol(self):
         input = self._get_input_symbol()
         output = self._get_output_symbol()
-        cost = T.sum((output - input) ** 2)/self.batch
+        batch_size = T.cast(input.shape[layers.get_batch_axis(self.input)],
+                            theano.config.floatX)
+        cost = T.sum((output - input) ** 2)/batch_size
         return cost
 
     def train(self, batch):
         return self.train_func(batch)
 
-    def eval(self, batch):
-        return self.eval_func(batch)
+    def eval(self, batch, dropout_active=False):
+        return self._select('eval_func', dropout_active)(batch)
 
-    def prediction(self, batch):
-        return self.prediction_func(batch)
+    def prediction(self, batch, dropout_active=False):
+        return self._select('prediction_func', dropout_active)(batch)
 
 
 # class RegressionModel(AbstractModel):
@@ -154,37 +437,19 @@ class UnsupervisedModel(AbstractModel):
 
 
 class SupervisedModel(AbstractModel):
-    def __init__(self, name, path, learning_rate=0.000001):
+    def __init__(self, name, path, learning_rate=0.000001, **kwargs):
         self.y = T.lvector(name='labels')
         super(SupervisedModel, self).__init__(
-            name, path, learning_rate=learning_rate)
-
-    def _compile(self):
-        self.all_trainable_parameters_symbol = layers.all_trainable_parameters(
-            self._get_output_layer())
+            name, path, learning_rate=learning_rate, **kwargs)
 
-        self.all_save_parameters_symbol = layers.all_parameters(
-            self._get_output_layer())
-
-        self.updates_symbol = layers.gen_updates_regular_momentum(
-            self._get_cost_symbol(),
-            self.all_trainable_parameters_symbol,
-            learning_rate=self.learning_rate_symbol,
-            momentum=0.9,
-            weight_decay=1e-5)
+    def _get_train_inputs_symbol(self):
+        return [self._get_input_symbol(), self._get_y_symbol()]
 
-        self.train_func = theano.function(
-            [self._get_input_symbol(), self._get_y_symbol()],
-            [self._get_cost_symbol(), self._get_accuracy_symbol()],
-            updates=self.updates_symbol)
-
-        self.eval_func = theano.function(
-            [self._get_input_symbol(), self._get_y_symbol()],
-            self._get_accuracy_symbol())
+    def _get_train_outputs_symbol(self):
+        return [self._get_cost_symbol(), self._get_accuracy_symbol()]
 
-        self.prediction_func = theano.function(
-            [self._get_input_symbol()],
-            self._get_output_symbol())
+    def _get_eval_outputs_symbol(self):
+        return self._get_accuracy_symbol()
 
     def _get_cost_symbol(self):
         y = self._get_y_symbol()
@@ -195,11 +460,11 @@ class SupervisedModel(AbstractModel):
     def train(self, x_batch, y_batch):
         return self.train_func(x_batch, y_batch)
 
-    def eval(self, x_batch, y_batch):
-        return self.eval_func(x_batch, y_batch)
+    def eval(self, x_batch, y_batch, dropout_active=False):
+        return self._select('eval_func', dropout_active)(x_batch, y_batch)
 
-    def prediction(self, x_batch):
-        return self.prediction_func(x_batch)
+    def prediction(self, x_batch, dropout_active=False):
+        return self._select('prediction_func', dropout_active)(x_batch)
 
     # New methods for SupervisedModel class
     def _get_y_symbol(self):
@@ -215,37 +480,13 @@ class SupervisedModel(AbstractModel):
 
 
 class RegressionModel(AbstractModel):
-    def __init__(self, name, path, learning_rate=0.000001):
+    def __init__(self, name, path, learning_rate=0.000001, **kwargs):
         self.y = T.fmatrix(name='labels')
         super(RegressionModel, self).__init__(
-            name, path, learning_rate=learning_rate)
-
-    def _compile(self):
-        self.all_trainable_parameters_symbol = layers.all_trainable_parameters(
-            self._get_output_layer())
-
-        self.all_save_parameters_symbol = layers.all_parameters(
-            self._get_output_layer())
+            name, path, learning_rate=learning_rate, **kwargs)
 
-        self.updates_symbol = layers.gen_updates_regular_momentum(
-            self._get_cost_symbol(),
-            self.all_trainable_parameters_symbol,
-            learning_rate=self.learning_rate_symbol,
-            momentum=0.9,
-            weight_decay=1e-5)
-
-        self.train_func = theano.function(
-            [self._get_input_symbol(), self._get_y_symbol()],
-            self._get_cost_symbol(),
-            updates=self.updates_symbol)
-
-        self.eval_func = theano.function(
-            [self._get_input_symbol(), self._get_y_symbol()],
-            self._get_cost_symbol())
-
-        self.prediction_func = theano.function(
-            [self._get_input_symbol()],
-            self._get_output_symbol())
+    def _get_train_inputs_symbol(self):
+        return [self._get_input_symbol(), self._get_y_symbol()]
 
     def _get_cost_symbol(self):
         y = self._get_y_symbol()
@@ -256,11 +497,11 @@ class RegressionModel(AbstractModel):
     def train(self, x_batch, y_batch):
         return self.train_func(x_batch, y_batch)
 
-    def eval(self, x_batch, y_batch):
-        return self.eval_func(x_batch, y_batch)
+    def eval(self, x_batch, y_batch, dropout_active=False):
+        return self._select('eval_func', dropout_active)(x_batch, y_batch)
 
-    def prediction(self, x_batch):
-        return self.prediction_func(x_batch)
+    def prediction(self, x_batch, dropout_active=False):
+        return self._select('prediction_func', dropout_active)(x_batch)
 
     # New methods for this class
     def _get_y_symbol(self):
@@ -269,59 +510,51 @@ class RegressionModel(AbstractModel):
 
 
 class KRegressionModel(AbstractModel):
-    def __init__(self, name, path, learning_rate=0.000001):
+    def __init__(self, name, path, learning_rate=0.000001, **kwargs):
         self.cluster_symbol = T.fmatrix('cluster')
         super(KRegressionModel, self).__init__(
-            name, path, learning_rate=learning_rate)
-
-    def _compile(self):
-        self.all_trainable_parameters_symbol = layers.all_trainable_parameters(
-            self._get_output_layer())
-
-        self.all_save_parameters_symbol = layers.all_parameters(
-            self._get_output_layer())
+            name, path, learning_rate=learning_rate, **kwargs)
 
-        self.updates_symbol = layers.gen_updates_regular_momentum(
-            self._get_cost_symbol(),
-            self.all_trainable_parameters_symbol,
-            learning_rate=self.learning_rate_symbol,
-            momentum=0.9,
-            weight_decay=1e-5)
-
-        self.train_func = theano.function(
-            [self._get_input_symbol(),
-             self._get_y_symbol(),
-             self.cluster_symbol],
-            self._get_cost_symbol(),
-            updates=self.updates_symbol)
-
-        self.eval_func = theano.function(
-            [self._get_input_symbol(),
-             self._get_y_symbol(),
-             self.cluster_symbol],
-            self._get_cost_symbol())
-
-        self.prediction_func = theano.function(
-            [self._get_input_symbol()],
-            self._get_output_symbol())
+    def _get_train_inputs_symbol(self):
+        return [self._get_input_symbol(),
+                self._get_y_symbol(),
+                self.cluster_symbol]
 
-        self.cluster_func = theano.function(
+    def _build_cluster_func(self):
+        return self._function(
+            'cluster_func',
             [self._get_input_symbol(), self._get_y_symbol()],
             self._get_cluster_symbol())
 
+    def _build_train_step_func(self):
+        # The cost with the cluster mask replaced by the one-hot argmin
+        # cluster, computed from the same forward pass. The gradient is the
+        # one of train, with the mask held constant.
+        cluster = self._get_cluster_symbol()
+        one_hot = T.cast(T.eq(cluster[:, None], T.arange(self.k)[None, :]),
+                         theano.config.floatX)
+        replace = {self.cluster_symbol: one_hot}
+        outputs = theano.clone([self._get_cost_symbol(), cluster],
+                               replace=replace)
+        return self._function(
+            'train_step_func',
+            [self._get_input_symbol(), self._get_y_symbol()],
+            outputs,
+            updates=self._clone_updates(replace))
+
     def _get_cost_symbol(self):
         cluster = self.cluster_symbol
         mask = T.tile(cluster[:, None, :], (1, self.y_n, 1))
         y = self._get_y_symbol()
         output = self._get_output_symbol()
-        Y_hat = T.reshape(output, (self.batch, self.y_n, self.k))
+        Y_hat = T.reshape(output, (output.shape[0], self.y_n, self.k))
         y_hat = T.sum(Y_hat*mask, axis=2)
         cost = T.mean((y - y_hat)**2)
         return cost
 
     def _get_cluster_symbol(self):
         output = self._get_output_symbol()
-        Y_hat = T.reshape(output, (self.batch, self.y_n, self.k))
+        Y_hat = T.reshape(output, (output.shape[0], self.y_n, self.k))
         y = self._get_y_symbol()
         Y = T.tile(y[:, :, None], (1, 1, self.k))
         diff = T.mean((Y - Y_hat)**2, axis=1)
@@ -331,19 +564,22 @@ class KRegressionModel(AbstractModel):
     def train(self, x_batch, y_batch, mask):
         return self.train_func(x_batch, y_batch, mask)
 
-    def eval(self, x_batch, y_batch, mask):
-        return self.eval_func(x_batch, y_batch, mask)
+    def train_step(self, x_batch, y_batch):
+        '''Assigns every sample to its closest cluster and trains on the
+        assignment in one call. Returns the cost and the assignments.
+        '''
+        return self.train_step_func(x_batch, y_batch)
 
-    def prediction(self, x_batch):
-        return self.prediction_func(x_batch)
+    def eval(self, x_batch, y_batch, mask, dropout_active=False):
+        return self._select('eval_func', dropout_active)(x_batch, y_batch,
+                                                          mask)
+
+    def prediction(self, x_batch, dropout_active=False):
+        return self._select('prediction_func', dropout_active)(x_batch)
 
     def cluster(self, x_batch, y_batch):
         clusters = self.cluster_func(x_batch, y_batch)
-
-        one_hot = numpy.zeros((self.batch, self.k))
-        for i, cluster in enumerate(clusters):
-            one_hot[i, cluster] = 1
-        return one_hot
+        return numpy.eye(self.k, dtype=theano.config.floatX)[clusters]
 
     # New methods for this class
     def _get_y_symbol(self):
@@ -351,76 +587,157 @@ class KRegressionModel(AbstractModel):
 
 
 class ReinforcementModel(AbstractModel):
-    def __init__(self, name, path, learning_rate=0.001):
+    def __init__(self, name, path, learning_rate=0.001,
+                 target_sync_every=1000, **kwargs):
+        '''target_sync_every: train_step copies the parameters to the
+        target network every target_sync_every steps.
+        '''
         self.r_symbol = T.fvector('r')
         self.gamma_symbol = T.fscalar('gamma')
         self.action_symbol = T.fmatrix('action')
         self.y_symbol = T.fvector('y')
+        self.action_index_symbol = T.lvector('action_index')
+        self.terminal_symbol = T.fvector('terminal')
+        self.weights_symbol = T.fvector('weights')
+        self.target_sync_every = target_sync_every
         super(ReinforcementModel, self).__init__(
-            name, path, learning_rate=learning_rate)
-
-    def _compile(self):
-        self.all_trainable_parameters_symbol = layers.all_trainable_parameters(
-            self._get_output_layer())
-
-        self.all_save_parameters_symbol = layers.all_parameters(
-            self._get_output_layer())
-
-        self.updates_symbol = layers.gen_updates_regular_momentum(
-            self._get_cost_symbol(),
-            self.all_trainable_parameters_symbol,
-            learning_rate=self.learning_rate_symbol,
-            momentum=0.9,
-            weight_decay=1e-5)
+            name, path, learning_rate=learning_rate, **kwargs)
 
-        self.train_func = theano.function(
-            [self._get_input_symbol(),
-             self.action_symbol,
-             self.y_symbol],
-            self._get_cost_symbol(),
-            updates=self.updates_symbol)
-
-        self.eval_func = theano.function(
-            [self._get_input_symbol(),
-             self.action_symbol,
-             self.y_symbol],
-            self._get_cost_symbol()
-            )
-
-        self.prediction_func = theano.function(
-            [self._get_input_symbol()],
-            self._get_output_symbol()
-            )
+    def _get_train_inputs_symbol(self):
+        return [self._get_input_symbol(),
+                self.action_symbol,
+                self.y_symbol]
 
-        # New funcs for ReinforcementModel
+    # New funcs for ReinforcementModel
 
-        self.action_func = theano.function(
+    def _build_action_func(self):
+        return self._function(
+            'action_func',
             [self._get_input_symbol()],
             self._get_action_symbol()
             )
 
-        self.max_q_func = theano.function(
+    def _build_max_q_func(self):
+        return self._function(
+            'max_q_func',
             [self._get_input_symbol()],
             self._get_max_q_symbol()
             )
 
-        self.y_func = theano.function(
+    def _build_y_func(self):
+        return self._function(
+            'y_func',
             [self._get_input_symbol(),
              self.r_symbol,
              self.gamma_symbol],
             self._get_y_symbol()
             )
 
-        self.value_func = theano.function(
+    def _build_value_func(self):
+        return self._function(
+            'value_func',
             [self._get_input_symbol(),
              self.action_symbol],
             self._get_value_symbol()
             )
 
-    def prediction(self, x_batch):
+    # Target network: shared copies of the parameters, synced in the graph
+    # of train_step every target_sync_every steps.
+
+    def _build_target_parameters_symbol(self):
+        return [theano.shared(param.get_value(),
+                              broadcastable=param.broadcastable)
+                for param in self.all_save_parameters_symbol]
+
+    def _build_target_step_symbol(self):
+        return theano.shared(numpy.int64(0), name='target_step')
+
+    def _build_next_input_symbol(self):
+        input = self._get_input_symbol()
+        return input.type('next_input')
+
+    def _get_target_y_symbol(self):
+        # Q values of the next states under the target network, without
+        # dropout. Terminal transitions get no bootstrapped value.
+        replace = dict(zip(self.all_save_parameters_symbol,
+                           self.target_parameters_symbol))
+        replace[self._get_input_symbol()] = self.next_input_symbol
+        next_q = theano.clone(self.inference_output_symbol, replace=replace)
+        max_q = T.max(next_q, axis=1)
+        return (self.r_symbol +
+                self.gamma_symbol * (1 - self.terminal_symbol) * max_q)
+
+    def _build_train_step_func(self):
+        action = T.cast(T.eq(self.action_index_symbol[:, None],
+                             T.arange(self.action_dims)[None, :]),
+                        theano.config.floatX)
+        value = theano.clone(self._get_value_symbol(),
+                             replace={self.action_symbol: action})
+        td_error = self._get_target_y_symbol() - value
+        weights = self.weights_symbol
+        cost = T.mean(weights * td_error**2)
+
+        # The gradient in updates_symbol treats y as a constant, so training
+        # towards value + weights * td_error scales the gradient of every
+        # sample by its importance weight.
+        replace = {self.action_symbol: action,
+                   self.y_symbol: value + weights * td_error}
+        updates = self._clone_updates(replace)
+
+        step = self.target_step_symbol + 1
+        sync = T.eq(step % self.target_sync_every, 0)
+        targets = self.target_parameters_symbol
+        synced = ifelse(sync, list(self.all_save_parameters_symbol),
+                        list(targets))
+        if not isinstance(synced, (list, tuple)):
+            synced = [synced]
+        updates[self.target_step_symbol] = step
+        updates.update(zip(targets, synced))
+
+        return self._function(
+            'train_step_func',
+            [self._get_input_symbol(),
+             self.action_index_symbol,
+             self.r_symbol,
+             self.next_input_symbol,
+             self.terminal_symbol,
+             self.gamma_symbol,
+             self.weights_symbol],
+            [cost, td_error],
+            updates=updates)
+
+    def _get_optimizer_parameters_symbol(self):
+        # The target network and its step counter are part of the training
+        # state too.
+        return (super(ReinforcementModel, self)
+                ._get_optimizer_parameters_symbol() +
+                self.target_parameters_symbol + [self.target_step_symbol])
+
+    def train_step(self, batch_x, action_index, r, batch_next_x, terminal,
+                   gamma, weights=None):
+        '''One DQN update: computes the targets from the next states with
+        the target network and trains on them in a single call.
+        action_index holds the index of the action taken, terminal is 1 for
+        transitions that ended an episode and weights are optional
+        importance weights of the samples (e.g. from prioritized replay).
+        Returns the cost and the TD errors.
+        '''
+        if weights is None:
+            weights = numpy.ones(len(r), dtype=numpy.float32)
+        return self.train_step_func(batch_x, action_index, r, batch_next_x,
+                                    terminal, gamma, weights)
+
+    def sync_target(self):
+        '''Copies the parameters to the target network.'''
+        for param, target in zip(self.all_save_parameters_symbol,
+                                 self.target_parameters_symbol):
+            target.set_value(param.get_value())
+        self.target_step_symbol.set_value(numpy.int64(0))
+
+    def prediction(self, x_batch, dropout_active=False):
         '''Output of the Q network
         '''
-        return self.prediction_func(x_batch)
+        return self._select('prediction_func', dropout_active)(x_batch)
 
     def _get_action_symbol(self):
         output = self._get_output_symbol()
@@ -455,11 +772,12 @@ class ReinforcementModel(AbstractModel):
         '''Action with max Q value
         '''
         action_index = self.action_func(batch_x)
-        actions = numpy.zeros((self.batch, self.action_dims),
-                              dtype=numpy.float32)
-        for i, action in enumerate(action_index):
-            actions[i, action] = 1
-        return actions
+        return numpy.eye(self.action_dims, dtype=numpy.float32)[action_index]
+
+    def action_index(self, batch_x):
+        '''Index of the action with max Q value, for any number of states.
+        '''
+        return self.action_func(batch_x)
 
     def max_q(self, batch_x):
         '''Max Q value
@@ -476,10 +794,10 @@ class ReinforcementModel(AbstractModel):
         '''
         return self.value_func(batch_x, action)
 
-    def eval(self, batch_x, action, y):
+    def eval(self, batch_x, action, y, dropout_active=False):
         '''Average squared difference between Q value of action and target, y.
         '''
-        return self.eval_func(batch_x, action, y)
+        return self._select('eval_func', dropout_active)(batch_x, action, y)
 
     def train(self, batch_x, action, y):
         '''Train (i.e. update the model parameters) based on data.
@@ -488,40 +806,28 @@ class ReinforcementModel(AbstractModel):
 
 
 class ForkModel(AbstractModel):
-    def __init__(self, name, path, learning_rate=0.000001):
+    def __init__(self, name, path, learning_rate=0.000001, **kwargs):
         self.y = T.lvector(name='labels')
         super(ForkModel, self).__init__(
-            name, path, learning_rate=learning_rate)
+            name, path, learning_rate=learning_rate, **kwargs)
 
     def _compile(self):
+        super(ForkModel, self)._compile()
 
-        output = self._get_output_layer()
-        all_trainable_parameters = layers.all_trainable_parameters(output)
-        self.all_trainable_parameters_symbol = list(set(
-            all_trainable_parameters))
+        # Branches of the fork share layers below the split.
+        self.all_trainable_parameters_symbol = _unique(
+            self.all_trainable_parameters_symbol)
+        self.all_save_parameters_symbol = _unique(
+            self.all_save_parameters_symbol)
 
-        all_save_parameters = layers.all_parameters(output)
-        self.all_save_parameters_symbol = list(set(all_save_parameters))
+    def _get_train_inputs_symbol(self):
+        return [self._get_input_symbol(), self._get_y_symbol()]
 
-        self.updates_symbol = layers.gen_updates_regular_momentum(
-            self._get_cost_symbol(),
-            self.all_trainable_parameters_symbol,
-            learning_rate=self.learning_rate_symbol,
-            momentum=0.9,
-            weight_decay=1e-5)
-
-        self.train_func = theano.function(
-            [self._get_input_symbol(), self._get_y_symbol()],
-            [self._get_cost_symbol(), self._get_accuracy_symbol()],
-            updates=self.updates_symbol)
+    def _get_train_outputs_symbol(self):
+        return [self._get_cost_symbol(), self._get_accuracy_symbol()]
 
-        self.eval_func = theano.function(
-            [self._get_input_symbol(), self._get_y_symbol()],
-            self._get_accuracy_symbol())
-
-        self.prediction_func = theano.function(
-            [self._get_input_symbol()],
-            self._get_output_symbol())
+    def _get_eval_outputs_symbol(self):
+        return self._get_accuracy_symbol()
 
     def _get_cost_symbol(self):
         y = self._get_y_symbol()
@@ -532,11 +838,11 @@ class ForkModel(AbstractModel):
     def train(self, x_batch, y_batch):
         return self.train_func(x_batch, y_batch)
 
-    def eval(self, x_batch, y_batch):
-        return self.eval_func(x_batch, y_batch)
+    def eval(self, x_batch, y_batch, dropout_active=False):
+        return self._select('eval_func', dropout_active)(x_batch, y_batch)
 
-    def prediction(self, x_batch):
-        return self.prediction_func(x_batch)
+    def prediction(self, x_batch, dropout_active=False):
+        return self._select('prediction_func', dropout_active)(x_batch)
 
     # New methods for SupervisedModel class
     def _get_y_symbol(self):
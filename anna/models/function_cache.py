@@ -0,0 +1,206 @@
+"""On-disk cache of compiled model functions.
+
+Identical architectures (e.g. a sweep launched with scripts/launcher.py) all
+compile the same graphs. The cache stores every compiled function under a
+key built from the layer graph (layer types, shapes, hyperparameters), the
+source of the classes involved and the Theano flags. On a hit the stored
+function is unpickled and rebound to the model's own shared variables with
+Function.copy(swap=...), which skips graph optimization and C compilation.
+
+The cache directory is taken from model.function_cache_dir, which defaults
+to the ANNA_FUNCTION_CACHE environment variable.
+"""
+import os
+import sys
+import inspect
+import hashlib
+import tempfile
+import cPickle
+
+import numpy
+import theano
+from theano.compile.sharedvalue import SharedVariable
+from theano.gof import graph
+
+from anna.layers import layers
+
+# Theano flags that change the compiled code.
+_THEANO_FLAGS = ['floatX', 'device', 'mode', 'linker', 'optimizer',
+                 'optimizer_excluding', 'optimizer_including',
+                 'optimizer_requiring', 'cast_policy', 'int_division',
+                 'nvcc.fastmath', 'lib.cnmem']
+
+_SIMPLE_TYPES = (bool, int, long, float, str, unicode, type(None))
+
+
+def _describe_value(value, layer_index):
+    if isinstance(value, _SIMPLE_TYPES):
+        return repr(value)
+    elif isinstance(value, numpy.generic):
+        return repr(value.item())
+    elif isinstance(value, (tuple, list)):
+        return '(%s)' % ', '.join(_describe_value(v, layer_index)
+                                  for v in value)
+    elif id(value) in layer_index:
+        return 'layer-%d' % layer_index[id(value)]
+    elif inspect.isfunction(value) or inspect.isbuiltin(value):
+        return '%s.%s' % (value.__module__, value.__name__)
+    elif isinstance(value, SharedVariable):
+        return 'shared%s' % (value.get_value(
+            borrow=True, return_internal_type=True).shape,)
+    # Theano variables, ops etc. follow from the rest of the description.
+    return type(value).__name__
+
+
+def _source_digest(classes):
+    digest = hashlib.sha1()
+    files = set()
+    for cls in classes:
+        try:
+            files.add(inspect.getsourcefile(cls))
+        except TypeError:
+            # Builtin class (e.g. object)
+            pass
+    for path in sorted(f for f in files if f):
+        f = open(path, 'rb')
+        digest.update(f.read())
+        f.close()
+    return digest.hexdigest()
+
+
+def describe_model(model):
+    """Canonical text description of the model's layer graph."""
+    all_layers = layers.all_layers(model._get_output_layer())
+    layer_index = dict((id(layer), i) for i, layer in enumerate(all_layers))
+
+    lines = []
+    for i, layer in enumerate(all_layers):
+        attributes = ', '.join(
+            '%s=%s' % (key, _describe_value(value, layer_index))
+            for key, value in sorted(vars(layer).items()))
+        lines.append('%d %s.%s %s {%s}' % (
+            i, type(layer).__module__, type(layer).__name__,
+            layer.get_output_shape(), attributes))
+
+    # The model's own hyperparameters (batch, k, action_dims, ...), but not
+    # its name and path, which differ between experiments of a sweep, the
+    # dataset chunk, whose size varies, nor dropout_active, which is only
+    # set while a graph is built (the function name tells train-time and
+    # inference functions apart).
+    attributes = ', '.join(
+        '%s=%s' % (key, _describe_value(value, layer_index))
+        for key, value in sorted(vars(model).items())
+        if key not in ('name', 'path', 'function_cache_dir',
+                       'chunk_symbol', 'dropout_active') and
+        isinstance(value, _SIMPLE_TYPES + (tuple, list)))
+    lines.append('model %s {%s}' % (
+        ', '.join(cls.__name__ for cls in type(model).__mro__), attributes))
+    lines.append('optimizer %r' % getattr(model, 'optimizer', None))
+
+    classes = list(type(model).__mro__) + [type(l) for l in all_layers]
+    lines.append('source %s' % _source_digest(classes))
+    return '\n'.join(lines)
+
+
+def describe_theano_flags():
+    values = []
+    for flag in _THEANO_FLAGS:
+        try:
+            value = theano.config
+            for part in flag.split('.'):
+                value = getattr(value, part)
+        except AttributeError:
+            continue
+        values.append('%s=%s' % (flag, value))
+    values.append('version=%s' % theano.__version__)
+    return ','.join(values)
+
+
+def get_shared_variables(outputs, updates=None, givens=None):
+    """Shared variables of a graph, in an order that only depends on the
+    graph's structure (and so is the same in every process).
+    """
+    if not isinstance(outputs, (list, tuple)):
+        outputs = [outputs]
+    variables = list(outputs)
+    if updates:
+        if hasattr(updates, 'items'):
+            updates = updates.items()
+        for target, update in updates:
+            variables.extend([target, update])
+    if givens:
+        # givens must be a list of pairs, a dict would make the order vary.
+        for replaced, value in givens:
+            variables.append(value)
+
+    seen = set()
+    shared = []
+    for variable in graph.inputs(variables):
+        if isinstance(variable, SharedVariable) and variable not in seen:
+            seen.add(variable)
+            shared.append(variable)
+    return shared
+
+
+class FunctionCache(object):
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+    def get_key(self, model, function_name):
+        digest = hashlib.sha1()
+        digest.update(function_name)
+        digest.update(describe_model(model))
+        digest.update(describe_theano_flags())
+        return '%s-%s' % (function_name, digest.hexdigest())
+
+    def load(self, key, shared_variables):
+        """Returns the cached function bound to shared_variables, or None."""
+        path = os.path.join(self.directory, key + '.pkl')
+        if not os.path.exists(path):
+            return None
+
+        try:
+            f = open(path, 'rb')
+            indices, func = cPickle.load(f)
+            f.close()
+            implicit = [i.variable for i in func.maker.inputs if i.implicit]
+            if len(implicit) != len(indices):
+                return None
+            swap = dict((variable, shared_variables[index])
+                        for variable, index in zip(implicit, indices))
+            copy = func.copy(swap=swap)
+            # copy() returns every output in a list, even a single one.
+            copy.unpack_single = func.unpack_single
+            copy.return_none = func.return_none
+            return copy
+        except Exception, e:
+            # A stale or unreadable entry is not fatal, just recompile.
+            print 'Could not use cached function %s: %s' % (key, e)
+            return None
+
+    def store(self, key, func, shared_variables):
+        position = dict((id(variable), i)
+                        for i, variable in enumerate(shared_variables))
+        implicit = [i.variable for i in func.maker.inputs if i.implicit]
+        if not all(id(variable) in position for variable in implicit):
+            return
+        indices = [position[id(variable)] for variable in implicit]
+
+        # Write to a temporary file and rename, so that concurrent processes
+        # never read a partial entry.
+        recursion_limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(max(recursion_limit, 50000))
+        handle, tmp_path = tempfile.mkstemp(dir=self.directory)
+        try:
+            f = os.fdopen(handle, 'wb')
+            cPickle.dump((indices, func), f, cPickle.HIGHEST_PROTOCOL)
+            f.close()
+            os.rename(tmp_path, os.path.join(self.directory, key + '.pkl'))
+        except Exception, e:
+            print 'Could not cache function %s: %s' % (key, e)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        finally:
+            sys.setrecursionlimit(recursion_limit)
@@ -0,0 +1,113 @@
+"""Scaling curve of data-parallel CPU training (anna.util.data_parallel).
+
+Trains a dense softmax classifier on random data with 1, 2, 4, ...
+replicas. Each configuration runs in a fresh process with OMP_NUM_THREADS
+set to its share of the cores, and the throughput and speedup over one
+replica are printed.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+
+
+def run_single(args):
+    import numpy
+    from anna.layers import layers
+    from anna.models import SupervisedModel
+    from anna.util import data_parallel
+
+    class BenchmarkModel(SupervisedModel):
+        def __init__(self):
+            self.input = layers.FlatInputLayer(args.batch_size,
+                                               args.n_features)
+            self.hidden = layers.DenseLayer(self.input, args.n_hidden,
+                                            weights_std=0.01,
+                                            init_bias_value=0.)
+            self.output = layers.DenseLayer(self.hidden, args.n_classes,
+                                            weights_std=0.01,
+                                            init_bias_value=0.,
+                                            nonlinearity=layers.softmax)
+            super(BenchmarkModel, self).__init__('benchmark', '/tmp',
+                                                 learning_rate=0.01)
+
+    def make_iterator(rank, num_replicas):
+        # A few fixed batches, so that data generation is not measured.
+        rng = numpy.random.RandomState(rank)
+        batches = [(rng.randn(args.batch_size,
+                              args.n_features).astype('float32'),
+                    rng.randint(0, args.n_classes, args.batch_size))
+                   for _ in range(8)]
+        i = 0
+        while True:
+            yield batches[i % len(batches)]
+            i += 1
+
+    trainer = data_parallel.DataParallelTrainer(
+        BenchmarkModel, make_iterator, num_replicas=args.single,
+        synchronous=not args.asynchronous, average=args.average,
+        sync_every=args.sync_every)
+    stats = trainer.train(args.num_steps)
+    print json.dumps({'num_replicas': stats['num_replicas'],
+                      'samples_per_second': stats['samples_per_second']})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='data_parallel_benchmark',
+                                     description='Throughput of data-parallel '
+                                     'CPU training for a range of replicas')
+    parser.add_argument('--replicas', type=int, nargs='+', default=None,
+                        help='Numbers of replicas to run (default: 1, 2, 4, '
+                        '... up to the number of cores)')
+    parser.add_argument('--num-steps', dest='num_steps', type=int,
+                        default=200, help='Steps per replica')
+    parser.add_argument('--batch-size', dest='batch_size', type=int,
+                        default=128)
+    parser.add_argument('--n-features', dest='n_features', type=int,
+                        default=1024)
+    parser.add_argument('--n-hidden', dest='n_hidden', type=int,
+                        default=1024)
+    parser.add_argument('--n-classes', dest='n_classes', type=int,
+                        default=10)
+    parser.add_argument('--average', default='gradients',
+                        choices=['gradients', 'parameters'])
+    parser.add_argument('--sync-every', dest='sync_every', type=int,
+                        default=1)
+    parser.add_argument('--asynchronous', action='store_true',
+                        help='Hogwild-style asynchronous updates')
+    parser.add_argument('--single', type=int, default=None,
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single is not None:
+        run_single(args)
+        sys.exit(0)
+
+    num_cores = multiprocessing.cpu_count()
+    replicas = args.replicas
+    if replicas is None:
+        replicas = [1]
+        while replicas[-1] * 2 <= num_cores:
+            replicas.append(replicas[-1] * 2)
+
+    print('%8s %10s %14s %8s %10s' % ('replicas', 'threads', 'samples/s',
+                                      'speedup', 'efficiency'))
+    baseline = None
+    for num_replicas in replicas:
+        threads = max(1, num_cores // num_replicas)
+        env = dict(os.environ)
+        env['OMP_NUM_THREADS'] = str(threads)
+        env['THEANO_FLAGS'] = 'floatX=float32,device=cpu'
+        command = [sys.executable, '-u', os.path.abspath(__file__),
+                   '--single', str(num_replicas)] + sys.argv[1:]
+        output = subprocess.check_output(command, env=env)
+        result = json.loads(output.strip().splitlines()[-1])
+        throughput = result['samples_per_second']
+        if baseline is None:
+            baseline = throughput
+        speedup = throughput / baseline
+        print('%8d %10d %14.1f %8.2f %10.2f' % (
+            num_replicas, threads, throughput, speedup,
+            speedup / num_replicas))
@@ -1,21 +1,479 @@
 """Script to launch experiments.
+
+    python launcher.py gpu exp_name train_path out_path
+
+launches one experiment. In scheduler mode the launcher reads a queue of
+experiment specs, one JSON object per line:
+
+    {"exp_name": "conv_lr0.01", "train_path": "exps", "out_path": "results"}
+    {"exp_name": "conv_lr0.1", "device": "cpu", "cores": 4}
+
+and runs them concurrently, as many as the device and core slots allow:
+
+    python launcher.py --queue queue.jsonl --gpus 0 1 --cores 16
+
+A spec may set device ("gpu", a gpu id, or "cpu"; default gpu if --gpus is
+given), cores (OMP_NUM_THREADS of the job, default --cores-per-job), env
+(extra environment variables) and resume (a checkpoint to resume from).
+train_path and out_path default to the positional arguments. The state and
+exit status of every job are written to the status file (default:
+queue.jsonl.status.json) whenever they change.
+
+With --max-restarts N a run that crashes or is killed is restarted up to N
+times, after a backoff that doubles every restart, from the newest valid
+checkpoint in out_path/checkpoints: train.py is called with an extra
+"--resume <checkpoint>" argument (see anna.util.resume_from_arguments). A
+CheckpointStore kept in that directory counts as a checkpoint, its index
+file is passed and the newest step in it is restored.
+Every attempt is recorded in out_path/status.json. In single-experiment
+mode the launcher then stays in the foreground to watch the run.
 """
 import argparse
+import cPickle
+import json
+import multiprocessing
 import os
 import shutil
 import subprocess
 import sys
+import time
+
+
+def prepare_experiment(exp_name, train_path, out_path):
+    """Copies model.py and the train scripts of the experiment to its output
+    folder. Returns False if one of them does not exist.
+    """
+    # Check if output directory exists, if not create it
+    if not os.path.exists(out_path):
+        os.makedirs(out_path)
+
+    # Copy model.py and train.py to out_file_path location
+    file_names = ['model.py', 'train.py', 'train_scratch.py',
+                  'train_finetune.py']
+    for file_name in file_names:
+        if not os.path.exists(os.path.join(train_path, file_name)):
+            print('{} Does Not Exist!'.format(file_name))
+            return False
+    for file_name in file_names:
+        shutil.copy(os.path.join(train_path, file_name),
+                    os.path.join(out_path, file_name))
+    return True
+
+
+def experiment_env(device, function_cache=None, threads=None):
+    env = dict(os.environ)
+    if device == 'cpu':
+        env['THEANO_FLAGS'] = 'floatX=float32,device=cpu'
+    else:
+        env['THEANO_FLAGS'] = (
+            'floatX=float32,device=gpu{0},nvcc.fastmath=True'.format(device))
+    if threads is not None:
+        env['OMP_NUM_THREADS'] = str(threads)
+    # Every experiment launched into the same out_path shares the compiled
+    # functions of identical models (see anna.models.function_cache).
+    if function_cache is not None:
+        env['ANNA_FUNCTION_CACHE'] = os.path.abspath(function_cache)
+    return env
+
+
+def launch(exp_name, out_path, env, extra_args=(), append_log=False):
+    """Starts train.py of a prepared experiment, logging to log.txt."""
+    log_file = os.path.join(out_path, 'log.txt')
+    f_log = open(log_file, 'ab' if append_log else 'wb')
+    run_str = "python -u {0} {1} {2}".format(os.path.join(out_path,
+                                             'train.py'),
+                                             exp_name,
+                                             out_path)
+    run_list = run_str.split() + list(extra_args)
+    run_str = ' '.join(run_list)
+    print run_list
+    print('Running: {}'.format(run_str))
+    child_proc = subprocess.Popen(run_list,
+                                  stdout=f_log,
+                                  stderr=f_log,
+                                  env=env)
+    f_log.close()
+    PID = child_proc.pid
+    print('Process Launched with PID: {}'.format(PID))
+    print('Process Log written to: {}'.format(log_file))
+
+    # Make file containing the pid
+    f_pid = open(os.path.join(out_path, 'pid'), 'wb')
+    f_pid.write('PID: {}\n'.format(PID))
+    f_pid.close()
+    return child_proc
+
+
+def write_json(path, data):
+    # Written to a temporary file and renamed, so readers never see a
+    # partial file.
+    temp_path = path + '.tmp'
+    f = open(temp_path, 'wb')
+    json.dump(data, f, indent=2, sort_keys=True)
+    f.close()
+    os.rename(temp_path, path)
+
+
+def _is_valid_checkpoint(path):
+    # Complete pickles of parameters (save_checkpoint) or of a training
+    # state (save_training_state); a run killed while saving leaves a
+    # truncated file behind.
+    try:
+        f = open(path, 'rb')
+        try:
+            checkpoint = cPickle.load(f)
+        finally:
+            f.close()
+    except Exception:
+        return False
+    return (isinstance(checkpoint, list) or
+            (isinstance(checkpoint, dict) and 'parameters' in checkpoint))
+
+
+def _is_valid_store(index_path):
+    # A CheckpointStore index (see anna.util.checkpoint_store) whose newest
+    # step can be rebuilt: its file and the full snapshot of a delta load.
+    try:
+        f = open(index_path, 'r')
+        try:
+            index = json.load(f)
+        finally:
+            f.close()
+        entries = index['entries'] if isinstance(index, dict) else index
+        if not entries:
+            return False
+        needed = [entries[-1]]
+        if entries[-1]['base'] is not None:
+            needed += [entry for entry in entries
+                       if entry['step'] == entries[-1]['base']]
+            if len(needed) != 2:
+                return False
+        for entry in needed:
+            f = open(os.path.join(os.path.dirname(index_path),
+                                  entry['file']), 'rb')
+            try:
+                cPickle.load(f)
+            finally:
+                f.close()
+    except Exception:
+        return False
+    return True
+
+
+def find_latest_checkpoint(checkpoint_path):
+    """Newest valid checkpoint in checkpoint_path, or None. The index file
+    stands for a CheckpointStore and its newest step.
+    """
+    if not os.path.isdir(checkpoint_path):
+        return None
+    # CheckpointStore snapshots and deltas are restored through the store.
+    paths = [os.path.join(checkpoint_path, name)
+             for name in os.listdir(checkpoint_path)
+             if (name.endswith('.pkl') and not
+                 name.endswith(('-full.pkl', '-delta.pkl'))) or
+             name.endswith('-index.json')]
+    for path in sorted(paths, key=os.path.getmtime, reverse=True):
+        if path.endswith('-index.json'):
+            if _is_valid_store(path):
+                return path
+        elif _is_valid_checkpoint(path):
+            return path
+    return None
+
+
+class SupervisedRun(object):
+    """Runs train.py of a prepared experiment and restarts it from its
+    newest checkpoint when it fails, recording every attempt in
+    out_path/status.json.
+    """
+    def __init__(self, exp_name, out_path, env, max_restarts=0, backoff=30.,
+                 max_backoff=600., checkpoint_directory='checkpoints',
+                 resume=None):
+        """
+        resume: checkpoint the first attempt resumes from, e.g. to continue
+        a run that stopped at its step budget.
+        """
+        self.exp_name = exp_name
+        self.resume = resume
+        self.out_path = out_path
+        self.env = env
+        self.max_restarts = max_restarts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.checkpoint_path = os.path.join(out_path, checkpoint_directory)
+        self.status_path = os.path.join(out_path, 'status.json')
+        self.attempts = []
+        self.process = None
+        self.restart_time = None
+        self.state = 'starting'
+
+    @property
+    def restarts(self):
+        return max(0, len(self.attempts) - 1)
+
+    @property
+    def pid(self):
+        return self.process.pid if self.process is not None else None
+
+    def start(self):
+        resume = None
+        if self.attempts:
+            resume = find_latest_checkpoint(self.checkpoint_path)
+        if resume is None:
+            resume = self.resume
+        if self.attempts and resume is None:
+            print('Warning: no valid checkpoint in {}, {} restarts from '
+                  'scratch'.format(self.checkpoint_path, self.exp_name))
+        extra_args = []
+        if resume is not None:
+            extra_args = ['--resume', resume]
+        self.process = launch(self.exp_name, self.out_path, self.env,
+                              extra_args, append_log=(resume is not None or
+                                                      bool(self.attempts)))
+        self.attempts.append({'pid': self.process.pid,
+                              'start_time': time.time(),
+                              'resume_checkpoint': resume})
+        self.state = 'running'
+        self._write_status()
+
+    def poll(self):
+        """None while the run is going or waiting to restart, its final exit
+        status once it succeeded or ran out of restarts.
+        """
+        if self.state == 'waiting':
+            if time.time() >= self.restart_time:
+                self.start()
+            return None
+        if self.state != 'running':
+            return self.attempts[-1]['returncode']
+
+        returncode = self.process.poll()
+        if returncode is None:
+            return None
+        self.attempts[-1]['returncode'] = returncode
+        self.attempts[-1]['end_time'] = time.time()
+        if returncode == 0:
+            self.state = 'done'
+        elif self.restarts < self.max_restarts:
+            delay = min(self.backoff * 2 ** self.restarts, self.max_backoff)
+            print('{} failed with exit status {}, restarting in {:.0f}s'
+                  .format(self.exp_name, returncode, delay))
+            self.restart_time = time.time() + delay
+            self.state = 'waiting'
+        else:
+            self.state = 'failed'
+        self._write_status()
+        if self.state == 'waiting':
+            return None
+        return returncode
+
+    def wait(self, poll_interval=1.0):
+        returncode = self.poll()
+        while returncode is None:
+            time.sleep(poll_interval)
+            returncode = self.poll()
+        return returncode
+
+    def _write_status(self):
+        write_json(self.status_path, {
+            'exp_name': self.exp_name,
+            'state': self.state,
+            'restarts': self.restarts,
+            'max_restarts': self.max_restarts,
+            'restart_time': self.restart_time,
+            'attempts': self.attempts,
+            'time': time.time()})
+
+
+def read_queue(queue_path):
+    jobs = []
+    f = open(queue_path, 'r')
+    for line in f:
+        line = line.strip()
+        if line and not line.startswith('#'):
+            jobs.append(json.loads(line))
+    f.close()
+    return jobs
+
+
+class Scheduler(object):
+    def __init__(self, specs, status_path, gpus=(), jobs_per_gpu=1,
+                 cores=None, cores_per_job=1, train_path=None, out_path=None,
+                 function_cache=None, poll_interval=1.0, max_restarts=0,
+                 backoff=30.):
+        if cores is None:
+            cores = multiprocessing.cpu_count()
+        self.status_path = status_path
+        self.gpus = [str(gpu) for gpu in gpus]
+        self.jobs_per_gpu = jobs_per_gpu
+        self.cores = cores
+        self.function_cache = function_cache
+        self.poll_interval = poll_interval
+        self.max_restarts = max_restarts
+        self.backoff = backoff
+        # Slots stay taken while a failed job waits for its restart.
+        self.runs = {}
+
+        self.jobs = []
+        for spec in specs:
+            job = {'exp_name': spec['exp_name'],
+                   'train_path': spec.get('train_path', train_path),
+                   'out_path': spec.get('out_path', out_path),
+                   'device': str(spec.get('device',
+                                          'gpu' if self.gpus else 'cpu')),
+                   'cores': spec.get('cores', cores_per_job),
+                   'env': spec.get('env', {}),
+                   'resume': spec.get('resume'),
+                   'state': 'queued'}
+            if job['train_path'] is None or job['out_path'] is None:
+                raise ValueError('No train_path or out_path for '
+                                 '{}'.format(job['exp_name']))
+            self.jobs.append(job)
+
+    def run(self):
+        """Runs every job, returns once the queue is empty and the last job
+        has finished.
+        """
+        self._write_status()
+        while True:
+            changed = self._reap()
+            changed = self._start_ready() or changed
+            if changed:
+                self._write_status()
+            if not self.runs and not any(
+                    job['state'] == 'queued' for job in self.jobs):
+                return self.jobs
+            time.sleep(self.poll_interval)
+
+    def _running(self):
+        return [job for job in self.jobs if job['state'] == 'running']
+
+    def _free_cores(self):
+        return self.cores - sum(job['cores'] for job in self._running())
+
+    def _free_gpu(self, device):
+        # A gpu of the job's device with a free slot, or None.
+        candidates = self.gpus if device == 'gpu' else [device]
+        for gpu in candidates:
+            used = sum(1 for job in self._running()
+                       if job['assigned_device'] == gpu)
+            if gpu in self.gpus and used < self.jobs_per_gpu:
+                return gpu
+        return None
+
+    def _start_ready(self):
+        # Starts every queued job that fits in the free slots, in order.
+        started = False
+        for job in self.jobs:
+            if job['state'] != 'queued':
+                continue
+            if job['cores'] > self.cores or (
+                    job['device'] not in ('cpu', 'gpu') and
+                    job['device'] not in self.gpus):
+                job['state'] = 'failed'
+                job['error'] = 'does not fit in the available slots'
+                started = True
+                continue
+            if job['cores'] > self._free_cores():
+                continue
+            if job['device'] == 'cpu':
+                device = 'cpu'
+            else:
+                device = self._free_gpu(job['device'])
+                if device is None:
+                    continue
+            self._start(job, device)
+            started = True
+        return started
+
+    def _start(self, job, device):
+        job['assigned_device'] = device
+        job['start_time'] = time.time()
+        exp_out_path = os.path.join(job['out_path'], job['exp_name'])
+        if not prepare_experiment(
+                job['exp_name'],
+                os.path.join(job['train_path'], job['exp_name']),
+                exp_out_path):
+            job['state'] = 'failed'
+            job['error'] = 'missing experiment files'
+            return
+        env = experiment_env(device, self.function_cache, job['cores'])
+        env.update(job['env'])
+        run = SupervisedRun(job['exp_name'], exp_out_path, env,
+                            max_restarts=self.max_restarts,
+                            backoff=self.backoff, resume=job['resume'])
+        run.start()
+        job['state'] = 'running'
+        job['pid'] = run.pid
+        job['restarts'] = 0
+        self.runs[id(job)] = run
+
+    def _reap(self):
+        finished = False
+        for job in self._running():
+            run = self.runs[id(job)]
+            returncode = run.poll()
+            if (job['pid'], job['restarts']) != (run.pid, run.restarts):
+                job['pid'] = run.pid
+                job['restarts'] = run.restarts
+                finished = True
+            if returncode is None:
+                continue
+            del self.runs[id(job)]
+            job['returncode'] = returncode
+            job['end_time'] = time.time()
+            job['state'] = 'done' if returncode == 0 else 'failed'
+            print('{} finished with exit status {}'.format(job['exp_name'],
+                                                           returncode))
+            finished = True
+        return finished
+
+    def _write_status(self):
+        write_json(self.status_path, {'jobs': self.jobs, 'time': time.time()})
 
 
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(prog='launcher', description='Script to '
                                      'launch experiments')
-    parser.add_argument('gpu', help='Integer for gpu')
-    parser.add_argument('exp_name', help='Name of experiment')
-    parser.add_argument('train_path',
+    parser.add_argument('gpu', nargs='?', help='Integer for gpu')
+    parser.add_argument('exp_name', nargs='?', help='Name of experiment')
+    parser.add_argument('train_path', nargs='?',
                         help='Path to model.py and train.py files')
-    parser.add_argument('out_path', help='Path to to folder to save results')
+    parser.add_argument('out_path', nargs='?',
+                        help='Path to to folder to save results')
+    parser.add_argument('--function-cache', dest='function_cache',
+                        default=None,
+                        help='Directory to cache compiled model functions in, '
+                        'shared by all experiments (default: '
+                        'out_path/function_cache)')
+    parser.add_argument('--no-function-cache', dest='no_function_cache',
+                        action='store_true',
+                        help='Do not cache compiled model functions')
+    parser.add_argument('--queue', default=None,
+                        help='Run the experiment specs of this file (one '
+                        'JSON object per line) concurrently')
+    parser.add_argument('--gpus', nargs='*', default=[],
+                        help='GPU ids the queued experiments may use')
+    parser.add_argument('--jobs-per-gpu', dest='jobs_per_gpu', type=int,
+                        default=1, help='Concurrent experiments per GPU')
+    parser.add_argument('--cores', type=int, default=None,
+                        help='CPU cores shared by the queued experiments '
+                        '(default: all)')
+    parser.add_argument('--cores-per-job', dest='cores_per_job', type=int,
+                        default=1,
+                        help='Default OMP_NUM_THREADS of a queued experiment')
+    parser.add_argument('--status-file', dest='status_file', default=None,
+                        help='Status of the queued experiments (default: '
+                        'the queue file + .status.json)')
+    parser.add_argument('--max-restarts', dest='max_restarts', type=int,
+                        default=0,
+                        help='Restart a failed run up to this many times '
+                        'from its newest checkpoint (default: 0, in single '
+                        'mode the launcher exits after the launch)')
+    parser.add_argument('--backoff', type=float, default=30.,
+                        help='Seconds before the first restart, doubled for '
+                        'every further restart')
     # parser.add_argument('-v', action='store_true', help='Verbose')
     args = parser.parse_args()
 
@@ -23,77 +481,78 @@ if __name__ == "__main__":
     print('              Anna Experiment Launcher                ')
     print('========================================================\n')
 
+    if args.queue is not None:
+        status_file = args.status_file
+        if status_file is None:
+            status_file = args.queue + '.status.json'
+        function_cache = args.function_cache
+        if function_cache is None and args.out_path is not None:
+            function_cache = os.path.join(args.out_path, 'function_cache')
+        if args.no_function_cache:
+            function_cache = None
+
+        scheduler = Scheduler(read_queue(args.queue), status_file,
+                              gpus=args.gpus,
+                              jobs_per_gpu=args.jobs_per_gpu,
+                              cores=args.cores,
+                              cores_per_job=args.cores_per_job,
+                              train_path=args.train_path,
+                              out_path=args.out_path,
+                              function_cache=function_cache,
+                              max_restarts=args.max_restarts,
+                              backoff=args.backoff)
+        print('Queue: {} experiments, status in {}'.format(
+            len(scheduler.jobs), status_file))
+        jobs = scheduler.run()
+        failed = [job['exp_name'] for job in jobs if job['state'] != 'done']
+        print('{} done, {} failed {}'.format(len(jobs) - len(failed),
+                                             len(failed), failed))
+        print('======================= Done ===========================')
+        sys.exit(1 if failed else 0)
+
+    if args.out_path is None:
+        parser.error('gpu, exp_name, train_path and out_path are required '
+                     'without --queue')
+
     exp_name = args.exp_name
     train_path = args.train_path
     out_path = args.out_path
     gpu = args.gpu
+    function_cache = args.function_cache
+    if function_cache is None:
+        function_cache = os.path.join(out_path, 'function_cache')
+    if args.no_function_cache:
+        function_cache = None
     train_path = os.path.join(train_path, exp_name)
     out_path = os.path.join(out_path, exp_name)
 
-    my_env = os.environ
-    my_env['THEANO_FLAGS'] =
-    'floatX=float32,device=gpu{0},nvcc.fastmath=True'.format(gpu)
+    my_env = experiment_env(gpu, function_cache)
 
     print('===================== Inputs ===========================')
     print('Experiment Name: {}'.format(exp_name))
     print('Path to train.py and model.py: {}'.format(train_path))
     print('Out Folder Path: {}'.format(out_path))
+    if function_cache is not None:
+        print('Function Cache: {}'.format(my_env['ANNA_FUNCTION_CACHE']))
     print('========================================================\n')
 
     # Modify output directory to include experiment name in path
-    # Check if output directory exists, if not create it
-    if not os.path.exists(out_path):
-        os.makedirs(out_path)
-
-    # Copy model.py and train.py to out_file_path location
-    model_file_path = os.path.join(train_path, 'model.py')
-    train_file_path = os.path.join(train_path, 'train.py')
-    scratch_file_path = os.path.join(train_path, 'train_scratch.py')
-    finetune_file_path = os.path.join(train_path, 'train_finetune.py')
-
-    if not os.path.exists(model_file_path):
-        print('Model File Does Not Exist!')
-        sys.exit(0)
-    elif not os.path.exists(train_file_path):
-        print('Train File Does Not Exist!')
-        sys.exit(0)
-    elif not os.path.exists(scratch_file_path):
-        print('Scratch File Does Not Exist!')
+    if not prepare_experiment(exp_name, train_path, out_path):
         sys.exit(0)
-    elif not os.path.exists(finetune_file_path):
-        print('Finetuning File Does Not Exist!')
-        sys.exit(0)
-
-    shutil.copy(model_file_path, os.path.join(out_path, 'model.py'))
-    shutil.copy(train_file_path, os.path.join(out_path, 'train.py'))
-    shutil.copy(scratch_file_path, os.path.join(out_path, 'train_scratch.py'))
-    shutil.copy(finetune_file_path, os.path.join(out_path,
-                                                 'train_finetune.py'))
 
     print('=================== Launch Process =======================')
 
     # Launch Process
-    log_file = os.path.join(out_path, 'log.txt')
-    f_log = open(log_file, 'wb')
-    run_str = "python -u {0} {1} {2}".format(os.path.join(out_path,
-                                             'train.py'),
-                                             exp_name,
-                                             out_path)
-    run_list = run_str.split()
-    print run_list
-    print('Running: {}'.format(run_str))
-    child_proc = subprocess.Popen(run_list,
-                                  stdout=f_log,
-                                  stderr=f_log,
-                                  env=my_env)
-    f_log.close()
-    PID = child_proc.pid
-    print('Process Launched with PID: {}'.format(PID))
-    print('Process Log written to: {}'.format(log_file))
-
-    # Make file containing the pid
-    f_pid = open(os.path.join(out_path, 'pid'), 'wb')
-    f_pid.write('PID: {}\n'.format(PID))
-    f_pid.close()
+    if args.max_restarts > 0:
+        run = SupervisedRun(exp_name, out_path, my_env,
+                            max_restarts=args.max_restarts,
+                            backoff=args.backoff)
+        run.start()
+        returncode = run.wait()
+        print('Finished with exit status {} after {} restarts'.format(
+            returncode, run.restarts))
+        print('Status written to: {}'.format(run.status_path))
+    else:
+        launch(exp_name, out_path, my_env)
 
     print('======================= Done ===========================')
@@ -0,0 +1,211 @@
+"""Hyperparameter sweep with successive halving.
+
+Every configuration of the queue (the experiment specs of launcher.py, one
+JSON object per line) is trained to a first step budget. The configurations
+are ranked by the last error their Monitor printed (the "&" test error
+lines, the "*" train error lines if there are none), the best 1/eta of them
+continue from their saved training state to eta times the budget, and so
+on until max_steps. The others stop at their budget, their training state
+stays in out_path/exp_name/checkpoints.
+
+    python sweep.py queue.jsonl --min-steps 2000 --max-steps 50000 --eta 3 \
+        --gpus 0 1
+
+train.py must build its Monitor after the model and call
+util.resume_from_arguments(model, monitor, ...), which sets the step budget
+the sweep passes in ANNA_MAX_STEPS and resumes a continued run where it
+stopped. monitor.done is set at the budget step, which is tested, and
+stop_test saves the training state with its test error, so the loop must
+test whenever monitor.test is set:
+
+    while not monitor.done:
+        monitor.start()
+        x_batch, y_batch = train_iterator.next()
+        cost, accuracy = model.train(x_batch, y_batch)
+        monitor.stop(1 - accuracy)
+        if monitor.test:
+            monitor.start()
+            x_batch, y_batch = test_iterator.next()
+            monitor.stop_test(1 - model.eval(x_batch, y_batch))
+
+The rungs, scores and survivors are written to the sweep status file
+(default: queue.jsonl.sweep.json).
+
+Running several sweeps with different --min-steps over the same
+configurations gives the brackets of Hyperband.
+"""
+import argparse
+import os
+import sys
+import time
+
+from launcher import Scheduler, find_latest_checkpoint, read_queue, \
+    write_json
+
+
+def read_score(log_path):
+    """Last test error in a training log, or the last train error if no test
+    error was printed. None if there is neither.
+    """
+    if not os.path.exists(log_path):
+        return None
+    test_error = None
+    train_error = None
+    f = open(log_path, 'r')
+    for line in f:
+        if line.startswith('&') or line.startswith('*'):
+            try:
+                error = float(line.split(',')[1].split(':')[1])
+            except (IndexError, ValueError):
+                continue
+            if line.startswith('&'):
+                test_error = error
+            else:
+                train_error = error
+    f.close()
+    return test_error if test_error is not None else train_error
+
+
+def get_budgets(min_steps, max_steps, eta):
+    budgets = [min_steps]
+    while budgets[-1] < max_steps:
+        budgets.append(min(budgets[-1] * eta, max_steps))
+    return budgets
+
+
+class SuccessiveHalving(object):
+    def __init__(self, specs, min_steps, max_steps, eta=3, status_path=None,
+                 train_path=None, out_path=None, **scheduler_kwargs):
+        self.specs = specs
+        self.budgets = get_budgets(min_steps, max_steps, eta)
+        self.eta = eta
+        self.status_path = status_path
+        self.train_path = train_path
+        self.out_path = out_path
+        self.scheduler_kwargs = scheduler_kwargs
+        self.rungs = []
+
+    def _exp_out_path(self, spec):
+        return os.path.join(spec.get('out_path', self.out_path),
+                            spec['exp_name'])
+
+    def run(self):
+        """Runs every rung, returns (score, exp_name) of the configurations
+        of the last rung, best first.
+        """
+        alive = list(self.specs)
+        for rung, budget in enumerate(self.budgets):
+            print('Rung {}: {} configurations to {} steps'.format(
+                rung, len(alive), budget))
+            rung_specs = []
+            for spec in alive:
+                rung_spec = dict(spec)
+                rung_spec['env'] = dict(spec.get('env', {}),
+                                        ANNA_MAX_STEPS=str(budget))
+                if rung > 0:
+                    # Continue from the state saved at the last budget.
+                    rung_spec['resume'] = find_latest_checkpoint(
+                        os.path.join(self._exp_out_path(spec),
+                                     'checkpoints'))
+                rung_specs.append(rung_spec)
+
+            scheduler = Scheduler(
+                rung_specs, '{}.rung{}.json'.format(self.status_path, rung),
+                train_path=self.train_path, out_path=self.out_path,
+                **self.scheduler_kwargs)
+            jobs = scheduler.run()
+
+            scores = []
+            for spec, job in zip(alive, jobs):
+                score = None
+                if job['state'] == 'done':
+                    score = read_score(os.path.join(
+                        self._exp_out_path(spec), 'log.txt'))
+                scores.append((score, spec))
+            # Failed runs and runs without a score rank last.
+            ranked = sorted(scores, key=lambda item: (item[0] is None,
+                                                      item[0]))
+            num_survivors = max(1, len(ranked) // self.eta)
+            if rung == len(self.budgets) - 1:
+                num_survivors = len(ranked)
+            alive = [spec for score, spec in ranked[:num_survivors]
+                     if score is not None]
+
+            self.rungs.append({
+                'budget': budget,
+                'scores': [{'exp_name': spec['exp_name'], 'score': score}
+                           for score, spec in ranked],
+                'survivors': [spec['exp_name'] for spec in alive],
+                'time': time.time()})
+            self._write_status()
+            if not alive:
+                break
+        return [(score, spec['exp_name']) for score, spec in ranked
+                if score is not None]
+
+    def _write_status(self):
+        if self.status_path is not None:
+            write_json(self.status_path, {'budgets': self.budgets,
+                                          'eta': self.eta,
+                                          'rungs': self.rungs})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='sweep', description='Successive '
+                                     'halving sweep over the experiments of '
+                                     'a launcher queue')
+    parser.add_argument('queue', help='Experiment specs, one JSON object per '
+                        'line (see launcher.py)')
+    parser.add_argument('train_path', nargs='?',
+                        help='Default path to the experiment folders')
+    parser.add_argument('out_path', nargs='?',
+                        help='Default path to the result folders')
+    parser.add_argument('--min-steps', dest='min_steps', type=int,
+                        required=True, help='Step budget of the first rung')
+    parser.add_argument('--max-steps', dest='max_steps', type=int,
+                        required=True, help='Step budget of the last rung')
+    parser.add_argument('--eta', type=int, default=3,
+                        help='1/eta of the configurations continue with eta '
+                        'times the steps')
+    parser.add_argument('--gpus', nargs='*', default=[],
+                        help='GPU ids the experiments may use')
+    parser.add_argument('--jobs-per-gpu', dest='jobs_per_gpu', type=int,
+                        default=1, help='Concurrent experiments per GPU')
+    parser.add_argument('--cores', type=int, default=None,
+                        help='CPU cores shared by the experiments (default: '
+                        'all)')
+    parser.add_argument('--cores-per-job', dest='cores_per_job', type=int,
+                        default=1,
+                        help='Default OMP_NUM_THREADS of an experiment')
+    parser.add_argument('--max-restarts', dest='max_restarts', type=int,
+                        default=0,
+                        help='Restart a failed run up to this many times')
+    parser.add_argument('--status-file', dest='status_file', default=None,
+                        help='Sweep status (default: the queue file + '
+                        '.sweep.json)')
+    args = parser.parse_args()
+
+    status_file = args.status_file
+    if status_file is None:
+        status_file = args.queue + '.sweep.json'
+    function_cache = None
+    if args.out_path is not None:
+        function_cache = os.path.join(args.out_path, 'function_cache')
+
+    sweep = SuccessiveHalving(read_queue(args.queue), args.min_steps,
+                              args.max_steps, eta=args.eta,
+                              status_path=status_file,
+                              train_path=args.train_path,
+                              out_path=args.out_path,
+                              gpus=args.gpus,
+                              jobs_per_gpu=args.jobs_per_gpu,
+                              cores=args.cores,
+                              cores_per_job=args.cores_per_job,
+                              function_cache=function_cache,
+                              max_restarts=args.max_restarts)
+    ranking = sweep.run()
+    print('===================== Ranking ==========================')
+    for score, exp_name in ranking:
+        print('{}: {:.5f}'.format(exp_name, score))
+    print('Sweep status written to: {}'.format(status_file))
+    sys.exit(0 if ranking else 1)
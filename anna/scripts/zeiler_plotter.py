@@ -11,6 +11,7 @@ import theano
 import theano.tensor as T
 
 from anna import util
+from anna.models import inference_model
 from anna.datasets import unsupervised_dataset
 # from model import Model
 # from model_2layer import Model
@@ -358,7 +359,7 @@ if __name__ == "__main__":
         os.makedirs(output_path)
 
     print('Loading Model')
-    model = UnsupervisedModel('xxx', './')
+    model = inference_model(UnsupervisedModel, 'xxx', './')
     print('Loading Checkpoint')
     util.load_checkpoint(model, checkpoint)
 
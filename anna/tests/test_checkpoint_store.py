@@ -0,0 +1,119 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from anna.util import checkpoint_store
+from anna.util.checkpoint_store import CheckpointStore
+
+
+def _arrays(step):
+    rng = numpy.random.RandomState(step)
+    return [rng.randn(3, 4).astype(numpy.float32),
+            rng.randn(5).astype(numpy.float32)]
+
+
+class TestCheckpointStore(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.time = checkpoint_store.time
+        self.now = 0.0
+        checkpoint_store.time = lambda: self.now
+
+    def tearDown(self):
+        checkpoint_store.time = self.time
+        shutil.rmtree(self.directory)
+
+    def _files(self):
+        return sorted(name for name in os.listdir(self.directory)
+                      if name.endswith('.pkl'))
+
+    def test_keep_last_and_bases(self):
+        store = CheckpointStore(self.directory, full_every=3, keep_last=2,
+                                keep_every_hours=None, keep_best=False)
+        for step in range(0, 70, 10):
+            store.save(step, _arrays(step))
+        # Saves 0, 3 and 6 are full. Step 50 is a delta against step 30.
+        self.assertEqual(store.steps(), [30, 50, 60])
+        self.assertEqual(self._files(), ['checkpoint-00000030-full.pkl',
+                                         'checkpoint-00000050-delta.pkl',
+                                         'checkpoint-00000060-full.pkl'])
+        for step in store.steps():
+            for array, expected in zip(store.load(step), _arrays(step)):
+                numpy.testing.assert_array_equal(array, expected)
+
+    def test_keep_last_zero(self):
+        store = CheckpointStore(self.directory, full_every=2, keep_last=0,
+                                keep_every_hours=None, keep_best=True)
+        errors = [0.5, 0.2, 0.4, 0.3, 0.6]
+        for i, error in enumerate(errors):
+            store.save(i, _arrays(i), test_error=error)
+        # Only the best checkpoint, its full snapshot and the newest full
+        # snapshot are left, and deltas did not stop full snapshots from
+        # coming every full_every saves.
+        self.assertEqual(store.steps(), [0, 1, 4])
+        self.assertEqual(store.best_step(), 1)
+        self.assertEqual(self._files(), ['checkpoint-00000000-full.pkl',
+                                         'checkpoint-00000001-delta.pkl',
+                                         'checkpoint-00000004-full.pkl'])
+
+    def test_keep_every_hours(self):
+        store = CheckpointStore(self.directory, full_every=1, keep_last=1,
+                                keep_every_hours=6.0, keep_best=False)
+        for step, hours in enumerate([0, 1, 7, 8, 13, 14]):
+            self.now = hours * 3600.0
+            store.save(step, _arrays(step))
+        self.assertEqual(store.steps(), [0, 2, 4, 5])
+
+    def test_reopen(self):
+        store = CheckpointStore(self.directory, full_every=3, keep_last=1,
+                                keep_every_hours=None, keep_best=False)
+        for step in range(4):
+            store.save(step, _arrays(step))
+        store = CheckpointStore(self.directory, full_every=3, keep_last=1,
+                                keep_every_hours=None, keep_best=False)
+        self.assertEqual(store.num_saves, 4)
+        store.save(4, _arrays(4))
+        store.save(5, _arrays(5))
+        # The sixth save (step 5) is a delta against step 3.
+        self.assertEqual(store.steps(), [3, 5])
+        for array, expected in zip(store.load(5), _arrays(5)):
+            numpy.testing.assert_array_equal(array, expected)
+
+    def test_deltas_of_slowly_changing_parameters_are_small(self):
+        store = CheckpointStore(self.directory, full_every=10, keep_last=10,
+                                keep_every_hours=None, keep_best=False)
+        rng = numpy.random.RandomState(0)
+        W = (0.05 * rng.randn(10000)).astype(numpy.float32)
+        series = []
+        for step in range(10):
+            series.append(W)
+            store.save(step, [W])
+            # Every value moves by about 1e-3 of the typical magnitude.
+            W = W - (5e-5 * rng.randn(W.size)).astype(numpy.float32)
+
+        sizes = [os.path.getsize(os.path.join(self.directory, name))
+                 for name in self._files()]
+        self.assertEqual(self._files()[0], 'checkpoint-00000000-full.pkl')
+        # The full snapshot barely compresses; the deltas stay small up to
+        # the last one before the next full snapshot.
+        self.assertGreater(sizes[0], 0.85 * W.nbytes)
+        self.assertLess(max(sizes[1:]), 0.8 * sizes[0])
+        for step, expected in enumerate(series):
+            numpy.testing.assert_array_equal(store.load(step)[0], expected)
+
+    def test_pack_round_trip(self):
+        arrays = [numpy.arange(6, dtype=numpy.float64).reshape(2, 3),
+                  numpy.zeros((0, 4), dtype=numpy.float32),
+                  numpy.array(7, dtype=numpy.int16)]
+        for array, expected in zip(
+                checkpoint_store._unpack(checkpoint_store._pack(arrays)),
+                arrays):
+            self.assertEqual(array.dtype, expected.dtype)
+            numpy.testing.assert_array_equal(array, expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
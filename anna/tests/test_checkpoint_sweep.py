@@ -0,0 +1,121 @@
+import os
+import shutil
+import tempfile
+import unittest
+import cPickle
+
+import numpy
+
+from anna import util
+from anna.layers import layers
+from anna.models import SupervisedModel
+from anna.util import evaluation
+from anna.util.checkpoint_sweep import CheckpointSweep, _RestoreParameters
+
+
+class TinyModel(SupervisedModel):
+    def __init__(self):
+        numpy.random.seed(0)
+        self.input = layers.FlatInputLayer(4, 5)
+        self.output = layers.DenseLayer(self.input, 3, 1., 0.,
+                                        nonlinearity=layers.softmax)
+        self.batch = 4
+        super(TinyModel, self).__init__('tiny', '/tmp')
+
+
+class DataContainer(object):
+    def __init__(self, X, y):
+        self.X = X
+        self.y = y
+
+
+class TestCheckpointSweep(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        rng = numpy.random.RandomState(0)
+        self.X = rng.randn(10, 5).astype(numpy.float32)
+        self.y = rng.randint(0, 3, 10)
+        self.model = TinyModel()
+        self.values = self._values()
+
+        self.checkpoints = []
+        for i in range(3):
+            path = os.path.join(self.directory, 'tiny-%d.pkl' % i)
+            f = open(path, 'wb')
+            cPickle.dump([value + rng.randn(*value.shape).astype(value.dtype)
+                          for value in self.values], f)
+            f.close()
+            self.checkpoints.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _values(self):
+        return [param.get_value()
+                for param in self.model.all_save_parameters_symbol]
+
+    def _check_restored(self):
+        for value, expected in zip(self._values(), self.values):
+            numpy.testing.assert_array_equal(value, expected)
+
+    def _check_results(self, results, expected):
+        self.assertEqual(sorted(results), sorted(expected))
+        for name in expected:
+            numpy.testing.assert_allclose(results[name], expected[name],
+                                          rtol=1e-5)
+
+    def test_run_matches_an_evaluator_per_checkpoint(self):
+        sweep = CheckpointSweep(self.model, self.X, self.y)
+        results = sweep.run(self.checkpoints)
+        self.assertEqual([path for path, _ in results], self.checkpoints)
+        self._check_restored()
+
+        data_container = DataContainer(self.X, self.y)
+        for path, result in results:
+            evaluator = util.Evaluator(self.model, data_container, path, [])
+            self.assertAlmostEqual(100.0 * result['accuracy'],
+                                   evaluator.run())
+            # Every default metric, evaluated from scratch.
+            streaming = evaluation.StreamingEvaluator(self.model)
+            streaming.update(self.X, self.y)
+            self._check_results(result, streaming.results())
+
+        # The same in forked workers.
+        for (path, result), (_, expected) in zip(
+                sweep.run(self.checkpoints, num_workers=2), results):
+            self._check_results(result, expected)
+
+    def test_restore_parameters(self):
+        try:
+            with _RestoreParameters(self.model):
+                util.load_checkpoint(self.model, self.checkpoints[0])
+                self.assertFalse(numpy.allclose(self._values()[0],
+                                                self.values[0]))
+                raise KeyboardInterrupt()
+        except KeyboardInterrupt:
+            pass
+        self._check_restored()
+
+    def test_ensemble_of_one_checkpoint(self):
+        sweep = CheckpointSweep(self.model, self.X, self.y)
+        ensemble = sweep.ensemble(self.checkpoints[1:2])
+        self._check_restored()
+        self._check_results(ensemble, sweep.evaluate(self.checkpoints[1]))
+
+    def test_ensemble_averages_the_predictions(self):
+        sweep = CheckpointSweep(self.model, self.X, self.y)
+        outputs = []
+        for path in self.checkpoints:
+            util.load_checkpoint(self.model, path)
+            outputs.append(self.model.prediction(self.X))
+        expected = {}
+        for metric in evaluation.default_metrics(self.model):
+            metric.update(numpy.mean(outputs, axis=0), self.y)
+            expected.update(metric.result())
+        self._check_results(sweep.ensemble(self.checkpoints), expected)
+        self._check_results(sweep.ensemble(self.checkpoints, num_workers=2),
+                            expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
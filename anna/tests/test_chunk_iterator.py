@@ -0,0 +1,44 @@
+import unittest
+
+import numpy
+
+from anna.datasets.chunk_iterator import ChunkIterator
+
+
+def _batches(num_batches):
+    for i in range(num_batches):
+        yield (numpy.full((2, 3), i, dtype=numpy.float32),
+               numpy.array([i, i]))
+
+
+class TestChunkIterator(unittest.TestCase):
+    def test_chunks(self):
+        chunks = list(ChunkIterator(_batches(5), 2))
+        self.assertEqual(len(chunks), 3)
+        x, y = chunks[0]
+        numpy.testing.assert_array_equal(x[:, 0], [0, 0, 1, 1])
+        numpy.testing.assert_array_equal(y, [0, 0, 1, 1])
+        # The last chunk holds what is left.
+        x, y = chunks[2]
+        numpy.testing.assert_array_equal(y, [4, 4])
+
+    def test_batch_axes_and_transform(self):
+        iterator = ChunkIterator(_batches(2), 2, batch_axes=(1, 0),
+                                 transform=lambda x, y: (x.T, y + 10))
+        x, y = iterator.next()
+        self.assertEqual(x.shape, (3, 4))
+        numpy.testing.assert_array_equal(y, [10, 10, 11, 11])
+
+    def test_reraises_producer_errors(self):
+        def batches():
+            for batch in _batches(3):
+                yield batch
+            raise IOError('disk gone')
+
+        iterator = ChunkIterator(batches(), 2)
+        iterator.next()
+        self.assertRaises(IOError, iterator.next)
+
+
+if __name__ == '__main__':
+    unittest.main()
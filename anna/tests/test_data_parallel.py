@@ -0,0 +1,98 @@
+import tempfile
+import unittest
+
+import numpy
+import theano
+
+from anna.layers import layers
+from anna.models import SupervisedModel
+from anna.util import data_parallel
+from anna.util.data_parallel import DataParallelTrainer
+
+
+class TinyModel(SupervisedModel):
+    def __init__(self):
+        self.input = layers.FlatInputLayer(4, 5)
+        self.output = layers.DenseLayer(self.input, 3, 0.1, 0.,
+                                        nonlinearity=layers.softmax)
+        super(TinyModel, self).__init__('tiny', tempfile.gettempdir(),
+                                        learning_rate=0.1)
+
+
+# The models built in this process; in a replica, the last one is the
+# replica's own.
+models = []
+
+
+def make_model():
+    numpy.random.seed(0)
+    models.append(TinyModel())
+    return models[-1]
+
+
+def make_iterator(rank, num_replicas):
+    rng = numpy.random.RandomState(rank)
+    while True:
+        yield (rng.randn(4, 5).astype(theano.config.floatX),
+               rng.randint(0, 3, 4).astype('int32'))
+
+
+class RecordingTrainer(DataParallelTrainer):
+    # Every replica also leaves its final parameters in self.final.
+    def __init__(self, *args, **kwargs):
+        super(RecordingTrainer, self).__init__(*args, **kwargs)
+        self.final = data_parallel._shared_array((self.num_replicas,
+                                                  self.num_parameters))
+
+    def _run_replica(self, rank, num_steps, results):
+        super(RecordingTrainer, self)._run_replica(rank, num_steps, results)
+        self.final[rank] = data_parallel.get_flat_parameters(
+            models[-1].all_save_parameters_symbol)
+
+
+def _parameters(model):
+    return [param.get_value() for param in model.all_save_parameters_symbol]
+
+
+class TestDataParallelTrainer(unittest.TestCase):
+    def test_one_replica_matches_train(self):
+        for num_steps in range(1, 4):
+            model = make_model()
+            iterator = make_iterator(0, 1)
+            costs = []
+            for i in range(num_steps):
+                costs.append(model.train(*next(iterator)))
+
+            trainer = DataParallelTrainer(make_model, make_iterator,
+                                          num_replicas=1)
+            stats = trainer.train(num_steps)
+            numpy.testing.assert_allclose(stats['replicas'][0]['outputs'],
+                                          numpy.mean(costs, axis=0),
+                                          rtol=1e-5)
+            for param, value in zip(_parameters(trainer.model),
+                                    _parameters(model)):
+                numpy.testing.assert_allclose(param, value, rtol=1e-5)
+
+    def test_synchronous_replicas_stay_identical(self):
+        for average in (data_parallel.GRADIENTS, data_parallel.PARAMETERS):
+            trainer = RecordingTrainer(make_model, make_iterator,
+                                       num_replicas=2, average=average)
+            initial = data_parallel.get_flat_parameters(
+                trainer.model.all_save_parameters_symbol)
+            trainer.train(3)
+            numpy.testing.assert_array_equal(trainer.final[0],
+                                             trainer.final[1])
+            result = data_parallel.get_flat_parameters(
+                trainer.model.all_save_parameters_symbol)
+            numpy.testing.assert_array_equal(result, trainer.final[0])
+            self.assertFalse(numpy.allclose(result, initial))
+
+    def test_buffers_have_the_dtype_of_the_parameters(self):
+        trainer = DataParallelTrainer(make_model, make_iterator,
+                                      num_replicas=1)
+        for array in (trainer.parameters, trainer.rows, trainer.averaged):
+            self.assertEqual(array.dtype, theano.config.floatX)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+import unittest
+
+import numpy
+
+from anna.layers import layers
+from anna.models import SupervisedModel
+from anna.util import evaluation
+
+
+class TinyModel(SupervisedModel):
+    def __init__(self):
+        numpy.random.seed(0)
+        self.input = layers.FlatInputLayer(4, 5)
+        self.output = layers.DenseLayer(self.input, 3, 1., 0.,
+                                        nonlinearity=layers.softmax)
+        super(TinyModel, self).__init__('tiny', '/tmp')
+
+
+def _softmax(logits):
+    e = numpy.exp(logits - logits.max(axis=1, keepdims=True))
+    return e / e.sum(axis=1, keepdims=True)
+
+
+def _feed(metric, output, target, batch_size=4):
+    # In batches, the last one partial.
+    for start in range(0, len(output), batch_size):
+        metric.update(output[start:start + batch_size],
+                      target[start:start + batch_size])
+    return metric.result()
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        rng = numpy.random.RandomState(0)
+        self.output = _softmax(rng.randn(10, 6))
+        self.target = rng.randint(0, 6, 10)
+
+    def test_cross_entropy(self):
+        expected = -numpy.mean(numpy.log(
+            self.output[numpy.arange(10), self.target]))
+        self.assertAlmostEqual(
+            _feed(evaluation.CrossEntropy(), self.output,
+                  self.target)['loss'], expected)
+
+    def test_accuracy(self):
+        expected = numpy.mean(self.output.argmax(axis=1) == self.target)
+        self.assertAlmostEqual(
+            _feed(evaluation.Accuracy(), self.output,
+                  self.target)['accuracy'], expected)
+
+    def test_top_k_accuracy(self):
+        ranks = (self.output >
+                 self.output[numpy.arange(10), self.target][:, None]).sum(
+            axis=1)
+        result = _feed(evaluation.TopKAccuracy(3), self.output, self.target)
+        self.assertAlmostEqual(result['top_3_accuracy'],
+                               numpy.mean(ranks < 3))
+
+    def test_confusion_matrix(self):
+        expected = numpy.zeros((6, 6), dtype=numpy.int64)
+        for true, predicted in zip(self.target,
+                                   self.output.argmax(axis=1)):
+            expected[true, predicted] += 1
+        result = _feed(evaluation.ConfusionMatrix(6), self.output,
+                       self.target)
+        numpy.testing.assert_array_equal(result['confusion_matrix'],
+                                         expected)
+        with numpy.errstate(invalid='ignore'):
+            recall = numpy.diag(expected) / expected.sum(axis=1).astype(float)
+        numpy.testing.assert_array_equal(result['per_class_recall'], recall)
+
+    def test_squared_error(self):
+        target = numpy.random.RandomState(1).rand(10, 6)
+        result = _feed(evaluation.SquaredError(), self.output, target)
+        mse = numpy.mean((self.output - target) ** 2)
+        self.assertAlmostEqual(result['mse'], mse)
+        self.assertAlmostEqual(result['rmse'], numpy.sqrt(mse))
+
+    def test_reconstruction_error(self):
+        target = numpy.random.RandomState(1).rand(10, 6)
+        result = _feed(evaluation.ReconstructionError(), self.output, target)
+        self.assertAlmostEqual(
+            result['reconstruction_error'],
+            numpy.mean(numpy.sum((self.output - target) ** 2, axis=1)))
+
+    def test_reset(self):
+        metric = evaluation.Accuracy()
+        _feed(metric, self.output, (self.target + 1) % 6)
+        metric.reset()
+        self.assertEqual(_feed(metric, self.output, self.target),
+                         _feed(evaluation.Accuracy(), self.output,
+                               self.target))
+
+
+class TestStreamingEvaluator(unittest.TestCase):
+    def setUp(self):
+        rng = numpy.random.RandomState(0)
+        self.model = TinyModel()
+        self.x = rng.randn(10, 5).astype(numpy.float32)
+        self.y = rng.randint(0, 3, 10)
+
+    def _results(self, **kwargs):
+        evaluator = evaluation.StreamingEvaluator(self.model, **kwargs)
+        evaluator.update(self.x, self.y)
+        return evaluator.results()
+
+    def _check(self, results, expected):
+        self.assertEqual(sorted(results), sorted(expected))
+        for name in expected:
+            numpy.testing.assert_allclose(results[name], expected[name],
+                                          rtol=1e-5)
+
+    def test_partial_last_batch_matches_whole_set(self):
+        # Batches of 4, 4 and an unpadded 2.
+        batch_sizes = []
+        func = self.model._select('prediction_func', False)
+        self.model.inference_prediction_func = lambda batch: (
+            batch_sizes.append(len(batch)) or func(batch))
+        results = self._results()
+        self.assertEqual(batch_sizes, [4, 4, 2])
+
+        # Straight from the parameters, for the whole set at once.
+        W = self.model.output.W.get_value()
+        b = self.model.output.b.get_value()
+        output = _softmax(self.x.dot(W) + b)
+        expected = {}
+        for metric in evaluation.default_metrics(self.model):
+            metric.update(output, self.y)
+            expected.update(metric.result())
+        self._check(results, expected)
+        self._check(self._results(batch_size=10), expected)
+        # The accuracy of the model's own eval over the whole set.
+        self.assertAlmostEqual(results['accuracy'],
+                               float(self.model.eval(self.x, self.y)),
+                               places=5)
+
+    def test_padded_last_batch_matches_whole_set(self):
+        expected = self._results(batch_size=10)
+        self.model.output.fixed_batch_size = True
+        self._check(self._results(), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from anna.layers import layers
+from anna.models import SupervisedModel
+from anna.models.function_cache import FunctionCache
+
+
+class DropoutModel(SupervisedModel):
+    def __init__(self, path):
+        self.input = layers.FlatInputLayer(4, 5)
+        self.output = layers.DenseLayer(self.input, 3, 0.1, 0.,
+                                        nonlinearity=layers.identity,
+                                        dropout=0.5)
+        super(DropoutModel, self).__init__('dropout', path)
+
+
+class TestFunctionCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.x = numpy.random.RandomState(0).randn(4, 5).astype(
+            numpy.float32)
+
+        # Records (function name, whether it was found) of every lookup.
+        self.lookups = []
+        self.load = FunctionCache.load
+
+        def load(cache, key, shared_variables):
+            func = self.load(cache, key, shared_variables)
+            self.lookups.append((key.rsplit('-', 1)[0], func is not None))
+            return func
+        FunctionCache.load = load
+
+    def tearDown(self):
+        FunctionCache.load = self.load
+        shutil.rmtree(self.directory)
+
+    def _model(self, seed):
+        numpy.random.seed(seed)
+        model = DropoutModel(self.directory)
+        model.function_cache_dir = self.directory
+        return model
+
+    def _cached_names(self):
+        return sorted(name.rsplit('-', 1)[0]
+                      for name in os.listdir(self.directory)
+                      if name.endswith('.pkl'))
+
+    def test_train_and_inference_graphs_are_cached_apart(self):
+        model = self._model(0)
+        model.prediction(self.x, dropout_active=False)
+        model.prediction(self.x, dropout_active=True)
+        self.assertEqual(self._cached_names(),
+                         ['inference_prediction_func', 'prediction_func'])
+        self.assertEqual(self.lookups,
+                         [('inference_prediction_func', False),
+                          ('prediction_func', False)])
+
+    def test_reload_rebinds_shared_variables(self):
+        self._model(0).prediction(self.x, dropout_active=False)
+
+        model = self._model(1)
+        del self.lookups[:]
+        output = model.prediction(self.x, dropout_active=False)
+        self.assertEqual(self.lookups, [('inference_prediction_func', True)])
+        # The cached function computes with the parameters of the new
+        # model, and follows changes to them.
+        W, b = model.output.W, model.output.b
+        numpy.testing.assert_allclose(
+            output, self.x.dot(W.get_value()) + b.get_value(), rtol=1e-5)
+        W.set_value(numpy.zeros_like(W.get_value()))
+        numpy.testing.assert_allclose(
+            model.prediction(self.x, dropout_active=False),
+            numpy.tile(b.get_value(), (4, 1)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,287 @@
+import os
+import imp
+import json
+import shutil
+import tempfile
+import unittest
+import cPickle
+
+import numpy
+
+import anna
+from anna.util.checkpoint_store import CheckpointStore
+
+launcher = imp.load_source('launcher', os.path.join(
+    os.path.dirname(anna.__file__), 'scripts', 'launcher.py'))
+
+# Stands in for train.py: records its extra arguments, and fails the first
+# FAILURES times, after writing a parameter checkpoint if CHECKPOINTS is set.
+CHILD = """
+import os
+import sys
+import pickle
+
+out_path = sys.argv[2]
+f = open(os.path.join(out_path, 'calls.txt'), 'a')
+f.write(' '.join(sys.argv[3:]) + '\\n')
+f.close()
+f = open(os.path.join(out_path, 'calls.txt'))
+num_calls = len(f.readlines())
+f.close()
+if num_calls <= int(os.environ['FAILURES']):
+    if os.environ['CHECKPOINTS']:
+        f = open(os.path.join(out_path, 'checkpoints',
+                              'model-%d.pkl' % num_calls), 'wb')
+        pickle.dump([num_calls], f, 2)
+        f.close()
+    sys.exit(1)
+"""
+
+# Stands in for the train.py of a queued experiment: records when it ran and
+# with which device and threads, sleeps SLEEP seconds and exits with EXIT.
+QUEUED_CHILD = """
+import os
+import sys
+import json
+import time
+
+start = time.time()
+time.sleep(float(os.environ.get('SLEEP', '0.3')))
+f = open(os.path.join(sys.argv[2], 'run.json'), 'w')
+json.dump({'start': start, 'end': time.time(),
+           'flags': os.environ['THEANO_FLAGS'],
+           'threads': os.environ['OMP_NUM_THREADS']}, f)
+f.close()
+sys.exit(int(os.environ.get('EXIT', '0')))
+"""
+
+
+def _arrays(step):
+    return [numpy.arange(6, dtype=numpy.float32).reshape(2, 3) + step]
+
+
+class TestSupervisedRun(unittest.TestCase):
+    def setUp(self):
+        self.out_path = tempfile.mkdtemp()
+        self.checkpoint_path = os.path.join(self.out_path, 'checkpoints')
+        os.makedirs(self.checkpoint_path)
+        f = open(os.path.join(self.out_path, 'train.py'), 'w')
+        f.write(CHILD)
+        f.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.out_path)
+
+    def _run(self, failures, max_restarts, checkpoints=True):
+        env = dict(os.environ, FAILURES=str(failures),
+                   CHECKPOINTS='1' if checkpoints else '')
+        run = launcher.SupervisedRun('exp', self.out_path, env,
+                                     max_restarts=max_restarts, backoff=0.1,
+                                     max_backoff=0.15)
+        run.start()
+        return run, run.wait(poll_interval=0.01)
+
+    def _checkpoint(self, number):
+        return os.path.join(self.checkpoint_path, 'model-%d.pkl' % number)
+
+    def test_restarts_from_the_newest_checkpoint(self):
+        run, returncode = self._run(failures=2, max_restarts=3)
+        self.assertEqual(returncode, 0)
+        self.assertEqual(run.restarts, 2)
+        self.assertEqual([attempt['returncode'] for attempt in run.attempts],
+                         [1, 1, 0])
+        self.assertEqual([attempt['resume_checkpoint']
+                          for attempt in run.attempts],
+                         [None, self._checkpoint(1), self._checkpoint(2)])
+        # The backoff doubles, up to max_backoff.
+        for previous, attempt, delay in zip(run.attempts, run.attempts[1:],
+                                            [0.1, 0.15]):
+            self.assertGreaterEqual(
+                attempt['start_time'] - previous['end_time'], delay)
+
+        f = open(run.status_path)
+        status = json.load(f)
+        f.close()
+        self.assertEqual((status['state'], status['restarts']), ('done', 2))
+        self.assertEqual(len(status['attempts']), 3)
+
+    def test_gives_up_after_max_restarts(self):
+        run, returncode = self._run(failures=5, max_restarts=1)
+        self.assertEqual(returncode, 1)
+        self.assertEqual(run.state, 'failed')
+        self.assertEqual(len(run.attempts), 2)
+        self.assertEqual(run.attempts[1]['resume_checkpoint'],
+                         self._checkpoint(1))
+
+    def test_restarts_from_a_checkpoint_store(self):
+        store = CheckpointStore(self.checkpoint_path, full_every=5)
+        for step in range(3):
+            store.save(step, _arrays(step))
+        run, returncode = self._run(failures=1, max_restarts=1,
+                                    checkpoints=False)
+        self.assertEqual(returncode, 0)
+        self.assertEqual([attempt['resume_checkpoint']
+                          for attempt in run.attempts],
+                         [None, store.index_path])
+
+    def test_restarts_from_scratch_without_checkpoints(self):
+        run, returncode = self._run(failures=1, max_restarts=1,
+                                    checkpoints=False)
+        self.assertEqual(returncode, 0)
+        self.assertEqual([attempt['resume_checkpoint']
+                          for attempt in run.attempts], [None, None])
+
+
+class TestScheduler(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.train_path = os.path.join(self.path, 'exps')
+        self.out_path = os.path.join(self.path, 'results')
+        self.status_path = os.path.join(self.path, 'queue.status.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _experiment(self, exp_name):
+        path = os.path.join(self.train_path, exp_name)
+        os.makedirs(path)
+        for name in ['model.py', 'train.py', 'train_scratch.py',
+                     'train_finetune.py']:
+            f = open(os.path.join(path, name), 'w')
+            f.write(QUEUED_CHILD if name == 'train.py' else '')
+            f.close()
+
+    def _run(self, specs, **kwargs):
+        for spec in specs:
+            if not spec.get('missing'):
+                self._experiment(spec['exp_name'])
+        scheduler = launcher.Scheduler(specs, self.status_path,
+                                       train_path=self.train_path,
+                                       out_path=self.out_path,
+                                       poll_interval=0.01, **kwargs)
+        jobs = scheduler.run()
+        runs = {}
+        for job in jobs:
+            path = os.path.join(self.out_path, job['exp_name'], 'run.json')
+            if os.path.exists(path):
+                f = open(path)
+                runs[job['exp_name']] = json.load(f)
+                f.close()
+        return jobs, runs
+
+    def _max_concurrent(self, runs):
+        return max(sum(1 for other in runs
+                       if other['start'] <= run['start'] < other['end'])
+                   for run in runs)
+
+    def test_gpu_slots(self):
+        specs = [{'exp_name': 'exp%d' % i} for i in range(4)]
+        jobs, runs = self._run(specs, gpus=[0, 1], cores=8)
+        self.assertEqual([job['state'] for job in jobs], ['done'] * 4)
+        by_gpu = {}
+        for job in jobs:
+            run = runs[job['exp_name']]
+            self.assertIn('device=gpu%s,' % job['assigned_device'],
+                          run['flags'])
+            by_gpu.setdefault(job['assigned_device'], []).append(run)
+        # One job per gpu at a time, both gpus busy.
+        self.assertEqual(sorted(by_gpu), ['0', '1'])
+        for gpu_runs in by_gpu.values():
+            self.assertEqual(self._max_concurrent(gpu_runs), 1)
+        self.assertEqual(self._max_concurrent(runs.values()), 2)
+
+    def test_core_slots(self):
+        specs = [{'exp_name': 'small0', 'cores': 2},
+                 {'exp_name': 'small1', 'cores': 2},
+                 {'exp_name': 'large', 'cores': 3},
+                 {'exp_name': 'too_large', 'cores': 5},
+                 {'exp_name': 'unknown_gpu', 'device': 7}]
+        jobs, runs = self._run(specs, cores=4)
+        self.assertEqual([job['state'] for job in jobs],
+                         ['done', 'done', 'done', 'failed', 'failed'])
+        for job in jobs[3:]:
+            self.assertEqual(job['error'],
+                             'does not fit in the available slots')
+        for name, run in runs.items():
+            self.assertIn('device=cpu', run['flags'])
+        self.assertEqual([runs[name]['threads']
+                          for name in ['small0', 'small1', 'large']],
+                         ['2', '2', '3'])
+        # The two small jobs ran together, the large one after both.
+        self.assertLess(runs['small1']['start'], runs['small0']['end'])
+        self.assertGreaterEqual(runs['large']['start'],
+                                max(runs['small0']['end'],
+                                    runs['small1']['end']))
+
+    def test_status_file(self):
+        specs = [{'exp_name': 'ok'},
+                 {'exp_name': 'crash', 'env': {'EXIT': '3'}},
+                 {'exp_name': 'missing', 'missing': True}]
+        jobs, runs = self._run(specs, cores=4)
+        f = open(self.status_path)
+        status = json.load(f)
+        f.close()
+        self.assertEqual([(job['exp_name'], job['state'],
+                           job.get('returncode')) for job in status['jobs']],
+                         [('ok', 'done', 0), ('crash', 'failed', 3),
+                          ('missing', 'failed', None)])
+        self.assertEqual(status['jobs'][2]['error'],
+                         'missing experiment files')
+        for job in status['jobs'][:2]:
+            self.assertEqual(job['assigned_device'], 'cpu')
+            self.assertEqual(job['restarts'], 0)
+            self.assertLessEqual(job['start_time'], job['end_time'])
+
+    def test_restarts_keep_the_slot(self):
+        specs = [{'exp_name': 'crash', 'env': {'EXIT': '3', 'SLEEP': '0'}},
+                 {'exp_name': 'next'}]
+        jobs, runs = self._run(specs, cores=1, max_restarts=2, backoff=0.1)
+        self.assertEqual([(job['state'], job['restarts']) for job in jobs],
+                         [('failed', 2), ('done', 0)])
+        # The second job waited for the restarts of the first one.
+        f = open(os.path.join(self.out_path, 'crash', 'status.json'))
+        attempts = json.load(f)['attempts']
+        f.close()
+        self.assertEqual(len(attempts), 3)
+        self.assertGreaterEqual(runs['next']['start'],
+                                attempts[-1]['end_time'])
+
+
+class TestFindLatestCheckpoint(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _write(self, name, data, mtime):
+        path = os.path.join(self.path, name)
+        f = open(path, 'wb')
+        f.write(data)
+        f.close()
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def test_skips_truncated_checkpoints(self):
+        valid = self._write('model-1.pkl', cPickle.dumps([1], 2), 100)
+        self._write('model-2.pkl', cPickle.dumps([2], 2)[:-3], 200)
+        self.assertEqual(launcher.find_latest_checkpoint(self.path), valid)
+        self.assertEqual(launcher.find_latest_checkpoint(
+            os.path.join(self.path, 'missing')), None)
+
+    def test_checkpoint_store(self):
+        older = self._write('model-1.pkl', cPickle.dumps([1], 2), 100)
+        store = CheckpointStore(self.path, full_every=5)
+        for step in range(3):
+            store.save(step, _arrays(step))
+        # The newest step is a delta, rebuilt through the store.
+        self.assertEqual(launcher.find_latest_checkpoint(self.path),
+                         store.index_path)
+
+        # Without its full snapshot the newest step cannot be restored.
+        os.remove(os.path.join(self.path, store.entries[0]['file']))
+        self.assertEqual(launcher.find_latest_checkpoint(self.path), older)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,181 @@
+import unittest
+
+import numpy
+
+from anna.layers import layers
+from anna.models import SupervisedModel, KRegressionModel, \
+    ReinforcementModel
+
+
+class TinyModel(SupervisedModel):
+    def __init__(self):
+        numpy.random.seed(0)
+        self.input = layers.FlatInputLayer(4, 5)
+        self.output = layers.DenseLayer(self.input, 3, 0.1, 0.,
+                                        nonlinearity=layers.softmax)
+        super(TinyModel, self).__init__('tiny', '/tmp', learning_rate=0.1)
+
+
+def _parameters(model):
+    return [param.get_value() for param in model.all_save_parameters_symbol]
+
+
+class TinyDropoutModel(SupervisedModel):
+    def __init__(self):
+        self.input = layers.FlatInputLayer(4, 5)
+        self.output = layers.DenseLayer(self.input, 3, 0.1, 0.,
+                                        nonlinearity=layers.softmax,
+                                        dropout=0.5)
+        super(TinyDropoutModel, self).__init__('tiny', '/tmp')
+
+
+class TinyKRegressionModel(KRegressionModel):
+    def __init__(self):
+        self.k = 3
+        self.y_n = 2
+        self.input = layers.FlatInputLayer(4, 5)
+        self.y = layers.FlatInputLayer(4, self.y_n)
+        self.output = layers.DenseLayer(self.input, self.y_n * self.k, 0.1,
+                                        0., nonlinearity=layers.identity)
+        super(TinyKRegressionModel, self).__init__('tiny', '/tmp',
+                                                   learning_rate=0.01)
+
+
+class TinyReinforcementModel(ReinforcementModel):
+    def __init__(self):
+        self.action_dims = 3
+        self.input = layers.FlatInputLayer(4, 5)
+        self.output = layers.DenseLayer(self.input, self.action_dims, 0.1,
+                                        0., nonlinearity=layers.identity)
+        super(TinyReinforcementModel, self).__init__(
+            'tiny', '/tmp', learning_rate=0.01, target_sync_every=2)
+
+
+class TestDropout(unittest.TestCase):
+    def test_prediction_is_deterministic_by_default(self):
+        model = TinyDropoutModel()
+        rng = numpy.random.RandomState(0)
+        x = rng.randn(4, 5).astype(numpy.float32)
+        y = numpy.array([0, 1, 2, 0])
+
+        prediction = model.prediction(x)
+        numpy.testing.assert_array_equal(model.prediction(x), prediction)
+        self.assertEqual(model.eval(x, y), model.eval(x, y))
+        W, b = model.output.W.get_value(), model.output.b.get_value()
+        logits = x.dot(W) + b
+        numpy.testing.assert_allclose(
+            prediction, numpy.exp(logits) /
+            numpy.exp(logits).sum(axis=1, keepdims=True), rtol=1e-5)
+
+        # The train-time graph draws a new dropout mask on every call.
+        self.assertFalse(numpy.allclose(
+            model.prediction(x, dropout_active=True),
+            model.prediction(x, dropout_active=True)))
+
+
+class TestTrainMany(unittest.TestCase):
+    def test_matches_train(self):
+        rng = numpy.random.RandomState(0)
+        x_block = rng.randn(3, 4, 5).astype(numpy.float32)
+        y_block = rng.randint(0, 3, (3, 4))
+
+        model = TinyModel()
+        outputs = [model.train(x, y) for x, y in zip(x_block, y_block)]
+        # Momentum carries over from one step to the next, the second block
+        # checks that it also carries over between calls.
+        outputs += [model.train(x, y) for x, y in zip(x_block, y_block)]
+
+        fused = TinyModel()
+        fused_outputs = [fused.train_many(x_block, y_block)
+                         for i in range(2)]
+        for i, (costs, accuracies) in enumerate(fused_outputs):
+            for step, (cost, accuracy) in enumerate(zip(costs,
+                                                        accuracies)):
+                numpy.testing.assert_allclose(
+                    [cost, accuracy], outputs[3 * i + step], rtol=1e-5)
+        for value, expected in zip(_parameters(fused), _parameters(model)):
+            numpy.testing.assert_allclose(value, expected, rtol=1e-5)
+
+
+class TestChunkTraining(unittest.TestCase):
+    def setUp(self):
+        rng = numpy.random.RandomState(0)
+        self.x = rng.randn(12, 5).astype(numpy.float32)
+        self.y = rng.randint(0, 3, 12)
+
+    def _check(self, train_chunk, batches):
+        model = TinyModel()
+        outputs = [model.train(self.x[batch], self.y[batch])
+                   for batch in batches]
+
+        chunked = TinyModel()
+        self.assertEqual(chunked.set_chunk(self.x, self.y), 3)
+        for batch, expected in zip(batches, outputs):
+            numpy.testing.assert_allclose(train_chunk(chunked, batch),
+                                          expected, rtol=1e-5)
+        for value, expected in zip(_parameters(chunked),
+                                   _parameters(model)):
+            numpy.testing.assert_allclose(value, expected, rtol=1e-5)
+
+    def test_train_chunk(self):
+        self._check(lambda model, batch: model.train_chunk(batch.start // 4),
+                    [slice(4 * i, 4 * (i + 1)) for i in range(3)])
+
+    def test_train_indexed(self):
+        permutation = numpy.random.RandomState(1).permutation(12)
+        self._check(lambda model, batch: model.train_indexed(batch),
+                    [permutation[4 * i:4 * (i + 1)] for i in range(3)])
+
+    def test_set_chunk_takes_every_argument_of_train(self):
+        model = TinyModel()
+        self.assertRaises(ValueError, model.set_chunk, self.x)
+        self.assertRaises(ValueError, model.set_chunk, self.x, self.y,
+                          self.y)
+
+
+class TestKRegressionModel(unittest.TestCase):
+    def test_train_step(self):
+        model = TinyKRegressionModel()
+        rng = numpy.random.RandomState(0)
+        x = rng.randn(4, 5).astype(numpy.float32)
+        y = rng.randn(4, 2).astype(numpy.float32)
+        expected = model.cluster(x, y)
+
+        cost, clusters = model.train_step(x, y)
+        self.assertTrue(numpy.isfinite(cost))
+        numpy.testing.assert_array_equal(clusters, expected.argmax(axis=1))
+
+
+class TestReinforcementModel(unittest.TestCase):
+    def test_train_step_and_sync_target(self):
+        model = TinyReinforcementModel()
+        rng = numpy.random.RandomState(0)
+        x = rng.randn(4, 5).astype(numpy.float32)
+        next_x = rng.randn(4, 5).astype(numpy.float32)
+        action_index = numpy.array([0, 1, 2, 0], dtype=numpy.int64)
+        r = numpy.ones(4, dtype=numpy.float32)
+        terminal = numpy.array([0, 0, 0, 1], dtype=numpy.float32)
+
+        params = model.all_save_parameters_symbol
+        targets = model.target_parameters_symbol
+        before = [param.get_value() for param in params]
+
+        cost, td_error = model.train_step(x, action_index, r, next_x,
+                                          terminal, numpy.float32(0.9))
+        self.assertTrue(numpy.isfinite(cost))
+        self.assertEqual(td_error.shape, (4,))
+        # The parameters moved, the target network did not.
+        self.assertFalse(all(numpy.allclose(param.get_value(), value)
+                             for param, value in zip(params, before)))
+        for target, value in zip(targets, before):
+            numpy.testing.assert_allclose(target.get_value(), value)
+
+        model.sync_target()
+        for param, target in zip(params, targets):
+            numpy.testing.assert_allclose(target.get_value(),
+                                          param.get_value())
+        self.assertEqual(model.target_step_symbol.get_value(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,172 @@
+import unittest
+
+import numpy
+import theano
+import theano.tensor as T
+
+from anna.layers import optimizers
+
+
+# The gen_updates_* functions of layers.py before they delegated to the
+# optimizers, the reference for the optimizers' updates and slot order.
+
+def reference_momentum(loss, all_parameters, learning_rate, momentum,
+                       weight_decay):
+    all_grads = [theano.grad(loss, param) for param in all_parameters]
+    updates = []
+    for param_i, grad_i in zip(all_parameters, all_grads):
+        mparam_i = theano.shared(param_i.get_value() * 0.)
+        v = (momentum * mparam_i - weight_decay * learning_rate * param_i -
+             learning_rate * grad_i)
+        updates.append((mparam_i, v))
+        updates.append((param_i, param_i + v))
+    return updates
+
+
+def reference_nesterov_momentum(loss, all_parameters, learning_rate,
+                                momentum, weight_decay):
+    all_grads = [theano.grad(loss, param) for param in all_parameters]
+    updates = []
+    for param_i, grad_i in zip(all_parameters, all_grads):
+        mparam_i = theano.shared(param_i.get_value() * 0.)
+        full_grad = grad_i + weight_decay * param_i
+        v = momentum * mparam_i - learning_rate * full_grad
+        w = param_i + momentum * v - learning_rate * full_grad
+        updates.append((mparam_i, v))
+        updates.append((param_i, w))
+    return updates
+
+
+def reference_sgd(loss, all_parameters, learning_rate):
+    all_grads = [theano.grad(loss, param) for param in all_parameters]
+    updates = []
+    for param_i, grad_i in zip(all_parameters, all_grads):
+        updates.append((param_i, param_i - learning_rate * grad_i))
+    return updates
+
+
+def reference_adagrad(loss, all_parameters, learning_rate=1.0, epsilon=1e-6):
+    all_grads = [theano.grad(loss, param) for param in all_parameters]
+    all_accumulators = [theano.shared(param.get_value() * 0.)
+                        for param in all_parameters]
+    updates = []
+    for param_i, grad_i, acc_i in zip(all_parameters, all_grads,
+                                      all_accumulators):
+        acc_i_new = acc_i + grad_i ** 2
+        updates.append((acc_i, acc_i_new))
+        updates.append(
+            (param_i,
+             param_i - learning_rate * grad_i / T.sqrt(acc_i_new + epsilon)))
+    return updates
+
+
+def reference_rmsprop(loss, all_parameters, learning_rate=1.0, rho=0.9,
+                      epsilon=1e-6):
+    all_grads = [theano.grad(loss, param) for param in all_parameters]
+    all_accumulators = [theano.shared(param.get_value() * 0.)
+                        for param in all_parameters]
+    updates = []
+    for param_i, grad_i, acc_i in zip(all_parameters, all_grads,
+                                      all_accumulators):
+        acc_i_new = rho * acc_i + (1 - rho) * grad_i ** 2
+        updates.append((acc_i, acc_i_new))
+        updates.append(
+            (param_i,
+             param_i - learning_rate * grad_i / T.sqrt(acc_i_new + epsilon)))
+    return updates
+
+
+def reference_adadelta(loss, all_parameters, learning_rate=1.0, rho=0.95,
+                       epsilon=1e-6):
+    all_grads = [theano.grad(loss, param) for param in all_parameters]
+    all_accumulators = [theano.shared(param.get_value() * 0.)
+                        for param in all_parameters]
+    all_delta_accumulators = [theano.shared(param.get_value() * 0.)
+                              for param in all_parameters]
+    updates = []
+    for param_i, grad_i, acc_i, acc_delta_i in zip(all_parameters, all_grads,
+                                                   all_accumulators,
+                                                   all_delta_accumulators):
+        acc_i_new = rho * acc_i + (1 - rho) * grad_i ** 2
+        updates.append((acc_i, acc_i_new))
+
+        update_i = (grad_i * T.sqrt(acc_delta_i + epsilon) /
+                    T.sqrt(acc_i_new + epsilon))
+        updates.append((param_i, param_i - learning_rate * update_i))
+
+        acc_delta_i_new = rho * acc_delta_i + (1 - rho) * update_i ** 2
+        updates.append((acc_delta_i, acc_delta_i_new))
+    return updates
+
+
+# (optimizer, reference taking loss, parameters and learning rate)
+CASES = [
+    (lambda flat: optimizers.SGD(flat=flat), reference_sgd),
+    (lambda flat: optimizers.Momentum(0.9, 1e-3, flat=flat),
+     lambda loss, params, lr: reference_momentum(loss, params, lr, 0.9,
+                                                 1e-3)),
+    (lambda flat: optimizers.NesterovMomentum(0.9, 1e-3, flat=flat),
+     lambda loss, params, lr: reference_nesterov_momentum(loss, params, lr,
+                                                          0.9, 1e-3)),
+    (lambda flat: optimizers.Adagrad(1e-6, flat=flat), reference_adagrad),
+    (lambda flat: optimizers.RMSProp(0.9, 1e-6, flat=flat),
+     reference_rmsprop),
+    (lambda flat: optimizers.Adadelta(0.95, 1e-6, flat=flat),
+     reference_adadelta),
+]
+
+
+class TestOptimizers(unittest.TestCase):
+    def setUp(self):
+        rng = numpy.random.RandomState(0)
+        self.values = [rng.randn(3, 2).astype(theano.config.floatX),
+                       rng.randn(2).astype(theano.config.floatX)]
+        self.x = rng.randn(5, 3).astype(theano.config.floatX)
+        self.t = rng.randn(5, 2).astype(theano.config.floatX)
+
+    def _run(self, get_updates):
+        # Three steps on a small regression; returns the parameters and
+        # the slots, in the order of the updates.
+        params = [theano.shared(value.copy()) for value in self.values]
+        W, b = params
+        loss = T.sum((T.dot(self.x, W) + b - self.t) ** 2)
+        learning_rate = theano.shared(
+            numpy.array(0.1, dtype=theano.config.floatX))
+        updates = get_updates(loss, params, learning_rate)
+        train = theano.function([], loss, updates=updates)
+        for i in range(3):
+            train()
+        slots = [var.get_value() for var, _ in updates if var not in params]
+        return [param.get_value() for param in params], slots
+
+    def _check(self, flat):
+        for make_optimizer, reference in CASES:
+            optimizer = make_optimizer(flat)
+            params, slots = self._run(optimizer.get_updates)
+            expected_params, expected_slots = self._run(reference)
+            for value, expected in zip(params, expected_params):
+                numpy.testing.assert_allclose(value, expected, rtol=1e-5,
+                                              err_msg=repr(optimizer))
+            self.assertEqual(len(slots),
+                             (1 if flat else 2) * optimizer.n_slots)
+            if flat:
+                # Slot k of every parameter, concatenated.
+                expected_slots = [
+                    numpy.concatenate([slot.ravel() for slot in
+                                       expected_slots[k::optimizer.n_slots]])
+                    for k in range(optimizer.n_slots)]
+            for value, expected in zip(slots, expected_slots):
+                numpy.testing.assert_allclose(value, expected, rtol=1e-5,
+                                              err_msg=repr(optimizer))
+
+    def test_matches_gen_updates(self):
+        # The slots are in the order the gen_updates_* functions saved them,
+        # per parameter (for Adadelta: gradient, then update accumulator).
+        self._check(flat=False)
+
+    def test_flat_matches_gen_updates(self):
+        self._check(flat=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+import numpy
+
+from anna.layers import layers
+from anna.util.prediction_server import PredictionServer, PredictionClient
+
+
+class DoublingModel(object):
+    # Stands in for a model whose prediction_func doubles its input, and
+    # records the size of every batch it runs.
+    def __init__(self, mb_size=4, n_features=3):
+        self.input = layers.FlatInputLayer(mb_size, n_features)
+        self.batch_sizes = []
+
+    def _get_output_layer(self):
+        return self.input
+
+    def _select(self, name, dropout_active):
+        return self.predict
+
+    def predict(self, batch):
+        self.batch_sizes.append(len(batch))
+        return 2 * batch
+
+
+def _samples(values):
+    return numpy.repeat(numpy.asarray(values, dtype=numpy.float32)[:, None],
+                        3, axis=1)
+
+
+class TestPredictionServer(unittest.TestCase):
+    def setUp(self):
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.server.server_close()
+
+    def _server(self, model, **kwargs):
+        server = PredictionServer(model, **kwargs)
+        self.servers.append(server)
+        return server
+
+    def test_batches_and_scatters(self):
+        model = DoublingModel()
+        server = self._server(model, max_latency=10.)
+        results = {}
+
+        def request(i):
+            results[i] = server.predict(_samples([i]))
+
+        threads = [threading.Thread(target=request, args=(i,))
+                   for i in range(4)]
+        started = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # The four requests filled one batch, which ran without waiting for
+        # max_latency, and every request got its own row back.
+        self.assertLess(time.time() - started, 5.)
+        self.assertEqual(model.batch_sizes, [4])
+        for i in range(4):
+            numpy.testing.assert_array_equal(results[i], _samples([2 * i]))
+        self.assertEqual(server.get_stats()['mean_batch_fill'], 1.)
+
+    def test_splits_large_requests_without_padding(self):
+        model = DoublingModel()
+        server = self._server(model)
+        numpy.testing.assert_array_equal(server.predict(_samples(range(6))),
+                                         _samples(range(0, 12, 2)))
+        self.assertEqual(model.batch_sizes, [4, 2])
+
+    def test_pads_for_fixed_batch_size(self):
+        model = DoublingModel()
+        model.input.fixed_batch_size = True
+        server = self._server(model)
+        numpy.testing.assert_array_equal(server.predict(_samples([1])),
+                                         _samples([2]))
+        self.assertEqual(model.batch_sizes, [4])
+
+    def test_deadline_flush(self):
+        model = DoublingModel()
+        server = self._server(model, max_latency=0.05)
+        started = time.time()
+        numpy.testing.assert_array_equal(server.predict(_samples([1])),
+                                         _samples([2]))
+        # The batch never filled, and ran once the request had waited
+        # max_latency.
+        self.assertGreaterEqual(time.time() - started, 0.04)
+        self.assertLess(time.time() - started, 5.)
+        self.assertEqual(model.batch_sizes, [1])
+
+    def test_rejects_malformed_requests(self):
+        model = DoublingModel()
+        server = self._server(model, max_latency=0.)
+        self.assertRaises(ValueError, server.predict,
+                          numpy.zeros((1, 4), dtype=numpy.float32))
+        self.assertRaises(ValueError, server.predict,
+                          numpy.zeros((1, 3, 1), dtype=numpy.float32))
+        self.assertRaises(ValueError, server.predict,
+                          numpy.zeros(3, dtype=numpy.float32))
+        self.assertRaises(ValueError, server.predict,
+                          numpy.zeros((1, 3), dtype=numpy.float64))
+        self.assertEqual(model.batch_sizes, [])
+        # Samples that convert safely are accepted.
+        numpy.testing.assert_array_equal(
+            server.predict(numpy.ones((1, 3), dtype=numpy.uint8)),
+            _samples([2]))
+
+    def test_client(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'server.sock')
+            server = self._server(DoublingModel(), address=path,
+                                  max_latency=0.)
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+
+            client = PredictionClient(path)
+            numpy.testing.assert_array_equal(client.predict(_samples([3])),
+                                             _samples([6]))
+            # A malformed request fails alone, and the connection is still
+            # usable.
+            self.assertRaises(RuntimeError, client.predict,
+                              numpy.zeros((2, 5), dtype=numpy.float32))
+            numpy.testing.assert_array_equal(client.predict(_samples([4])),
+                                             _samples([8]))
+            self.assertEqual(client.stats()['requests'], 2)
+            client.close()
+            server.server.shutdown()
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import unittest
+
+import numpy
+
+from anna.util.reinforcement import BatchedActor, ChainEnvironment
+from anna.util.replay import ReplayMemory
+
+
+class AlwaysRight(object):
+    # Stands in for a ReinforcementModel whose greedy action is 1.
+    action_dims = ChainEnvironment.num_actions
+
+    def __init__(self):
+        self.num_calls = 0
+
+    def action_index(self, states):
+        self.num_calls += 1
+        return numpy.ones(len(states), dtype=numpy.int64)
+
+
+class TestChainEnvironment(unittest.TestCase):
+    def test_walk(self):
+        env = ChainEnvironment(length=4)
+        numpy.testing.assert_array_equal(env.reset(), [1, 0, 0, 0])
+        observation, reward, terminal = env.step(0)
+        numpy.testing.assert_array_equal(observation, [1, 0, 0, 0])
+        for position in (1, 2):
+            observation, reward, terminal = env.step(1)
+            self.assertEqual(observation.argmax(), position)
+            self.assertEqual((reward, terminal), (0.0, False))
+        observation, reward, terminal = env.step(1)
+        self.assertEqual((reward, terminal), (1.0, True))
+
+    def test_max_steps(self):
+        env = ChainEnvironment(length=4, max_steps=3)
+        env.reset()
+        terminals = [env.step(0)[2] for _ in range(3)]
+        self.assertEqual(terminals, [False, False, True])
+
+
+class TestBatchedActor(unittest.TestCase):
+    def test_greedy_episodes(self):
+        environments = [ChainEnvironment(length=4) for _ in range(3)]
+        memory = ReplayMemory(30, (4,), num_streams=3)
+        model = AlwaysRight()
+        actor = BatchedActor(model, environments, memory, epsilon=0.)
+
+        for step in range(3):
+            actions, rewards, terminals = actor.step()
+            numpy.testing.assert_array_equal(actions, [1, 1, 1])
+        # Every chain is walked to its end in 3 steps, with one action_func
+        # call per step for all environments.
+        numpy.testing.assert_array_equal(terminals, [True, True, True])
+        self.assertEqual(model.num_calls, 3)
+        self.assertEqual(actor.episode_returns, [1.0, 1.0, 1.0])
+        self.assertEqual(len(memory), 9)
+
+        # Stream 0 stored positions 0, 1 and 2, interleaved with the others.
+        numpy.testing.assert_array_equal(memory.frames[0:9:3].argmax(axis=1),
+                                         [0, 1, 2])
+        numpy.testing.assert_array_equal(memory.rewards[:9],
+                                         [0] * 6 + [1] * 3)
+        numpy.testing.assert_array_equal(memory.terminals[:9],
+                                         [False] * 6 + [True] * 3)
+        # The environments were reset.
+        numpy.testing.assert_array_equal(actor.frames.argmax(axis=1),
+                                         [0, 0, 0])
+
+    def test_random_actions(self):
+        environments = [ChainEnvironment(length=4) for _ in range(2)]
+        memory = ReplayMemory(20, (4,), num_streams=2)
+        model = AlwaysRight()
+        actor = BatchedActor(model, environments, memory, epsilon=1.)
+        actor.run(10)
+        self.assertEqual(len(memory), 10)
+        self.assertEqual(model.num_calls, 0)
+
+    def test_streams_must_match(self):
+        memory = ReplayMemory(20, (4,), num_streams=2)
+        self.assertRaises(ValueError, BatchedActor, AlwaysRight(),
+                          [ChainEnvironment()], memory)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import unittest
+
+import numpy
+
+from anna.util.replay import ReplayMemory, SumTree
+
+
+class TestReplayMemory(unittest.TestCase):
+    def _fill(self, memory, num_transitions, terminal_at=()):
+        # Frame i holds the value i + 1, so that 0 means a zeroed frame.
+        for i in range(num_transitions):
+            memory.add([i + 1], i % 3, float(i), i in terminal_at)
+
+    def test_wraparound(self):
+        memory = ReplayMemory(5, (1,), batch_size=64)
+        self._fill(memory, 7)
+        self.assertEqual(len(memory), 5)
+        self.assertEqual(memory.top, 2)
+        numpy.testing.assert_array_equal(memory.frames[:, 0],
+                                         [6, 7, 3, 4, 5])
+
+        states, actions, rewards, next_states, terminals = memory.sample()
+        # Only transitions 2 to 5 are complete: transition 6 has no next
+        # frame yet and transition 1 was overwritten.
+        values = states[:, 0, 0]
+        self.assertTrue(set(values) <= set([3, 4, 5, 6]))
+        numpy.testing.assert_array_equal(next_states[:, 0, 0], values + 1)
+        numpy.testing.assert_array_equal(rewards, values - 1)
+
+    def test_history_across_the_wrap_and_episodes(self):
+        memory = ReplayMemory(6, (1,), history_length=2, batch_size=2)
+        self._fill(memory, 8, terminal_at=(4,))
+        # Transition 5 (slot 5) starts an episode, transition 6 (slot 0)
+        # stacks the frames of slots 5 and 0.
+        states, _, _, next_states, terminals = memory.take(
+            numpy.array([5, 0]))
+        numpy.testing.assert_array_equal(states[:, :, 0], [[0, 6], [6, 7]])
+        numpy.testing.assert_array_equal(next_states[:, :, 0],
+                                         [[6, 7], [7, 8]])
+        numpy.testing.assert_array_equal(terminals, [0, 0])
+
+    def test_current_states(self):
+        memory = ReplayMemory(6, (1,), history_length=3)
+        self._fill(memory, 2)
+        state = memory.get_current_state([9])
+        numpy.testing.assert_array_equal(state[:, 0], [1, 2, 9])
+
+        memory.add([3], 0, 0., True)
+        state = memory.get_current_state([9])
+        numpy.testing.assert_array_equal(state[:, 0], [0, 0, 9])
+
+
+class TestSumTree(unittest.TestCase):
+    def test_update(self):
+        tree = SumTree(5)
+        tree.update(numpy.arange(5), [1., 2., 3., 4., 5.])
+        self.assertEqual(tree.total(), 15.)
+        tree.update([1, 3], [0., 10.])
+        self.assertEqual(tree.total(), 19.)
+        numpy.testing.assert_array_equal(tree.get(numpy.arange(5)),
+                                         [1., 0., 3., 10., 5.])
+
+    def test_find(self):
+        tree = SumTree(4)
+        tree.update(numpy.arange(4), [1., 2., 3., 4.])
+        numpy.testing.assert_array_equal(
+            tree.find([0., 0.99, 1., 2.99, 3., 5.99, 6., 9.99]),
+            [0, 0, 1, 1, 2, 2, 3, 3])
+
+    def test_sampling_proportions(self):
+        priorities = numpy.array([1., 0., 2., 4., 1.])
+        tree = SumTree(len(priorities))
+        tree.update(numpy.arange(len(priorities)), priorities)
+        rng = numpy.random.RandomState(0)
+        leaves = tree.find(rng.uniform(0, tree.total(), size=100000))
+        counts = numpy.bincount(leaves, minlength=len(priorities))
+        self.assertEqual(len(counts), len(priorities))
+        numpy.testing.assert_allclose(counts / 100000.,
+                                      priorities / priorities.sum(),
+                                      atol=0.01)
+
+
+if __name__ == '__main__':
+    unittest.main()
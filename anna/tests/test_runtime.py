@@ -0,0 +1,114 @@
+import unittest
+
+import numpy
+
+from anna.inference import runtime
+
+
+def _conv_spec(order, filter_size, stride, pad, output_size, flip=False):
+    return {'inputs': [0], 'order': order, 'W': 'W', 'b': None,
+            'untie_biases': False, 'filter_size': [filter_size] * 2,
+            'stride': [stride] * 2, 'pad': [pad] * 2, 'flip': flip,
+            'output_size': [output_size] * 2, 'nonlinearity': 'identity'}
+
+
+def _reference_conv(x, W, stride, pad, output_size):
+    # Direct bc01 correlation: x (b, c, h, w), W (f, c, fh, fw).
+    b, c, h, w = x.shape
+    f, _, fh, fw = W.shape
+    padded = numpy.zeros((b, c, h + 2 * pad, w + 2 * pad))
+    padded[:, :, pad:pad + h, pad:pad + w] = x
+    out = numpy.zeros((b, f, output_size, output_size))
+    for i in range(output_size):
+        for j in range(output_size):
+            window = padded[:, :, i * stride:i * stride + fh,
+                            j * stride:j * stride + fw]
+            out[:, :, i, j] = numpy.tensordot(window, W,
+                                              axes=([1, 2, 3], [1, 2, 3]))
+    return out
+
+
+class TestConvOp(unittest.TestCase):
+    def setUp(self):
+        self.rng = numpy.random.RandomState(0)
+
+    def _check(self, stride, pad, size, output_size):
+        x = self.rng.randn(2, 3, size, size).astype(numpy.float32)
+        W = self.rng.randn(4, 3, 3, 3).astype(numpy.float32)
+        expected = _reference_conv(x, W, stride, pad, output_size)
+
+        # Theano layers convolve (flipped filters), in bc01.
+        op = runtime.ConvOp(_conv_spec('bc01', 3, stride, pad,
+                                       output_size, flip=True),
+                            {'W': W[:, :, ::-1, ::-1]})
+        numpy.testing.assert_allclose(op.forward(x), expected, rtol=1e-4,
+                                      atol=1e-4)
+
+        # cuda-convnet layers correlate, in c01b with W (c, fh, fw, f).
+        op = runtime.ConvOp(_conv_spec('c01b', 3, stride, pad,
+                                       output_size),
+                            {'W': W.transpose(1, 2, 3, 0)})
+        out = op.forward(x.transpose(1, 2, 3, 0))
+        numpy.testing.assert_allclose(out.transpose(3, 0, 1, 2), expected,
+                                      rtol=1e-4, atol=1e-4)
+
+    def test_im2col(self):
+        self._check(stride=1, pad=0, size=5, output_size=3)
+
+    def test_im2col_stride_and_pad(self):
+        self._check(stride=2, pad=1, size=6, output_size=3)
+
+
+class TestDeconvOp(unittest.TestCase):
+    def _check(self, stride, pad, size, output_size):
+        # The deconvolution (col2im) is the transpose of the c01b
+        # convolution with the same filters: <conv(x), y> = <x, deconv(y)>.
+        rng = numpy.random.RandomState(0)
+        W = rng.randn(3, 3, 3, 4).astype(numpy.float32)
+        conv = runtime.ConvOp(_conv_spec('c01b', 3, stride, pad,
+                                         output_size), {'W': W})
+        deconv = runtime.DeconvOp(
+            {'inputs': [0], 'W': 'W', 'b': None, 'untie_biases': False,
+             'stride': [stride] * 2, 'pad': [pad] * 2,
+             'output_size': [size] * 2, 'guided': False,
+             'nonlinearity': 'identity'}, {'W': W})
+
+        x = rng.randn(3, size, size, 2).astype(numpy.float32)
+        y = rng.randn(4, output_size, output_size, 2).astype(numpy.float32)
+        deconv_y = deconv.forward(y)
+        self.assertEqual(deconv_y.shape, x.shape)
+        numpy.testing.assert_allclose(numpy.sum(conv.forward(x) * y),
+                                      numpy.sum(x * deconv_y), rtol=1e-4)
+
+    def test_col2im(self):
+        self._check(stride=1, pad=1, size=6, output_size=6)
+
+    def test_col2im_stride(self):
+        self._check(stride=2, pad=0, size=7, output_size=3)
+
+
+class TestUnpoolOp(unittest.TestCase):
+    def test_routes_to_the_max(self):
+        rng = numpy.random.RandomState(0)
+        x = rng.randn(3, 4, 4, 2).astype(numpy.float32)
+        pool = runtime.MaxPoolOp({'inputs': [0], 'order': 'c01b',
+                                  'pool_size': [2, 2], 'stride': [2, 2],
+                                  'output_size': [2, 2],
+                                  'record_switches': True}, {})
+        unpool = runtime.UnpoolOp({'inputs': [1], 'pooling': 0,
+                                   'output_size': [4, 4]}, {})
+        unpool.link([pool])
+
+        pooled = pool.forward(x)
+        windows = x.reshape(3, 2, 2, 2, 2, 2).transpose(0, 1, 3, 5, 2, 4)
+        numpy.testing.assert_array_equal(pooled, windows.max(axis=(4, 5)))
+
+        # Unpooling the pooled output puts every max back where it was and
+        # zeros everywhere else.
+        is_max = x == pooled.repeat(2, axis=1).repeat(2, axis=2)
+        numpy.testing.assert_array_equal(unpool.forward(pooled),
+                                         numpy.where(is_max, x, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
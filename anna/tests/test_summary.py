@@ -0,0 +1,77 @@
+import unittest
+
+from anna.layers import layers, optimizers
+from anna.util import summary
+
+
+class SmallModel(object):
+    # Input 3x6x6, a 3x3 convolution to 5 features, 2x2 pooling and a
+    # dense layer of 10 units.
+    def __init__(self):
+        self.input = layers.Input2DLayer(4, 3, 6, 6)
+        self.conv = layers.Conv2DLayer(self.input, 5, 3, 0.1)
+        self.pool = layers.Pool2DLayer(self.conv, 2)
+        self.output = layers.DenseLayer(self.pool, 10, 0.1, 0.)
+        self.optimizer = optimizers.Momentum()
+
+    def _get_output_layer(self):
+        return self.output
+
+
+class TestSummary(unittest.TestCase):
+    def setUp(self):
+        self.model = SmallModel()
+
+    def test_summarize(self):
+        rows = summary.summarize(self.model)
+        self.assertEqual([row['name'] for row in rows],
+                         ['Input2DLayer', 'Conv2DLayer', 'Pool2DLayer',
+                          'DenseLayer'])
+        self.assertEqual([row['output_shape'] for row in rows],
+                         [(4, 3, 6, 6), (4, 5, 6, 6), (4, 5, 3, 3), (4, 10)])
+        self.assertEqual([row['params'] for row in rows],
+                         [0, 5 * 3 * 3 * 3, 0, 45 * 10 + 10])
+        self.assertEqual([row['trainable_params'] for row in rows],
+                         [0, 135, 0, 460])
+        self.assertEqual([row['activation_bytes'] for row in rows],
+                         [4 * 108, 4 * 180, 4 * 45, 4 * 10])
+        # A multiply-add per filter tap of every output, one comparison per
+        # pooled element and a multiply-add per weight.
+        self.assertEqual([row['forward_flops'] for row in rows],
+                         [0, 2 * 180 * 3 * 9, 45 * 4, 2 * 45 * 10])
+        self.assertEqual([row['backward_flops'] for row in rows],
+                         [0, 4 * 180 * 3 * 9, 45 * 4, 4 * 45 * 10])
+
+    def test_estimate_training_memory(self):
+        # Parameters, gradients and one momentum slot; every activation and
+        # the gradients of the two largest.
+        fixed = (595 + 595 * 2) * 4
+        per_sample = (108 + 180 + 45 + 10) * 4 + (180 + 108) * 4
+        self.assertEqual(summary.estimate_training_memory(self.model, 0),
+                         fixed)
+        self.assertEqual(summary.estimate_training_memory(self.model, 16),
+                         fixed + 16 * per_sample)
+
+    def test_plan_batch_size(self):
+        memory = summary.estimate_training_memory
+        self.assertEqual(summary.plan_batch_size(
+            self.model, memory(self.model, 40) + 1), 40)
+        self.assertEqual(summary.plan_batch_size(
+            self.model, memory(self.model, 40) - 1), 39)
+        self.assertEqual(summary.plan_batch_size(
+            self.model, memory(self.model, 40), multiple_of=16), 32)
+        self.assertEqual(summary.plan_batch_size(self.model, 100), None)
+        self.assertEqual(summary.plan_batch_size(
+            self.model, memory(self.model, 10 ** 6), max_batch_size=128),
+            128)
+
+    def test_plan_batch_size_of_fixed_batch_size_models(self):
+        # cuda-convnet layers need a multiple of 32.
+        self.model.conv.fixed_batch_size = True
+        self.assertEqual(summary.plan_batch_size(
+            self.model, summary.estimate_training_memory(self.model, 40)),
+            32)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,182 @@
+import os
+import glob
+import shutil
+import tempfile
+import unittest
+import cPickle
+
+import numpy
+
+from anna import util
+from anna.layers import layers
+from anna.models import SupervisedModel
+from anna.util.checkpoint_store import CheckpointStore
+from anna.datasets.supervised_dataset import SupervisedDataset
+
+
+class TinyModel(SupervisedModel):
+    def __init__(self, path):
+        self.input = layers.Input2DLayer(4, 1, 2, 2)
+        self.output = layers.DenseLayer(self.input, 3, 0.1, 0.,
+                                        nonlinearity=layers.softmax)
+        super(TinyModel, self).__init__('tiny', path, learning_rate=0.1)
+
+
+def _train(model, monitor, iterator, num_steps):
+    for i in range(num_steps):
+        monitor.start()
+        x_batch, y_batch = iterator.next()
+        cost, accuracy = model.train(x_batch, y_batch)
+        monitor.stop(cost)
+
+
+class TestMonitor(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        rng = numpy.random.RandomState(0)
+        self.dataset = SupervisedDataset(
+            rng.randn(20, 1, 2, 2).astype(numpy.float32),
+            rng.randint(0, 3, 20))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _build(self, name):
+        numpy.random.seed(0)
+        model = TinyModel(os.path.join(self.path, name))
+        iterator = self.dataset.iterator(mode='random_uniform', batch_size=4,
+                                         num_batches=100)
+        monitor = util.Monitor(model, short_steps=5, long_steps=3,
+                               save_steps=5, test_steps=1000,
+                               full_state=True, iterator=iterator)
+        return model, monitor, iterator
+
+    def _load_state(self, name, step_number):
+        for path in glob.glob(os.path.join(self.path, name, 'checkpoints',
+                                           '*-state.pkl')):
+            f = open(path, 'rb')
+            state = cPickle.load(f)
+            f.close()
+            if state['monitor']['step_number'] == step_number:
+                return path
+        self.fail('No training state of step %d.' % step_number)
+
+    def test_resume_matches_uninterrupted_run(self):
+        model, monitor, iterator = self._build('uninterrupted')
+        _train(model, monitor, iterator, 10)
+
+        interrupted_model, interrupted, iterator = self._build('interrupted')
+        _train(interrupted_model, interrupted, iterator, 6)
+
+        resumed_model, resumed, iterator = self._build('resumed')
+        util.load_training_state(resumed_model,
+                                 self._load_state('interrupted', 5),
+                                 monitor=resumed, iterator=iterator)
+        self.assertEqual(resumed.step_number, 6)
+        # Nothing of before the save is left over from the interrupted run.
+        self.assertEqual(resumed.errors, [])
+        _train(resumed_model, resumed, iterator, 4)
+
+        self.assertEqual(resumed.step_number, monitor.step_number)
+        numpy.testing.assert_allclose(resumed.errors, monitor.errors)
+        numpy.testing.assert_allclose(resumed.big_errors, monitor.big_errors)
+        for param, resumed_param in zip(
+                model.all_save_parameters_symbol,
+                resumed_model.all_save_parameters_symbol):
+            numpy.testing.assert_allclose(resumed_param.get_value(),
+                                          param.get_value(), rtol=1e-5)
+
+    def test_random_stream_count_mismatch(self):
+        model, monitor, iterator = self._build('streams')
+        util.save_training_state(model, 'checkpoints')
+        path, = glob.glob(os.path.join(self.path, 'streams', 'checkpoints',
+                                       '*-state.pkl'))
+        values = [param.get_value()
+                  for param in model.all_save_parameters_symbol]
+        model.output.W.set_value(values[0] + 1)
+
+        # A graph with one more random stream than at the save.
+        layers.srng.uniform((2,))
+        try:
+            self.assertRaises(ValueError, util.load_training_state, model,
+                              path)
+        finally:
+            layers.srng.state_updates.pop()
+        # Nothing was restored.
+        numpy.testing.assert_array_equal(model.output.W.get_value(),
+                                         values[0] + 1)
+
+    def test_checkpoint_store_gets_the_test_error_of_the_step(self):
+        model = TinyModel(self.path)
+        iterator = self.dataset.iterator(mode='random_uniform', batch_size=4,
+                                         num_batches=100)
+        store = CheckpointStore(os.path.join(self.path, 'store'),
+                                keep_last=10)
+        monitor = util.Monitor(model, save_steps=2, test_steps=2,
+                               checkpoint_store=store)
+        for step in range(6):
+            monitor.start()
+            x_batch, y_batch = iterator.next()
+            cost, accuracy = model.train(x_batch, y_batch)
+            monitor.stop(cost)
+            if monitor.test:
+                monitor.stop_test(step / 10.0)
+        self.assertEqual([(entry['step'], entry['test_error'])
+                          for entry in store.entries],
+                         [(0, 0.0), (2, 0.2), (4, 0.4)])
+
+    def test_step_budget(self):
+        model, monitor, iterator = self._build('budget')
+        monitor.max_steps = 7
+        tested = []
+        while not monitor.done:
+            monitor.start()
+            x_batch, y_batch = iterator.next()
+            cost, accuracy = model.train(x_batch, y_batch)
+            monitor.stop(cost)
+            if monitor.test:
+                tested.append(monitor.step_number - 1)
+                monitor.stop_test(len(tested) / 10.0)
+        # The budget step is tested although test_steps is 1000.
+        self.assertEqual(tested, [0, 7])
+        self.assertEqual(monitor.step_number, 8)
+
+        # The state saved at the budget holds the test error of that step.
+        f = open(self._load_state('budget', 7), 'rb')
+        state = cPickle.load(f)
+        f.close()
+        self.assertEqual(state['monitor']['last_test_error'], 0.2)
+        resumed_model, resumed, iterator = self._build('resumed')
+        util.load_training_state(resumed_model, self._load_state('budget', 7),
+                                 monitor=resumed)
+        self.assertEqual(resumed.step_number, 8)
+
+    def test_resume_from_checkpoint_store(self):
+        model, monitor, iterator = self._build('store')
+        store = CheckpointStore(os.path.join(self.path, 'store'),
+                                full_every=5)
+        values = [param.get_value()
+                  for param in model.all_save_parameters_symbol]
+        store.save(6, values)
+        store.save(7, [value + 1 for value in values])
+
+        resumed_model, resumed, iterator = self._build('resumed')
+        self.assertEqual(util.resume_from_arguments(
+            resumed_model, resumed, argv=['train.py', '--resume',
+                                          store.index_path]),
+            store.index_path)
+        # The parameters of the newest step, and the steps after it.
+        self.assertEqual(resumed.step_number, 8)
+        for param, value in zip(resumed_model.all_save_parameters_symbol,
+                                values):
+            numpy.testing.assert_array_equal(param.get_value(), value + 1)
+
+    def test_full_state_and_checkpoint_store(self):
+        model = TinyModel(self.path)
+        store = CheckpointStore(os.path.join(self.path, 'store'))
+        self.assertRaises(ValueError, util.Monitor, model, full_state=True,
+                          checkpoint_store=store)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,7 @@
 """Utils for training neural networks.
 """
 import os
+import sys
 import Image
 from time import time
 from datetime import datetime
@@ -17,7 +18,8 @@ from theano.sandbox.cuda.basic_ops import gpu_contiguous
 from pylearn2.sandbox.cuda_convnet.filter_acts import FilterActs
 
 from anna.layers import layers
-from anna.datasets import supervised_dataset
+from anna.util import evaluation
+from anna.util.checkpoint_store import CheckpointStore
 
 
 def load_checkpoint(model, checkpoint_path):
@@ -26,6 +28,10 @@ def load_checkpoint(model, checkpoint_path):
     checkpoint = cPickle.load(f)
     f.close()
 
+    # Training state checkpoints also hold the parameters.
+    if isinstance(checkpoint, dict):
+        checkpoint = checkpoint['parameters']
+
     [model_param.set_value(checkpoint_param)
      for model_param, checkpoint_param in zip(all_parameters, checkpoint)]
 
@@ -46,6 +52,140 @@ def save_checkpoint(model, checkpoint_directory_name):
     f.close()
 
 
+def _get_rstates():
+    # Random states of layers.srng, one per random graph built. Entries of
+    # state_updates start with the state, followed by its update (and in
+    # newer Theano versions the size and number of streams).
+    return [state_update[0] for state_update in layers.srng.state_updates]
+
+
+def save_training_state(model, checkpoint_directory_name, monitor=None,
+                        annealer=None, iterator=None):
+    """Saves everything needed to resume training exactly where it stopped.
+
+    Besides the model parameters this holds the optimizer buffers (momentum,
+    adagrad/rmsprop/adadelta accumulators), the learning rate, the numpy and
+    theano random states and, when given, the state of the monitor, annealer
+    and data iterator. Use load_training_state to resume from it.
+    """
+    state = {
+        'parameters': [param.get_value()
+                       for param in model.all_save_parameters_symbol],
+        'optimizer': [param.get_value()
+                      for param in model._get_optimizer_parameters_symbol()],
+        'learning_rate': model.learning_rate_symbol.get_value(),
+        'numpy_rng': numpy.random.get_state(),
+        'theano_rng': [rstate.get_value() for rstate in _get_rstates()]}
+    if monitor is not None:
+        state['monitor'] = monitor.get_state()
+    if annealer is not None:
+        state['annealer'] = annealer.get_state()
+    if iterator is not None:
+        state['iterator'] = iterator.get_state()
+
+    tt = datetime.now()
+    time_string = tt.strftime('%mm-%dd-%Hh-%Mm-%Ss')
+    checkpoint_name = '%s-%s-state.pkl' % (model.name, time_string)
+    checkpoint_path = os.path.join(model.path, checkpoint_directory_name,
+                                   checkpoint_name)
+
+    print 'Saving training state to: %s' % checkpoint_path
+    f = open(checkpoint_path, 'wb')
+    cPickle.dump(state, f, cPickle.HIGHEST_PROTOCOL)
+    f.close()
+
+
+def load_training_state(model, checkpoint_path, monitor=None, annealer=None,
+                        iterator=None):
+    """Restores a checkpoint written by save_training_state.
+
+    The model must be built the same way as the one that was saved, so that
+    its parameters, optimizer buffers and random streams line up. Random
+    streams are created as graphs using them (e.g. dropout) are built, so
+    those graphs must be built before loading. Raises ValueError if any of
+    their numbers differ.
+    """
+    f = open(checkpoint_path, 'rb')
+    state = cPickle.load(f)
+    f.close()
+
+    # Everything is checked before anything is restored.
+    parameters = model.all_save_parameters_symbol
+    optimizer_parameters = model._get_optimizer_parameters_symbol()
+    rstates = _get_rstates()
+    for description, variables, values in [
+            ('parameters', parameters, state['parameters']),
+            ('optimizer buffers', optimizer_parameters, state['optimizer']),
+            ('theano random streams', rstates, state['theano_rng'])]:
+        if len(variables) != len(values):
+            raise ValueError('Checkpoint has %d %s, model has %d.' %
+                             (len(values), description, len(variables)))
+
+    for param, value in zip(parameters, state['parameters']):
+        param.set_value(value)
+    for param, value in zip(optimizer_parameters, state['optimizer']):
+        param.set_value(value)
+
+    model.learning_rate_symbol.set_value(state['learning_rate'])
+    numpy.random.set_state(state['numpy_rng'])
+
+    for rstate, value in zip(rstates, state['theano_rng']):
+        rstate.set_value(value)
+
+    if monitor is not None and 'monitor' in state:
+        monitor.set_state(state['monitor'])
+    if annealer is not None and 'annealer' in state:
+        annealer.set_state(state['annealer'])
+    if iterator is not None and 'iterator' in state:
+        iterator.set_state(state['iterator'])
+
+
+def resume_from_arguments(model, monitor=None, annealer=None, iterator=None,
+                          argv=None):
+    """Resumes from the checkpoint passed as "--resume <path>" on the
+    command line, as anna/scripts/launcher.py does when it restarts a failed
+    run.
+
+    Training state checkpoints restore everything (see load_training_state),
+    parameter checkpoints only the parameters. The index file of a
+    CheckpointStore restores the parameters of its newest step, and the
+    monitor continues after that step. Returns the path, or None when the
+    script was not started with --resume.
+
+    The step budget of the monitor is set from ANNA_MAX_STEPS, as passed by
+    anna/scripts/sweep.py, with or without --resume.
+    """
+    if monitor is not None and os.environ.get('ANNA_MAX_STEPS'):
+        monitor.max_steps = int(os.environ['ANNA_MAX_STEPS'])
+    if argv is None:
+        argv = sys.argv
+    if '--resume' not in argv:
+        return None
+    checkpoint_path = argv[argv.index('--resume') + 1]
+
+    if checkpoint_path.endswith('-index.json'):
+        directory, file_name = os.path.split(checkpoint_path)
+        store = CheckpointStore(directory,
+                                name=file_name[:-len('-index.json')])
+        step = store.steps()[-1]
+        store.restore(model, step)
+        if monitor is not None:
+            monitor.step_number = step + 1
+        print 'Resumed from step %d of: %s' % (step, checkpoint_path)
+        return checkpoint_path
+
+    f = open(checkpoint_path, 'rb')
+    checkpoint = cPickle.load(f)
+    f.close()
+    if isinstance(checkpoint, dict):
+        load_training_state(model, checkpoint_path, monitor=monitor,
+                            annealer=annealer, iterator=iterator)
+    else:
+        load_checkpoint(model, checkpoint_path)
+    print 'Resumed from: %s' % checkpoint_path
+    return checkpoint_path
+
+
 def rescale(data):
     data = data / 2.0 * 255.0
     data[data > 255.0] = 255.0
@@ -385,11 +525,6 @@ class FilterVisualizerGrayscale(object):
 
 
 class Monitor(object):
-    errors = []
-    times = []
-    big_errors = []
-    big_times = []
-
     def __init__(self, model,
                  step_number=0,
                  best=1,
@@ -397,9 +532,18 @@ class Monitor(object):
                  long_steps=50,
                  save_steps=2000,
                  test_steps=50,
-                 checkpoint_directory='checkpoints'):
+                 checkpoint_directory='checkpoints',
+                 full_state=False,
+                 annealer=None,
+                 iterator=None,
+                 checkpoint_store=None,
+                 max_steps=None):
         self.step_number = step_number
         self.best = best
+        self.errors = []
+        self.times = []
+        self.big_errors = []
+        self.big_times = []
         self.short_steps = short_steps
         self.long_steps = long_steps
         self.save_steps = save_steps
@@ -407,6 +551,30 @@ class Monitor(object):
         self.test = False
         self.test_steps = test_steps
         self.checkpoint_directory = checkpoint_directory
+        # With full_state, checkpoints hold everything needed to resume
+        # (see save_training_state), not just the parameters.
+        self.full_state = full_state
+        self.annealer = annealer
+        self.iterator = iterator
+        # Optional checkpoint_store.CheckpointStore that replaces the full
+        # timestamped parameter pickles with full snapshots plus deltas.
+        if full_state and checkpoint_store is not None:
+            raise ValueError('Pass either full_state or checkpoint_store, '
+                             'not both.')
+        self.checkpoint_store = checkpoint_store
+        # (step_number, parameters) of a tested step, stored by stop_test
+        # together with its test error.
+        self.pending_snapshot = None
+        self.last_test_error = None
+        # Step budget, e.g. of a successive halving sweep (see
+        # anna/scripts/sweep.py): this step is tested and done is set, and
+        # stop_test saves the training state with the step's test error.
+        # Training loops run while not monitor.done.
+        self.max_steps = max_steps
+        self.done = False
+        self.pending_state = False
+        # Last completed step, the step a saved state resumes after.
+        self.last_step = step_number - 1
 
         # Check if model.path exists, if not create it
         # (with a checkpoint folder)
@@ -419,24 +587,42 @@ class Monitor(object):
 
     def stop_test(self, error):
         if self.test:
+            self.last_test_error = float(error)
             self.toc = time()
             _time = self.toc - self.tic
             print '&%d, test error: %.5f, time: %.2f' % (self.step_number,
                                                          error, _time)
+            if self.pending_snapshot is not None:
+                self._store_snapshot(self.last_test_error)
+            if self.pending_state:
+                self.pending_state = False
+                save_training_state(self.model, self.checkpoint_directory,
+                                    monitor=self, annealer=self.annealer,
+                                    iterator=self.iterator)
+
+    def _store_snapshot(self, test_error):
+        step_number, parameters = self.pending_snapshot
+        self.pending_snapshot = None
+        self.checkpoint_store.save(step_number, parameters,
+                                   test_error=test_error)
 
     def stop(self, error):
+        if self.pending_snapshot is not None:
+            # The previous step was not tested after all.
+            self._store_snapshot(None)
+        self.last_step = self.step_number
         self.toc = time()
         _time = self.toc - self.tic
         self.errors.append(error)
         self.times.append(_time)
         self.big_errors.append(error)
         self.big_times.append(_time)
-        if self.step_number % self.test_steps == 0:
+        budget_reached = (self.max_steps is not None and
+                          self.step_number >= self.max_steps)
+        if self.step_number % self.test_steps == 0 or budget_reached:
             self.test = True
         else:
             self.test = False
-        if self.step_number % self.save_steps == 0:
-            save_checkpoint(self.model, self.checkpoint_directory)
         if self.step_number % self.long_steps == 0:
             mean_error = numpy.mean(self.big_errors)
             mean_time = numpy.mean(self.big_times)
@@ -452,8 +638,51 @@ class Monitor(object):
                                                          mean_error, mean_time)
             self.errors = []
             self.times = []
+        # Saved after the flush, so that a resumed run continues with the
+        # buffers the uninterrupted run has at the next step.
+        if self.step_number % self.save_steps == 0:
+            if self.full_state:
+                # At the budget, stop_test saves it with the test error.
+                if not budget_reached:
+                    save_training_state(self.model,
+                                        self.checkpoint_directory,
+                                        monitor=self, annealer=self.annealer,
+                                        iterator=self.iterator)
+            elif self.checkpoint_store is not None:
+                self.pending_snapshot = (
+                    self.step_number,
+                    [param.get_value()
+                     for param in self.model.all_save_parameters_symbol])
+                if not self.test:
+                    self._store_snapshot(None)
+            else:
+                save_checkpoint(self.model, self.checkpoint_directory)
+        if budget_reached:
+            # Saved by stop_test, once this step's test error is known.
+            self.pending_state = True
+            print 'Reached the step budget of %d steps.' % self.max_steps
+            self.done = True
         self.step_number += 1
 
+    def get_state(self):
+        return {'step_number': self.last_step,
+                'best': self.best,
+                'last_test_error': self.last_test_error,
+                'errors': list(self.errors),
+                'times': list(self.times),
+                'big_errors': list(self.big_errors),
+                'big_times': list(self.big_times)}
+
+    def set_state(self, state):
+        self.last_step = state['step_number']
+        self.step_number = state['step_number'] + 1
+        self.best = state['best']
+        self.last_test_error = state.get('last_test_error')
+        self.errors = list(state['errors'])
+        self.times = list(state['times'])
+        self.big_errors = list(state['big_errors'])
+        self.big_times = list(state['big_times'])
+
 
 class Normer2(object):
     def __init__(self, filter_size=7, num_channels=3):
@@ -623,74 +852,21 @@ class Evaluator(object):
 
         # Load parameters from checkpoint
         load_checkpoint(self.model, self.checkpoint)
-        self._switch_off_dropout_flags()
 
     def run(self):
-        predictions = self._get_predictions()
-
-        # Compute accuracy
-        accuracy = (100.0 * numpy.sum(predictions == self.data_container.y)
-                    ) / len(self.data_container.y)
-
-        return accuracy
+        # Streams the test set through the model, see evaluation.
+        evaluator = evaluation.StreamingEvaluator(
+            self.model, [evaluation.Accuracy()],
+            self.preprocessor.module_list, batch_size=self.batch_size)
+        evaluator.update(self.data_container.X, self.data_container.y)
+        return 100.0 * evaluator.results()['accuracy']
 
     def set_checkpoint(self, checkpoint):
         self.checkpoint = checkpoint
         load_checkpoint(self.model, self.checkpoint)
-        self._switch_off_dropout_flags()
 
     def set_preprocessor(self, preprocessor_module_list):
-        self.preprocessor = Preprocessor(preproessor_module_list)
-
-    def _switch_off_dropout_flags(self):
-        # Switch off dropout flag (if present) in every layer
-        all_layers = layers.all_layers(self.model.output)
-        for layer in all_layers:
-            if hasattr(layer, 'dropout'):
-                layer.dropout = 0.0
-        # Re-compile the model
-        self.model._compile()
-
-    def _get_iterator(self):
-        dataset = supervised_dataset.SupervisedDataset(self.data_container.X,
-                                                       self.data_container.y)
-        iterator = dataset.iterator(mode='sequential',
-                                    batch_size=self.batch_size)
-        return iterator
-
-    def _get_predictions(self):
-        iterator = self._get_iterator()
-
-        # Compute accuracy on each training batch
-        predictions = []
-        for x_batch, y_batch in iterator:
-            x_batch = self.preprocessor.run(x_batch)
-            batch_pred = self.model.prediction(x_batch)
-            batch_pred = numpy.argmax(batch_pred, axis=1)
-            predictions.append(batch_pred)
-
-        # Classify last training batch
-        num_samples, num_channels, height, width = self.data_container.X.shape
-        last_batch_start_ind = numpy.floor(num_samples /
-                                           self.batch_size) * self.batch_size
-        last_batch_start_ind = int(last_batch_start_ind)
-        last_batch = self.data_container.X[last_batch_start_ind:, :, :, :]
-
-        dummy_batch = numpy.zeros((self.batch_size, num_channels, height,
-                                   width),
-                                  dtype=numpy.float32)
-        dummy_batch[0:last_batch.shape[0], :, :, :] = last_batch
-        dummy_batch = self.preprocessor.run(dummy_batch)
-        batch_pred = self.model.prediction(dummy_batch)
-        batch_pred = batch_pred[0:last_batch.shape[0], :]
-        batch_pred = numpy.argmax(batch_pred, axis=1)
-        predictions.append(batch_pred)
-
-        # Get all predictions
-        predictions = numpy.hstack(predictions)
-        # print predictions.shape
-
-        return predictions
+        self.preprocessor = Preprocessor(preprocessor_module_list)
 
 
 class Preprocessor(object):
@@ -984,5 +1160,17 @@ class Annealer(object):
     def get_current_learning_rate(self):
         return self.current_learning_rate
 
+    def get_state(self):
+        return {'step_count': self.step_count,
+                'epoch_count': self.epoch_count,
+                'init_learning_rate': self.init_learning_rate,
+                'current_learning_rate': self.current_learning_rate}
+
+    def set_state(self, state):
+        self.step_count = state['step_count']
+        self.epoch_count = state['epoch_count']
+        self.init_learning_rate = state['init_learning_rate']
+        self.current_learning_rate = state['current_learning_rate']
+
     def exp_decay(self, init_learning_rate, epoch_count):
         return init_learning_rate * (0.1)**(epoch_count)
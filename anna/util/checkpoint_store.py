@@ -0,0 +1,243 @@
+"""Checkpoint store that keeps periodic full snapshots plus compressed deltas.
+
+Every checkpoint is a list of arrays (e.g. the values of
+model.all_save_parameters_symbol). Every full_every-th checkpoint is written
+in full, the ones in between as the bitwise XOR against the last full
+snapshot. Consecutive parameter values share sign, exponent and the high
+bits of the mantissa, so the high bytes of the XOR are mostly zero. The
+low bytes stay noise: for float32 parameters that move by about 1e-3 of
+their magnitude between saves, a delta takes 70 to 75% of the space of a
+full snapshot, and zlib barely shrinks full snapshots (see
+test_checkpoint_store.py).
+A delta only depends on its full snapshot, so any retained step is rebuilt
+from two files.
+"""
+import os
+import json
+import zlib
+import cPickle
+from time import time
+
+import numpy
+
+
+def _bits(array):
+    # View the array as unsigned integers of the same width so it can be
+    # XORed bit for bit.
+    array = numpy.ascontiguousarray(array)
+    return array.view(numpy.dtype('u%d' % array.dtype.itemsize))
+
+
+def _pack(arrays):
+    # The bytes are stored by significance (byte shuffling): the high bytes
+    # of a delta are mostly zero and compress to almost nothing, instead of
+    # being interleaved with the noisy low bytes. The fourth field marks
+    # shuffled arrays.
+    packed = []
+    for array in arrays:
+        array = numpy.ascontiguousarray(array)
+        planes = array.reshape(-1).view(numpy.uint8).reshape(
+            -1, array.dtype.itemsize).T
+        packed.append((array.dtype.str, array.shape, zlib.compress(
+            numpy.ascontiguousarray(planes).tostring(), 6), True))
+    return packed
+
+
+def _unpack(packed):
+    arrays = []
+    for item in packed:
+        dtype, shape, data = item[:3]
+        data = zlib.decompress(data)
+        if len(item) > 3:
+            planes = numpy.fromstring(data, dtype=numpy.uint8).reshape(
+                numpy.dtype(dtype).itemsize, -1)
+            data = numpy.ascontiguousarray(planes.T).tostring()
+        arrays.append(numpy.fromstring(data, dtype=dtype).reshape(shape))
+    return arrays
+
+
+class CheckpointStore(object):
+    def __init__(self, directory, name='checkpoint', full_every=10,
+                 keep_last=5, keep_every_hours=6.0, keep_best=True):
+        """
+        full_every: write a full snapshot every full_every saves, deltas
+        against it in between.
+        keep_last: number of most recent checkpoints to retain (0 to
+        retain only what the other rules keep).
+        keep_every_hours: additionally retain the first checkpoint of every
+        window of this many hours (None to disable).
+        keep_best: additionally retain the checkpoint with the lowest test
+        error.
+        """
+        self.directory = directory
+        self.name = name
+        self.full_every = full_every
+        self.keep_last = keep_last
+        self.keep_every_hours = keep_every_hours
+        self.keep_best = keep_best
+
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+        self.index_path = os.path.join(self.directory, '%s-index.json' % name)
+        self.entries = []
+        # Counts every save, including the ones retention removed, so that
+        # full snapshots keep coming every full_every saves.
+        self.num_saves = 0
+        if os.path.exists(self.index_path):
+            f = open(self.index_path, 'r')
+            index = json.load(f)
+            f.close()
+            if isinstance(index, list):
+                # Index without a save counter.
+                index = {'entries': index,
+                         'num_saves': (index[-1]['index'] + 1 if index
+                                       else 0)}
+            self.entries = index['entries']
+            self.num_saves = index['num_saves']
+
+        # Cache of the last full snapshot, the reference for new deltas.
+        self._base_step = None
+        self._base_bits = None
+
+    def steps(self):
+        return [entry['step'] for entry in self.entries]
+
+    def best_step(self):
+        scored = [entry for entry in self.entries
+                  if entry['test_error'] is not None]
+        if not scored:
+            return None
+        return min(scored, key=lambda entry: entry['test_error'])['step']
+
+    def save(self, step, arrays, test_error=None):
+        arrays = [numpy.asarray(array) for array in arrays]
+        save_index = self.num_saves
+        self.num_saves += 1
+        base = self._get_base_entry()
+        is_full = (base is None or save_index % self.full_every == 0 or
+                   not self._matches_base(arrays))
+
+        if is_full:
+            filename = '%s-%08d-full.pkl' % (self.name, step)
+            payload = _pack(arrays)
+            self._base_step = step
+            self._base_bits = [_bits(array).copy() for array in arrays]
+            base_step = None
+        else:
+            filename = '%s-%08d-delta.pkl' % (self.name, step)
+            base_bits = self._get_base_bits(base)
+            payload = _pack([_bits(array) ^ bits
+                             for array, bits in zip(arrays, base_bits)])
+            base_step = base['step']
+
+        path = os.path.join(self.directory, filename)
+        print 'Saving model checkpoint to: %s' % path
+        f = open(path, 'wb')
+        cPickle.dump(payload, f, cPickle.HIGHEST_PROTOCOL)
+        f.close()
+
+        self.entries.append({'step': step,
+                             'index': save_index,
+                             'file': filename,
+                             'base': base_step,
+                             'time': time(),
+                             'test_error': test_error})
+        self._apply_retention()
+        self._write_index()
+
+    def load(self, step):
+        """Rebuilds the arrays of a retained step."""
+        entry = self._get_entry(step)
+        arrays = self._read(entry)
+        if entry['base'] is None:
+            return arrays
+
+        base_arrays = self._read(self._get_entry(entry['base']))
+        return [(_bits(base) ^ delta).view(base.dtype)
+                for base, delta in zip(base_arrays, arrays)]
+
+    def restore(self, model, step=None):
+        """Sets the model parameters to those of step (default: newest)."""
+        if step is None:
+            step = self.entries[-1]['step']
+        for param, value in zip(model.all_save_parameters_symbol,
+                                self.load(step)):
+            param.set_value(value)
+
+    def _read(self, entry):
+        f = open(os.path.join(self.directory, entry['file']), 'rb')
+        packed = cPickle.load(f)
+        f.close()
+        return _unpack(packed)
+
+    def _get_entry(self, step):
+        for entry in self.entries:
+            if entry['step'] == step:
+                return entry
+        raise ValueError('Step %d is not in the checkpoint store.' % step)
+
+    def _get_base_entry(self):
+        for entry in reversed(self.entries):
+            if entry['base'] is None:
+                return entry
+        return None
+
+    def _get_base_bits(self, base):
+        if self._base_step != base['step']:
+            self._base_step = base['step']
+            self._base_bits = [_bits(array) for array in self._read(base)]
+        return self._base_bits
+
+    def _matches_base(self, arrays):
+        base_bits = self._get_base_bits(self._get_base_entry())
+        return (len(base_bits) == len(arrays) and
+                all(bits.shape == array.shape and
+                    bits.dtype.itemsize == array.dtype.itemsize
+                    for bits, array in zip(base_bits, arrays)))
+
+    def _apply_retention(self):
+        keep = set()
+        if self.keep_last > 0:
+            keep.update(entry['step']
+                        for entry in self.entries[-self.keep_last:])
+
+        if self.keep_every_hours is not None:
+            window = self.keep_every_hours * 3600.0
+            start = self.entries[0]['time']
+            seen_windows = set()
+            for entry in self.entries:
+                window_index = int((entry['time'] - start) / window)
+                if window_index not in seen_windows:
+                    seen_windows.add(window_index)
+                    keep.add(entry['step'])
+
+        if self.keep_best:
+            best = self.best_step()
+            if best is not None:
+                keep.add(best)
+
+        # Deltas need their full snapshot, and the newest full snapshot is
+        # the reference for the next delta.
+        keep.update(entry['base'] for entry in self.entries
+                    if entry['step'] in keep and entry['base'] is not None)
+        keep.add(self._get_base_entry()['step'])
+
+        retained = []
+        for entry in self.entries:
+            if entry['step'] in keep:
+                retained.append(entry)
+            else:
+                path = os.path.join(self.directory, entry['file'])
+                if os.path.exists(path):
+                    os.remove(path)
+        self.entries = retained
+
+    def _write_index(self):
+        # Write then rename, so a crash never leaves a truncated index.
+        tmp_path = self.index_path + '.tmp'
+        f = open(tmp_path, 'w')
+        json.dump({'num_saves': self.num_saves, 'entries': self.entries}, f,
+                  indent=1)
+        f.close()
+        os.rename(tmp_path, self.index_path)
@@ -0,0 +1,126 @@
+"""Evaluates many checkpoints of a model with a single compilation.
+
+The test set is split into minibatches, preprocessed and kept in memory
+once (see StreamingEvaluator.prepare). Each checkpoint is then evaluated by
+loading its parameter values into the shared variables of the model
+(set_value, no recompilation) and running the cached minibatches through
+the compiled prediction function.
+
+    sweep = CheckpointSweep(model, X_test, y_test, preprocessor_module_list)
+    results = sweep.run(checkpoint_paths, num_workers=4)
+    best_path, best = max(results, key=lambda item: item[1]['accuracy'])
+    ensemble_results = sweep.ensemble(checkpoint_paths[-5:])
+
+With num_workers > 1 the checkpoints are spread over forked worker
+processes, which inherit the cached test set and the prediction function,
+compiled when the sweep is built. The model must then be compiled for the
+CPU (e.g. THEANO_FLAGS=device=cpu), a CUDA context does not survive a fork.
+"""
+import multiprocessing
+
+from anna import util
+from anna.util import evaluation
+
+# The sweep run by forked workers.
+_worker_sweep = None
+
+
+def _evaluate_in_worker(checkpoint):
+    return _worker_sweep.evaluate(checkpoint)
+
+
+def _summed_outputs_in_worker(checkpoints):
+    return _worker_sweep._summed_outputs(checkpoints)
+
+
+class CheckpointSweep(object):
+    def __init__(self, model, X, y=None, preprocessor_module_list=(),
+                 metrics=None, batch_size=None, dropout_active=False):
+        """
+        X, y: test set, as for StreamingEvaluator.update.
+        metrics: list of evaluation.Metric, reset for every checkpoint
+        (default: evaluation.default_metrics(model)).
+        """
+        self.model = model
+        self.evaluator = evaluation.StreamingEvaluator(
+            model, metrics, preprocessor_module_list, batch_size=batch_size,
+            dropout_active=dropout_active)
+        self.batches = list(self.evaluator.prepare(X, y))
+        # Compiled here, before any worker is forked.
+        model._select('prediction_func', dropout_active)
+
+    def evaluate(self, checkpoint):
+        """Metrics of the model with the parameters of one checkpoint."""
+        util.load_checkpoint(self.model, checkpoint)
+        self.evaluator.reset()
+        for batch, target in self.batches:
+            self.evaluator.update_outputs(
+                self.evaluator.predict(batch, len(target)), target)
+        return self.evaluator.results()
+
+    def run(self, checkpoints, num_workers=1):
+        """List of (checkpoint, results) in the order of checkpoints."""
+        if num_workers > 1:
+            results = self._map(_evaluate_in_worker, checkpoints, num_workers)
+        else:
+            with _RestoreParameters(self.model):
+                results = [self.evaluate(checkpoint)
+                           for checkpoint in checkpoints]
+        return zip(checkpoints, results)
+
+    def ensemble(self, checkpoints, num_workers=1):
+        """Metrics of the average prediction of the checkpoints."""
+        if num_workers > 1:
+            shards = [checkpoints[i::num_workers] for i in range(num_workers)]
+            shards = [shard for shard in shards if shard]
+            partial_sums = self._map(_summed_outputs_in_worker, shards,
+                                     len(shards))
+            sums = [sum(outputs) for outputs in zip(*partial_sums)]
+        else:
+            with _RestoreParameters(self.model):
+                sums = self._summed_outputs(checkpoints)
+
+        self.evaluator.reset()
+        for summed, (batch, target) in zip(sums, self.batches):
+            self.evaluator.update_outputs(summed / len(checkpoints), target)
+        return self.evaluator.results()
+
+    def _summed_outputs(self, checkpoints):
+        # Sum over checkpoints of the output of every cached minibatch.
+        sums = None
+        for checkpoint in checkpoints:
+            util.load_checkpoint(self.model, checkpoint)
+            outputs = [self.evaluator.predict(batch, len(target))
+                       for batch, target in self.batches]
+            if sums is None:
+                sums = [output.astype('float64') for output in outputs]
+            else:
+                for summed, output in zip(sums, outputs):
+                    summed += output
+        return sums
+
+    def _map(self, function, items, num_workers):
+        global _worker_sweep
+        _worker_sweep = self
+        pool = multiprocessing.Pool(num_workers)
+        try:
+            return pool.map(function, items, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+            _worker_sweep = None
+
+
+class _RestoreParameters(object):
+    # Puts the model's own parameters back after a sweep in this process.
+    def __init__(self, model):
+        self.model = model
+
+    def __enter__(self):
+        self.values = [param.get_value()
+                       for param in self.model.all_save_parameters_symbol]
+
+    def __exit__(self, *exc_info):
+        for param, value in zip(self.model.all_save_parameters_symbol,
+                                self.values):
+            param.set_value(value)
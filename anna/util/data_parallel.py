@@ -0,0 +1,272 @@
+"""Data-parallel training on the CPU with several processes.
+
+Every replica is a forked process with its own copy of the model, trained on
+its own shard of the data. The replicas are kept in sync through buffers in
+shared memory:
+
+- synchronous, average='gradients': every step the replicas compute their
+  gradients, average them (each replica averages one slice of the buffer)
+  and apply the same optimizer update, so their parameters stay identical.
+- synchronous, average='parameters': every replica trains with its own
+  optimizer and the parameters are averaged every sync_every steps.
+- asynchronous (Hogwild): the parameters live in shared memory. Every
+  sync_every steps a replica adds the change of its parameters since its
+  last sync to the shared parameters, without locking, and continues from
+  the result.
+
+    def make_model():
+        return MyModel()
+
+    def make_iterator(rank, num_replicas):
+        return dataset.iterator(mode='random_uniform', batch_size=128,
+                                num_batches=100000, rng_seed=rank)
+
+    trainer = DataParallelTrainer(make_model, make_iterator, num_replicas=4)
+    stats = trainer.train(10000)
+    model = trainer.model
+
+Theano reads OMP_NUM_THREADS when it is imported, set it to the number of
+cores divided by num_replicas before starting the script. See
+anna/scripts/data_parallel_benchmark.py for the scaling curve of a model.
+"""
+import time
+import Queue
+import multiprocessing
+
+import numpy
+import theano
+import theano.tensor as T
+
+GRADIENTS = 'gradients'
+PARAMETERS = 'parameters'
+
+
+def get_flat_parameters(params):
+    return numpy.concatenate([
+        param.get_value(borrow=True).ravel() for param in params])
+
+
+def set_flat_parameters(params, flat):
+    offset = 0
+    for param in params:
+        value = param.get_value(borrow=True)
+        param.set_value(flat[offset:offset + value.size].reshape(
+            value.shape).astype(value.dtype))
+        offset += value.size
+
+
+def _shared_array(shape):
+    # Of the dtype of the parameters, so that float64 models lose nothing
+    # on the way through the buffers.
+    dtype = numpy.dtype(theano.config.floatX)
+    raw = multiprocessing.RawArray(dtype.char, int(numpy.prod(shape)))
+    return numpy.frombuffer(raw, dtype=dtype).reshape(shape)
+
+
+class _Barrier(object):
+    # multiprocessing has no Barrier in Python 2.
+    def __init__(self, parties):
+        self.parties = parties
+        self.condition = multiprocessing.Condition()
+        self.count = multiprocessing.RawValue('i', 0)
+        self.generation = multiprocessing.RawValue('i', 0)
+
+    def wait(self):
+        with self.condition:
+            generation = self.generation.value
+            self.count.value += 1
+            if self.count.value == self.parties:
+                self.count.value = 0
+                self.generation.value += 1
+                self.condition.notify_all()
+            else:
+                while generation == self.generation.value:
+                    self.condition.wait()
+
+
+class _GradientStep(object):
+    # The training step of a model split in two functions: the gradients
+    # (flattened into one vector) and the optimizer update from a given
+    # gradient vector.
+    def __init__(self, model):
+        params = model.all_trainable_parameters_symbol
+        outputs = model._get_train_outputs_symbol()
+        if not isinstance(outputs, (list, tuple)):
+            outputs = [outputs]
+        grads = theano.grad(model._get_cost_symbol(), params)
+        flat_grad = T.concatenate([grad.flatten() for grad in grads])
+        self.grad_func = theano.function(model._get_train_inputs_symbol(),
+                                         list(outputs) + [flat_grad])
+
+        sizes = [param.get_value(borrow=True).size for param in params]
+        self.grad = theano.shared(numpy.zeros(sum(sizes),
+                                              dtype=theano.config.floatX))
+        split_grads = []
+        offset = 0
+        for param, size in zip(params, sizes):
+            split_grads.append(T.patternbroadcast(
+                self.grad[offset:offset + size].reshape(param.shape,
+                                                        ndim=param.ndim),
+                param.broadcastable))
+            offset += size
+        updates = model.optimizer.get_updates_from_grads(
+            split_grads, params, model.learning_rate_symbol)
+        self.apply_func = theano.function([], [], updates=updates)
+
+
+class DataParallelTrainer(object):
+    def __init__(self, model_factory, iterator_factory, num_replicas=None,
+                 synchronous=True, average=GRADIENTS, sync_every=1):
+        """
+        model_factory: builds the model, called once in this process and
+        once in every replica.
+        iterator_factory(rank, num_replicas): the iterator of one replica,
+        yielding the arguments of model.train.
+        sync_every: steps between two synchronizations (average=PARAMETERS
+        and asynchronous training only).
+        """
+        if num_replicas is None:
+            num_replicas = multiprocessing.cpu_count()
+        if average not in (GRADIENTS, PARAMETERS):
+            raise ValueError('average must be %r or %r' % (GRADIENTS,
+                                                            PARAMETERS))
+        self.model_factory = model_factory
+        self.iterator_factory = iterator_factory
+        self.num_replicas = num_replicas
+        self.synchronous = synchronous
+        self.average = average
+        self.sync_every = sync_every
+
+        # Holds the initial parameters, and the result after train.
+        self.model = model_factory()
+        params = self.model.all_save_parameters_symbol
+        self.num_parameters = sum(param.get_value(borrow=True).size
+                                  for param in params)
+        num_trainable = sum(
+            param.get_value(borrow=True).size
+            for param in self.model.all_trainable_parameters_symbol)
+        row_size = (num_trainable if average == GRADIENTS
+                    else self.num_parameters)
+
+        self.parameters = _shared_array(self.num_parameters)
+        # One row per replica, and the average, double buffered so that a
+        # replica can start averaging the next step while a slower one is
+        # still reading the previous average.
+        self.rows = _shared_array((num_replicas, row_size))
+        self.averaged = _shared_array((2, row_size))
+        self.barrier = _Barrier(num_replicas)
+
+    def train(self, num_steps):
+        """Trains every replica for num_steps steps, leaves the result in
+        self.model and returns throughput statistics.
+        """
+        self.parameters[:] = get_flat_parameters(
+            self.model.all_save_parameters_symbol)
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(
+            target=self._run_replica, args=(rank, num_steps, results))
+            for rank in range(self.num_replicas)]
+        for process in processes:
+            process.daemon = True
+            process.start()
+
+        replica_stats = []
+        while len(replica_stats) < self.num_replicas:
+            try:
+                replica_stats.append(results.get(timeout=1))
+            except Queue.Empty:
+                if any(process.exitcode not in (None, 0)
+                       for process in processes):
+                    for process in processes:
+                        process.terminate()
+                    raise RuntimeError('A replica failed.')
+        for process in processes:
+            process.join()
+
+        set_flat_parameters(self.model.all_save_parameters_symbol,
+                            self.parameters)
+        samples = sum(stats['samples'] for stats in replica_stats)
+        elapsed = max(stats['elapsed'] for stats in replica_stats)
+        return {'num_replicas': self.num_replicas,
+                'samples': samples,
+                'elapsed': elapsed,
+                'samples_per_second': samples / elapsed,
+                'replicas': sorted(replica_stats,
+                                   key=lambda stats: stats['rank'])}
+
+    def _run_replica(self, rank, num_steps, results):
+        model = self.model_factory()
+        set_flat_parameters(model.all_save_parameters_symbol,
+                            self.parameters)
+        iterator = self.iterator_factory(rank, self.num_replicas)
+
+        # Compile before the clock starts.
+        if self.synchronous and self.average == GRADIENTS:
+            step = _GradientStep(model)
+            train = self._gradient_step(rank, step)
+        else:
+            train = self._local_step(rank, model)
+        self.barrier.wait()
+
+        start = time.time()
+        outputs = []
+        for i in range(num_steps):
+            batch = next(iterator)
+            if not isinstance(batch, (list, tuple)):
+                batch = [batch]
+            outputs.append(train(i, batch, i == num_steps - 1))
+        elapsed = time.time() - start
+
+        # The replicas all hold the same parameters after a synchronous run.
+        if self.synchronous and rank == 0:
+            self.parameters[:] = get_flat_parameters(
+                model.all_save_parameters_symbol)
+        results.put({'rank': rank,
+                     'samples': num_steps * model.input.mb_size,
+                     'elapsed': elapsed,
+                     'outputs': numpy.mean(outputs, axis=0)})
+
+    def _average_rows(self, rank, phase):
+        # Every replica averages one slice of the rows.
+        size = self.rows.shape[1]
+        begin = size * rank // self.num_replicas
+        end = size * (rank + 1) // self.num_replicas
+        self.averaged[phase, begin:end] = self.rows[:, begin:end].mean(axis=0)
+
+    def _gradient_step(self, rank, step):
+        def train(i, batch, last):
+            outputs = step.grad_func(*batch)
+            self.rows[rank] = outputs.pop()
+            self.barrier.wait()
+            self._average_rows(rank, i % 2)
+            self.barrier.wait()
+            step.grad.set_value(self.averaged[i % 2])
+            step.apply_func()
+            return outputs
+        return train
+
+    def _local_step(self, rank, model):
+        params = model.all_save_parameters_symbol
+        model.train_func  # compiles it
+        state = {'syncs': 0, 'last': self.parameters.copy()}
+
+        def train(i, batch, last):
+            outputs = model.train_func(*batch)
+            if (i + 1) % self.sync_every and not last:
+                return outputs
+            current = get_flat_parameters(params)
+            if self.synchronous:
+                phase = state['syncs'] % 2
+                self.rows[rank] = current
+                self.barrier.wait()
+                self._average_rows(rank, phase)
+                self.barrier.wait()
+                set_flat_parameters(params, self.averaged[phase])
+            else:
+                # Lock-free: concurrent additions may be lost (Hogwild).
+                self.parameters += current - state['last']
+                state['last'] = self.parameters.copy()
+                set_flat_parameters(params, state['last'])
+            state['syncs'] += 1
+            return outputs
+        return train
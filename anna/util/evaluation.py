@@ -0,0 +1,261 @@
+"""Streaming evaluation of a model over a dataset in fixed memory.
+
+Every minibatch goes through the model's compiled prediction function once
+and each metric folds the outputs into a few running sums, so nothing grows
+with the size of the dataset.
+
+    evaluator = evaluation.StreamingEvaluator(model)
+    evaluator.update(X_test, y_test)
+    print evaluator.results()
+
+The default metrics depend on the model: loss, accuracy, top-5 accuracy,
+the confusion matrix and per-class recall for SupervisedModel and
+ForkModel, MSE/RMSE for RegressionModel and the reconstruction error for
+UnsupervisedModel.
+"""
+import numpy
+
+from anna.layers import layers
+from anna import models
+
+
+class Metric(object):
+    def reset(self):
+        raise NotImplementedError(str(type(self)) +
+                                  " does not implement reset.")
+
+    def update(self, output, target):
+        """Adds a batch, both arrays have the batch on the first axis."""
+        raise NotImplementedError(str(type(self)) +
+                                  " does not implement update.")
+
+    def result(self):
+        """Dict of metric name to value."""
+        raise NotImplementedError(str(type(self)) +
+                                  " does not implement result.")
+
+
+class CrossEntropy(Metric):
+    # Same as the cost of SupervisedModel, from the softmax output.
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.total = 0.
+        self.count = 0
+
+    def update(self, output, target):
+        probabilities = output[numpy.arange(len(target)), target]
+        self.total -= numpy.sum(numpy.log(probabilities), dtype=numpy.float64)
+        self.count += len(target)
+
+    def result(self):
+        return {'loss': self.total / max(self.count, 1)}
+
+
+class Accuracy(Metric):
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.correct = 0
+        self.count = 0
+
+    def update(self, output, target):
+        self.correct += numpy.sum(numpy.argmax(output, axis=1) == target)
+        self.count += len(target)
+
+    def result(self):
+        return {'accuracy': float(self.correct) / max(self.count, 1)}
+
+
+class TopKAccuracy(Metric):
+    def __init__(self, k=5):
+        self.k = k
+        self.reset()
+
+    def reset(self):
+        self.correct = 0
+        self.count = 0
+
+    def update(self, output, target):
+        top_k = numpy.argsort(-output, axis=1)[:, :self.k]
+        self.correct += numpy.sum(top_k == target[:, None])
+        self.count += len(target)
+
+    def result(self):
+        return {'top_%d_accuracy' % self.k:
+                float(self.correct) / max(self.count, 1)}
+
+
+class ConfusionMatrix(Metric):
+    # Rows are true classes, columns predicted classes.
+    def __init__(self, n_classes):
+        self.n_classes = n_classes
+        self.reset()
+
+    def reset(self):
+        self.matrix = numpy.zeros((self.n_classes, self.n_classes),
+                                  dtype=numpy.int64)
+
+    def update(self, output, target):
+        predicted = numpy.argmax(output, axis=1)
+        self.matrix += numpy.bincount(
+            target.astype(numpy.int64) * self.n_classes + predicted,
+            minlength=self.n_classes ** 2).reshape(self.matrix.shape)
+
+    def result(self):
+        # nan for classes without samples.
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            recall = (numpy.diag(self.matrix) /
+                      self.matrix.sum(axis=1).astype(numpy.float64))
+        return {'confusion_matrix': self.matrix.copy(),
+                'per_class_recall': recall}
+
+
+class SquaredError(Metric):
+    # Mean over every element, same as the cost of RegressionModel.
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.total = 0.
+        self.count = 0
+
+    def update(self, output, target):
+        self.total += numpy.sum((output - target) ** 2, dtype=numpy.float64)
+        self.count += output.size
+
+    def result(self):
+        mse = self.total / max(self.count, 1)
+        return {'mse': mse, 'rmse': numpy.sqrt(mse)}
+
+
+class ReconstructionError(Metric):
+    # Summed over each sample and averaged over samples, same as the cost
+    # of UnsupervisedModel.
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.total = 0.
+        self.count = 0
+
+    def update(self, output, target):
+        self.total += numpy.sum((output - target) ** 2, dtype=numpy.float64)
+        self.count += len(output)
+
+    def result(self):
+        return {'reconstruction_error': self.total / max(self.count, 1)}
+
+
+def default_metrics(model):
+    if isinstance(model, (models.SupervisedModel, models.ForkModel)):
+        n_classes = model._get_output_layer().get_output_shape()[1]
+        metrics = [CrossEntropy(), Accuracy()]
+        if n_classes > 5:
+            metrics.append(TopKAccuracy(5))
+        metrics.append(ConfusionMatrix(n_classes))
+        return metrics
+    if isinstance(model, models.RegressionModel):
+        return [SquaredError()]
+    if isinstance(model, models.UnsupervisedModel):
+        return [ReconstructionError()]
+    raise ValueError('No default metrics for %s, pass them explicitly.' %
+                     type(model).__name__)
+
+
+def _slice(array, axis, start, stop):
+    index = [slice(None)] * array.ndim
+    index[axis] = slice(start, stop)
+    return array[tuple(index)]
+
+
+class StreamingEvaluator(object):
+    def __init__(self, model, metrics=None, preprocessor_module_list=(),
+                 batch_size=None, dropout_active=False):
+        """
+        metrics: list of Metric (default: default_metrics(model)).
+        batch_size: samples per compiled call (default: the model's
+        mb_size). The last batch holds the remaining samples, except for
+        models with cuda-convnet layers, which only run batches of the
+        compiled size: there it is padded with zeros.
+        """
+        self.model = model
+        if metrics is None:
+            metrics = default_metrics(model)
+        self.metrics = metrics
+        self.preprocessor_module_list = preprocessor_module_list
+        if batch_size is None:
+            batch_size = model.input.mb_size
+        self.batch_size = batch_size
+        self.dropout_active = dropout_active
+        self.input_axis = layers.get_batch_axis(model.input)
+        self.output_axis = layers.get_batch_axis(model._get_output_layer())
+        self.pad = layers.has_fixed_batch_size(model._get_output_layer())
+        # Unsupervised models are scored against their (preprocessed) input.
+        self.reconstruction = isinstance(model, models.UnsupervisedModel)
+
+    def reset(self):
+        for metric in self.metrics:
+            metric.reset()
+
+    def update(self, x_batch, y_batch=None):
+        """Adds any number of samples, in minibatches of batch_size."""
+        for batch, target in self.prepare(x_batch, y_batch):
+            self.update_outputs(self.predict(batch, len(target)), target)
+
+    def prepare(self, x_batch, y_batch=None):
+        """Yields every minibatch preprocessed (and padded to batch_size
+        for cuda-convnet models), with its targets (batch first, only the
+        real samples).
+        """
+        total = x_batch.shape[self.input_axis]
+        for start in range(0, total, self.batch_size):
+            stop = min(start + self.batch_size, total)
+            batch = _slice(x_batch, self.input_axis, start, stop)
+            n = stop - start
+            if self.pad and n < self.batch_size:
+                # Padding is preprocessed with the batch, and skews batch
+                # statistics, so only where the layers need it.
+                padding = list(batch.shape)
+                padding[self.input_axis] = self.batch_size - n
+                batch = numpy.concatenate(
+                    [batch, numpy.zeros(padding, dtype=batch.dtype)],
+                    axis=self.input_axis)
+            for module in self.preprocessor_module_list:
+                batch = module.run(batch)
+
+            if self.reconstruction:
+                target = numpy.rollaxis(
+                    _slice(batch, self.input_axis, 0, n), self.input_axis)
+            else:
+                target = numpy.asarray(y_batch[start:stop])
+            yield batch, target
+
+    def predict(self, batch, n):
+        """Output of the first n samples of a prepared batch, batch first."""
+        func = self.model._select('prediction_func', self.dropout_active)
+        output = _slice(func(batch), self.output_axis, 0, n)
+        return numpy.rollaxis(output, self.output_axis)
+
+    def update_outputs(self, output, target):
+        for metric in self.metrics:
+            metric.update(output, target)
+
+    def run(self, iterator):
+        """Adds every batch of an iterator of (x, y) pairs, or of x for
+        unsupervised models, and returns the results.
+        """
+        for batch in iterator:
+            if self.reconstruction:
+                self.update(batch)
+            else:
+                self.update(*batch)
+        return self.results()
+
+    def results(self):
+        results = {}
+        for metric in self.metrics:
+            results.update(metric.result())
+        return results
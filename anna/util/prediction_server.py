@@ -0,0 +1,389 @@
+"""Local prediction server batching requests for model.prediction.
+
+Clients send samples over a Unix socket or TCP (127.0.0.1 by default). The
+server queues the requests and a single worker thread packs them into
+minibatches of the model's mb_size, waiting at most max_latency seconds after
+the oldest queued request for the batch to fill. Every batch runs through the
+compiled prediction function, and the rows of the output are scattered back
+to the requests. A partial batch is only padded with zeros to mb_size for
+models with cuda-convnet layers, which need the batch size they were built
+for.
+
+Layers normalizing with the statistics of their batch (DenseBatchNormLayer,
+ConvBatchNormLayer) make a sample's prediction depend on the other samples
+it was batched with, and so on the timing of other clients' requests. For
+reproducible predictions from such models, use max_latency=0 and send
+requests of exactly batch_size samples.
+
+Every message is a length-prefixed JSON header, followed by the raw bytes of
+an array if the header gives its dtype and shape. Nothing received is ever
+unpickled.
+
+Checkpoints are swapped in with load_checkpoint between two batches,
+reusing the compiled function. Clients can only load checkpoints by name
+from the checkpoint_directory given to the server, and not at all if it has
+none.
+
+    server = PredictionServer(model, '/tmp/anna.sock',
+                              checkpoint_directory='checkpoints')
+    server.serve_forever()
+
+    client = PredictionClient('/tmp/anna.sock')
+    predictions = client.predict(x)
+    client.load_checkpoint('model-10000.pkl')
+"""
+import os
+import time
+import socket
+import struct
+import threading
+import SocketServer
+import Queue
+import json
+from collections import deque
+
+import numpy
+
+from anna import util
+from anna.layers import layers
+
+_HEADER = struct.Struct('!I')
+# Longest JSON header accepted.
+_MAX_HEADER_SIZE = 1 << 16
+
+
+def _send(sock, header, array=None):
+    # header: dict sent as JSON, array: numpy array sent as raw bytes after
+    # it.
+    header = dict(header)
+    if array is not None:
+        array = numpy.ascontiguousarray(array)
+        header['dtype'] = array.dtype.str
+        header['shape'] = list(array.shape)
+    data = json.dumps(header)
+    sock.sendall(_HEADER.pack(len(data)) + data)
+    if array is not None:
+        sock.sendall(array.data)
+
+
+def _receive_exactly(sock, size):
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(min(size, 1 << 20))
+        if not chunk:
+            raise EOFError('Connection closed.')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+
+def _receive(sock):
+    # Returns the header and the array that follows it (or None).
+    size, = _HEADER.unpack(_receive_exactly(sock, _HEADER.size))
+    if size > _MAX_HEADER_SIZE:
+        raise ValueError('Header of %d bytes is too long.' % size)
+    header = json.loads(_receive_exactly(sock, size))
+    if not isinstance(header, dict):
+        raise ValueError('The header must be a JSON object.')
+    if 'dtype' not in header:
+        return header, None
+    dtype = numpy.dtype(str(header['dtype']))
+    if dtype.hasobject:
+        raise ValueError('Arrays of objects cannot be sent.')
+    shape = tuple(int(n) for n in header['shape'])
+    data = _receive_exactly(sock, int(numpy.prod(shape)) * dtype.itemsize)
+    return header, numpy.frombuffer(data, dtype=dtype).reshape(shape)
+
+
+def _get_address(address):
+    # A port alone listens on (or connects to) 127.0.0.1.
+    if address is None:
+        return ('127.0.0.1', 0)
+    if isinstance(address, (int, long)):
+        return ('127.0.0.1', address)
+    return address
+
+
+class _Request(object):
+    def __init__(self, samples):
+        self.samples = samples
+        self.arrival = time.time()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class _Handler(SocketServer.BaseRequestHandler):
+    def handle(self):
+        server = self.server.prediction_server
+        while True:
+            try:
+                header, array = _receive(self.request)
+            except (EOFError, ValueError):
+                # Closed, or not speaking the protocol.
+                return
+            try:
+                command = header.get('command')
+                if command == 'predict':
+                    if array is None:
+                        raise ValueError('predict needs samples.')
+                    _send(self.request, {'status': 'ok'},
+                          server.predict(array))
+                elif command == 'load':
+                    _send(self.request, {
+                        'status': 'ok',
+                        'result': server.load_named_checkpoint(
+                            header.get('name'))})
+                elif command == 'stats':
+                    _send(self.request, {'status': 'ok',
+                                         'result': server.get_stats()})
+                else:
+                    raise ValueError('Unknown command %r' % command)
+            except Exception, e:
+                _send(self.request, {'status': 'error', 'message': str(e)})
+
+
+class _TCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _UnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+class PredictionServer(object):
+    def __init__(self, model, address=None, max_latency=0.005,
+                 batch_size=None, dropout_active=False, num_latencies=10000,
+                 checkpoint_directory=None):
+        """
+        address: path of a Unix socket, a port on 127.0.0.1, or (host, port)
+        for TCP (default: a free port on 127.0.0.1, see self.address).
+        max_latency: longest time in seconds a request waits for its batch
+        to fill before a partial batch is run.
+        batch_size: samples per compiled call (default: the model's
+        mb_size).
+        checkpoint_directory: directory clients may load checkpoints from,
+        by file name. None disables remote loading.
+        """
+        self.model = model
+        self.max_latency = max_latency
+        if batch_size is None:
+            batch_size = model.input.mb_size
+        self.batch_size = batch_size
+        self.dropout_active = dropout_active
+        self.input_axis = layers.get_batch_axis(model.input)
+        self.output_axis = layers.get_batch_axis(model._get_output_layer())
+        self.pad = layers.has_fixed_batch_size(model._get_output_layer())
+        # Shape and dtype of one sample, to check requests against.
+        self.sample_shape = list(model.input.get_output_shape())
+        del self.sample_shape[self.input_axis]
+        self.dtype = numpy.dtype(model.input.input_var.dtype)
+
+        self.queue = Queue.Queue()
+        # Held while a batch runs or a checkpoint is loaded.
+        self.model_lock = threading.Lock()
+        self.stats_lock = threading.Lock()
+        self.latencies = deque(maxlen=num_latencies)
+        self.num_requests = 0
+        self.num_samples = 0
+        self.num_batches = 0
+        self.checkpoint = None
+        self.checkpoint_directory = checkpoint_directory
+
+        # Compile before accepting requests.
+        self.model._select('prediction_func', dropout_active)
+
+        if isinstance(address, basestring):
+            if os.path.exists(address):
+                os.remove(address)
+            self.server = _UnixServer(address, _Handler)
+        else:
+            self.server = _TCPServer(_get_address(address), _Handler)
+        self.server.prediction_server = self
+        self.address = self.server.server_address
+
+        self.worker = threading.Thread(target=self._run_batches)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def shutdown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def predict(self, samples):
+        """Queues samples (model input layout, any number of them) and
+        waits for their predictions.
+        """
+        samples = numpy.asarray(samples)
+        # Checked here, as a bad request would fail the whole batch it is
+        # concatenated into.
+        shape = list(samples.shape)
+        if len(shape) == len(self.sample_shape) + 1:
+            del shape[self.input_axis]
+        else:
+            shape = None
+        if shape != self.sample_shape:
+            raise ValueError('Expected samples of shape %s, got an array of '
+                             'shape %s.' % (tuple(self.sample_shape),
+                                            samples.shape))
+        if not numpy.can_cast(samples.dtype, self.dtype):
+            raise ValueError('Expected samples of dtype %s, got %s.' %
+                             (self.dtype, samples.dtype))
+        request = _Request(samples.astype(self.dtype, copy=False))
+        self.queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def load_checkpoint(self, path):
+        """Swaps in the parameters of a checkpoint between two batches."""
+        with self.model_lock:
+            util.load_checkpoint(self.model, path)
+            self.checkpoint = path
+        return path
+
+    def load_named_checkpoint(self, name):
+        """Loads the checkpoint file name of checkpoint_directory, for
+        remote clients.
+        """
+        if self.checkpoint_directory is None:
+            raise ValueError('This server does not load checkpoints.')
+        if (not isinstance(name, basestring) or
+                os.path.basename(name) != name or name in ('', '.', '..')):
+            raise ValueError('Invalid checkpoint name %r' % (name,))
+        path = os.path.join(self.checkpoint_directory, name)
+        if not os.path.isfile(path):
+            raise ValueError('No checkpoint named %r' % (name,))
+        self.load_checkpoint(path)
+        return name
+
+    def get_stats(self):
+        with self.stats_lock:
+            latencies = numpy.array(self.latencies)
+            stats = {'queue_depth': self.queue.qsize(),
+                     'requests': self.num_requests,
+                     'samples': self.num_samples,
+                     'batches': self.num_batches,
+                     'checkpoint': self.checkpoint}
+        if self.num_batches:
+            stats['mean_batch_fill'] = (float(self.num_samples) /
+                                        (self.num_batches * self.batch_size))
+        for percentile in (50, 90, 99):
+            stats['latency_p%d' % percentile] = (
+                numpy.percentile(latencies, percentile)
+                if len(latencies) else None)
+        return stats
+
+    def _num_samples(self, request):
+        return request.samples.shape[self.input_axis]
+
+    def _collect(self):
+        # Blocks for the first request, then takes more until the batch is
+        # full or the oldest request has waited max_latency.
+        requests = [self.queue.get()]
+        total = self._num_samples(requests[0])
+        deadline = requests[0].arrival + self.max_latency
+        while total < self.batch_size:
+            timeout = deadline - time.time()
+            try:
+                if timeout > 0:
+                    request = self.queue.get(timeout=timeout)
+                else:
+                    request = self.queue.get_nowait()
+            except Queue.Empty:
+                break
+            requests.append(request)
+            total += self._num_samples(request)
+        return requests
+
+    def _run_batches(self):
+        while True:
+            requests = self._collect()
+            try:
+                outputs = self._predict(numpy.concatenate(
+                    [r.samples for r in requests], axis=self.input_axis))
+                offset = 0
+                for request in requests:
+                    n = self._num_samples(request)
+                    rows = numpy.arange(offset, offset + n)
+                    request.result = outputs.take(rows,
+                                                  axis=self.output_axis)
+                    offset += n
+            except Exception, e:
+                for request in requests:
+                    request.error = e
+
+            finished = time.time()
+            with self.stats_lock:
+                for request in requests:
+                    self.latencies.append(finished - request.arrival)
+                    self.num_samples += self._num_samples(request)
+                self.num_requests += len(requests)
+            for request in requests:
+                request.done.set()
+
+    def _predict(self, samples):
+        # Runs the samples in minibatches of batch_size, padding the last
+        # only for models that need it.
+        axis = self.input_axis
+        total = samples.shape[axis]
+        func = self.model._select('prediction_func', self.dropout_active)
+        outputs = []
+        for start in range(0, total, self.batch_size):
+            batch = samples.take(
+                numpy.arange(start, min(start + self.batch_size, total)),
+                axis=axis)
+            n = batch.shape[axis]
+            if self.pad and n < self.batch_size:
+                padding = list(batch.shape)
+                padding[axis] = self.batch_size - n
+                batch = numpy.concatenate(
+                    [batch, numpy.zeros(padding, dtype=batch.dtype)],
+                    axis=axis)
+            with self.model_lock:
+                output = func(batch)
+            with self.stats_lock:
+                self.num_batches += 1
+            outputs.append(output.take(numpy.arange(n),
+                                       axis=self.output_axis))
+        return numpy.concatenate(outputs, axis=self.output_axis)
+
+
+class PredictionClient(object):
+    def __init__(self, address):
+        """address: as given to PredictionServer."""
+        if isinstance(address, basestring):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            address = _get_address(address)
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.connect(address)
+
+    def close(self):
+        self.sock.close()
+
+    def _call(self, header, array=None):
+        _send(self.sock, header, array)
+        header, array = _receive(self.sock)
+        if header['status'] != 'ok':
+            raise RuntimeError(header['message'])
+        if array is not None:
+            return array
+        return header.get('result')
+
+    def predict(self, samples):
+        return self._call({'command': 'predict'}, numpy.asarray(samples))
+
+    def load_checkpoint(self, name):
+        """Loads the checkpoint file name of the server's
+        checkpoint_directory.
+        """
+        return self._call({'command': 'load', 'name': name})
+
+    def stats(self):
+        return self._call({'command': 'stats'})
@@ -0,0 +1,126 @@
+"""Acting for ReinforcementModel.
+
+BatchedActor steps several environments together: one action_func call
+selects the actions of all of them, and their transitions go straight into
+a ReplayMemory created with num_streams equal to the number of environments.
+
+An environment is any object with reset() returning the first observation
+and step(action) returning (observation, reward, terminal), like
+ChainEnvironment below.
+"""
+import numpy
+import theano
+
+
+class ChainEnvironment(object):
+    """Tiny deterministic environment: walk along a chain of length cells
+    from the left end to the right end, which gives reward 1 and ends the
+    episode. Action 0 moves left, action 1 moves right. Observations are the
+    one-hot position. Useful to test agents, a greedy policy on a trained
+    model reaches the end in length - 1 steps.
+    """
+    num_actions = 2
+
+    def __init__(self, length=8, max_steps=None):
+        self.length = length
+        self.frame_shape = (length,)
+        if max_steps is None:
+            max_steps = 4 * length
+        self.max_steps = max_steps
+        self.position = 0
+        self.steps = 0
+
+    def reset(self):
+        self.position = 0
+        self.steps = 0
+        return self._observation()
+
+    def step(self, action):
+        if action == 1:
+            self.position = min(self.position + 1, self.length - 1)
+        else:
+            self.position = max(self.position - 1, 0)
+        self.steps += 1
+
+        reached = self.position == self.length - 1
+        reward = 1.0 if reached else 0.0
+        terminal = reached or self.steps >= self.max_steps
+        return self._observation(), reward, terminal
+
+    def _observation(self):
+        observation = numpy.zeros(self.length, dtype=numpy.uint8)
+        observation[self.position] = 1
+        return observation
+
+
+def _to_float(states):
+    return states.astype(theano.config.floatX)
+
+
+class BatchedActor(object):
+    def __init__(self, model, environments, replay_memory, epsilon=1.0,
+                 preprocess=_to_float, rng_seed=0):
+        """
+        model: ReinforcementModel choosing the greedy actions.
+        environments: list of environments stepped together.
+        replay_memory: ReplayMemory with num_streams == len(environments).
+        epsilon: probability of a random action, can be annealed by setting
+        the attribute.
+        preprocess: maps a batch of stacked states from the replay memory
+        to the model's input (e.g. cast to float, transpose to c01b).
+        """
+        if replay_memory.num_streams != len(environments):
+            raise ValueError('The replay memory needs one stream per '
+                             'environment.')
+        self.model = model
+        self.environments = environments
+        self.memory = replay_memory
+        self.epsilon = epsilon
+        self.preprocess = preprocess
+        self.rng = numpy.random.RandomState(rng_seed)
+
+        self.frames = numpy.array([env.reset() for env in environments])
+        self.returns = numpy.zeros(len(environments))
+        self.episode_returns = []
+        self.num_steps = 0
+
+    def select_actions(self, states):
+        """Epsilon-greedy actions for a batch of stacked states."""
+        n = len(states)
+        actions = self.rng.randint(self.model.action_dims, size=n)
+        greedy = self.rng.uniform(size=n) >= self.epsilon
+        if greedy.any():
+            best = self.model.action_index(self.preprocess(states))
+            actions[greedy] = best[greedy]
+        return actions
+
+    def step(self):
+        """Steps every environment once and stores the transitions.
+        Returns the actions, rewards and terminal flags.
+        """
+        states = self.memory.get_current_states(self.frames)
+        actions = self.select_actions(states)
+
+        next_frames = numpy.empty_like(self.frames)
+        rewards = numpy.zeros(len(self.environments), dtype=numpy.float32)
+        terminals = numpy.zeros(len(self.environments), dtype=numpy.bool_)
+        for i, env in enumerate(self.environments):
+            next_frames[i], rewards[i], terminals[i] = env.step(actions[i])
+            if terminals[i]:
+                next_frames[i] = env.reset()
+
+        self.memory.add_batch(self.frames, actions, rewards, terminals)
+        self.frames = next_frames
+        self.num_steps += len(self.environments)
+
+        self.returns += rewards
+        self.episode_returns.extend(self.returns[terminals])
+        self.returns[terminals] = 0
+        return actions, rewards, terminals
+
+    def run(self, num_steps):
+        """Steps the environments until num_steps transitions were added."""
+        num_batches = int(numpy.ceil(float(num_steps) /
+                                     len(self.environments)))
+        for _ in range(num_batches):
+            self.step()
@@ -0,0 +1,274 @@
+"""Experience replay for ReinforcementModel.
+
+Transitions live in a ring buffer of preallocated numpy arrays. Frame i is
+the observation action i was taken from; reward i and terminal i follow that
+action. A state is the stack of the last history_length frames, and the next
+state of transition i is the stack ending at frame i + 1, so stacked frames
+are assembled by index arithmetic at sampling time and every frame is stored
+once.
+
+With num_streams > 1 the memory interleaves the transitions of several
+environments stepped together (see util.reinforcement.BatchedActor): every
+add_batch writes one transition per stream, so consecutive frames of a
+stream are num_streams slots apart.
+"""
+import numpy
+
+
+class ReplayMemory(object):
+    def __init__(self, capacity, frame_shape, history_length=1,
+                 frame_dtype=numpy.uint8, batch_size=32, num_streams=1,
+                 rng_seed=0):
+        """
+        capacity: number of transitions kept; the oldest are overwritten.
+        frame_shape: shape of a single observation, e.g. (84, 84).
+        history_length: number of consecutive frames stacked into a state.
+        batch_size: size of the minibatches returned by sample.
+        num_streams: number of environments stored interleaved.
+        """
+        if capacity % num_streams != 0:
+            raise ValueError('capacity must be a multiple of num_streams.')
+        self.capacity = capacity
+        self.frame_shape = tuple(frame_shape)
+        self.history_length = history_length
+        self.num_streams = num_streams
+        self.batch_size = batch_size
+        self.rng = numpy.random.RandomState(rng_seed)
+
+        self.frames = numpy.zeros((capacity,) + self.frame_shape,
+                                  dtype=frame_dtype)
+        self.actions = numpy.zeros(capacity, dtype=numpy.int64)
+        self.rewards = numpy.zeros(capacity, dtype=numpy.float32)
+        self.terminals = numpy.zeros(capacity, dtype=numpy.bool_)
+        self.top = 0
+        self.size = 0
+
+        # Reused by every call to sample.
+        state_shape = (batch_size, history_length) + self.frame_shape
+        self.states_buffer = numpy.zeros(state_shape, dtype=frame_dtype)
+        self.next_states_buffer = numpy.zeros(state_shape, dtype=frame_dtype)
+        self.actions_buffer = numpy.zeros(batch_size, dtype=numpy.int64)
+        self.rewards_buffer = numpy.zeros(batch_size, dtype=numpy.float32)
+        self.terminals_buffer = numpy.zeros(batch_size, dtype=numpy.float32)
+        self._offsets = numpy.arange(-history_length + 1, 1) * num_streams
+
+    def __len__(self):
+        return self.size
+
+    def add(self, frame, action, reward, terminal):
+        """Stores the frame an action was taken from and its outcome
+        (single stream memories).
+        """
+        self.add_batch([frame], [action], [reward], [terminal])
+
+    def add_batch(self, frames, actions, rewards, terminals):
+        """Stores one transition of every stream. Returns the slots written.
+        """
+        rows = numpy.arange(self.top, self.top + self.num_streams)
+        self.frames[rows] = frames
+        self.actions[rows] = actions
+        self.rewards[rows] = rewards
+        self.terminals[rows] = terminals
+        self.top = (self.top + self.num_streams) % self.capacity
+        self.size = min(self.size + self.num_streams, self.capacity)
+        return rows
+
+    def num_samplable(self):
+        # A transition needs a full history before it and its next frame
+        # after it.
+        return max(self.size - self.history_length * self.num_streams, 0)
+
+    def sample_indices(self, batch_size=None):
+        """Indices of batch_size transitions drawn uniformly."""
+        if batch_size is None:
+            batch_size = self.batch_size
+        if self.num_samplable() < 1:
+            raise ValueError('Not enough transitions in the replay memory.')
+        oldest = (self.top - self.size) % self.capacity
+        relative = self.rng.randint(
+            (self.history_length - 1) * self.num_streams,
+            self.size - self.num_streams, size=batch_size)
+        return (oldest + relative) % self.capacity
+
+    def sample(self):
+        """Uniform minibatch of (states, actions, rewards, next_states,
+        terminals). States have shape (batch_size, history_length) +
+        frame_shape. The arrays are reused by the next call, copy them to
+        keep them.
+        """
+        return self.take(self.sample_indices())
+
+    def take(self, indices):
+        """Gathers the transitions at indices into the reusable buffers."""
+        self._stack(indices, self.states_buffer)
+        self._stack((indices + self.num_streams) % self.capacity,
+                    self.next_states_buffer)
+        numpy.take(self.actions, indices, out=self.actions_buffer)
+        numpy.take(self.rewards, indices, out=self.rewards_buffer)
+        self.terminals_buffer[:] = self.terminals[indices]
+        return (self.states_buffer, self.actions_buffer, self.rewards_buffer,
+                self.next_states_buffer, self.terminals_buffer)
+
+    def get_current_states(self, frames):
+        """The states to act on from frames, a new observation of every
+        stream that is not stored yet: each frame stacked after the previous
+        frames of its episode.
+        """
+        frames = numpy.asarray(frames)
+        states = numpy.zeros((len(frames), self.history_length) +
+                             self.frame_shape, dtype=self.frames.dtype)
+        states[:, -1] = frames
+        if self.history_length > 1 and self.size > 0:
+            last = (self.top - self.num_streams +
+                    numpy.arange(self.num_streams)) % self.capacity
+            previous = numpy.zeros_like(states)
+            self._stack(last, previous)
+            # Streams whose last transition ended an episode start afresh.
+            previous[self.terminals[last]] = 0
+            states[:, :-1] = previous[:, 1:]
+        return states
+
+    def get_current_state(self, frame):
+        return self.get_current_states([frame])[0]
+
+    def _stack(self, indices, out):
+        window = (indices[:, None] + self._offsets[None, :]) % self.capacity
+        numpy.take(self.frames, window, axis=0, out=out, mode='clip')
+        if self.history_length == 1:
+            return
+
+        # Frames before the last terminal inside the window belong to an
+        # earlier episode and are zeroed.
+        ended = self.terminals[window[:, :-1]]
+        earlier = numpy.logical_or.accumulate(ended[:, ::-1], axis=1)[:, ::-1]
+        rows, columns = numpy.nonzero(earlier)
+        out[rows, columns] = 0
+
+
+class SumTree(object):
+    """Binary tree of sums over leaf priorities, stored in one array.
+
+    Node i has children 2i and 2i + 1, the leaves start at self.num_leaves.
+    Updates and sampling are vectorized over a batch of leaves and take
+    O(log n) numpy operations.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.depth = int(numpy.ceil(numpy.log2(max(capacity, 2))))
+        self.num_leaves = 2 ** self.depth
+        self.tree = numpy.zeros(2 * self.num_leaves, dtype=numpy.float64)
+
+    def total(self):
+        return self.tree[1]
+
+    def get(self, indices):
+        return self.tree[self.num_leaves + indices]
+
+    def update(self, indices, priorities):
+        nodes = self.num_leaves + numpy.asarray(indices, dtype=numpy.int64)
+        self.tree[nodes] = priorities
+        for _ in range(self.depth):
+            nodes = numpy.unique(nodes // 2)
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def find(self, values):
+        """Leaves at which the cumulative priority reaches values."""
+        values = numpy.array(values, dtype=numpy.float64)
+        nodes = numpy.ones(len(values), dtype=numpy.int64)
+        for _ in range(self.depth):
+            left = self.tree[2 * nodes]
+            right = values >= left
+            values -= left * right
+            nodes = 2 * nodes + right
+        return nodes - self.num_leaves
+
+
+class PrioritizedReplayMemory(ReplayMemory):
+    """Replay memory sampling transitions with probability proportional to
+    priority ** alpha, where the priority is the absolute TD error of the
+    transition's last update. New transitions get the highest priority seen
+    so far, so every transition is replayed at least once.
+    """
+    def __init__(self, capacity, frame_shape, alpha=0.6, beta=0.4,
+                 epsilon=1e-6, **kwargs):
+        """
+        alpha: how much prioritization is used (0 is uniform).
+        beta: exponent of the importance weights correcting the bias of the
+        prioritized sampling, usually annealed to 1 over training.
+        epsilon: added to TD errors so no transition gets priority 0.
+        """
+        super(PrioritizedReplayMemory, self).__init__(capacity, frame_shape,
+                                                      **kwargs)
+        self.alpha = alpha
+        self.beta = beta
+        self.epsilon = epsilon
+        self.max_priority = 1.0
+        self.tree = SumTree(capacity)
+        self.weights_buffer = numpy.zeros(self.batch_size,
+                                          dtype=numpy.float32)
+
+    def add_batch(self, frames, actions, rewards, terminals):
+        rows = super(PrioritizedReplayMemory, self).add_batch(
+            frames, actions, rewards, terminals)
+        # Only transitions that have a full history and a next frame can be
+        # sampled: the new ones become samplable with the next batch, the
+        # previous ones now, and when full, the ones whose history start was
+        # just overwritten no longer are.
+        streams = self.num_streams
+        history = (self.history_length - 1) * streams
+        oldest = (self.top - self.size) % self.capacity
+        previous = (rows - streams) % self.capacity
+        indices = [rows]
+        priorities = [numpy.zeros(streams)]
+        if (self.size > streams and
+                (previous[0] - oldest) % self.capacity >= history):
+            indices.append(previous)
+            priorities.append(numpy.repeat(self.max_priority ** self.alpha,
+                                           streams))
+        if self.size == self.capacity and self.history_length > 1:
+            indices.append((oldest + history - streams +
+                            numpy.arange(streams)) % self.capacity)
+            priorities.append(numpy.zeros(streams))
+        self.tree.update(numpy.concatenate(indices),
+                         numpy.concatenate(priorities))
+
+    def sample_indices(self, batch_size=None):
+        """Indices of batch_size transitions drawn by priority, one from
+        each of batch_size equal slices of the total priority.
+        """
+        if batch_size is None:
+            batch_size = self.batch_size
+        if self.num_samplable() < 1:
+            raise ValueError('Not enough transitions in the replay memory.')
+        segment = self.tree.total() / batch_size
+        values = (numpy.arange(batch_size) +
+                  self.rng.uniform(size=batch_size)) * segment
+        indices = self.tree.find(values)
+        # Rounding can end the descent on an empty leaf, replace those by
+        # another draw of the batch.
+        empty = self.tree.get(indices) <= 0
+        if empty.all():
+            return super(PrioritizedReplayMemory, self).sample_indices(
+                batch_size)
+        indices[empty] = indices[~empty][0]
+        return indices
+
+    def sample(self):
+        """Like ReplayMemory.sample, followed by the indices of the
+        transitions (for update_priorities) and their importance weights.
+        """
+        indices = self.sample_indices()
+        transitions = self.take(indices)
+
+        probabilities = self.tree.get(indices) / self.tree.total()
+        weights = (self.num_samplable() * probabilities) ** -self.beta
+        self.weights_buffer[:] = weights / weights.max()
+        return transitions + (indices, self.weights_buffer)
+
+    def update_priorities(self, indices, td_errors):
+        """Sets the priorities of the sampled transitions from the TD errors
+        returned by ReinforcementModel.train_step.
+        """
+        priorities = numpy.abs(td_errors) + self.epsilon
+        self.max_priority = max(self.max_priority, priorities.max())
+        self.tree.update(indices, priorities ** self.alpha)
@@ -0,0 +1,177 @@
+"""Model summary: per layer parameters, activation sizes and FLOPs, and an
+estimate of training memory to pick the batch size before compiling.
+
+    summary.print_summary(model, batch_size=128)
+    batch_size = summary.plan_batch_size(model, 4 * 1024 ** 3)
+
+Everything is computed from get_output_shape and the parameter shapes, no
+Theano function is built. FLOPs count a multiply-add as two operations,
+pooling counts one operation per compared element. The memory estimate
+assumes every activation is kept for the backward pass and is meant for
+planning, not as an exact figure.
+"""
+import numpy
+
+from anna.layers import layers, cc_layers
+
+_FLOAT_BYTES = 4
+
+
+def _unique_layers(output_layer):
+    # Input first, each layer once (branches of a fork share layers).
+    seen = set()
+    unique = []
+    for layer in reversed(layers.all_layers(output_layer)):
+        if id(layer) not in seen:
+            seen.add(id(layer))
+            unique.append(layer)
+    return unique
+
+
+def _param_count(layer):
+    count = 0
+    for param in getattr(layer, 'params', []):
+        count += param.get_value(borrow=True,
+                                 return_internal_type=True).size
+    return count
+
+
+def _per_sample_size(layer):
+    shape = list(layer.get_output_shape())
+    del shape[layers.get_batch_axis(layer)]
+    return int(numpy.prod(shape))
+
+
+def _forward_flops(layer):
+    """FLOPs of one sample through the layer."""
+    output_size = _per_sample_size(layer)
+    if isinstance(layer, (layers.DenseLayer, layers.DenseNoBiasLayer)):
+        return 2 * layer.n_inputs * layer.n_outputs
+    if isinstance(layer, (layers.Conv2DLayer, cc_layers.Conv2DLayer,
+                          cc_layers.Conv2DNoBiasLayer)):
+        return 2 * output_size * layer.n_channels * layer.filter_size ** 2
+    if isinstance(layer, (cc_layers.Deconv2DLayer,
+                          cc_layers.DeconvUntied2DLayer,
+                          cc_layers.Deconv2DNoBiasLayer)):
+        # The transpose of the mirrored convolution costs the same.
+        input_size = _per_sample_size(layer.input_layer)
+        return 2 * input_size * layer.n_channels * layer.filter_size ** 2
+    if isinstance(layer, layers.Pool2DLayer):
+        return output_size * layer.filter_size ** 2
+    if isinstance(layer, cc_layers.Pooling2DLayer):
+        return output_size * layer.pool_size ** 2
+    if isinstance(layer, layers.PoolingLayer):
+        return output_size * layer.ds_factor
+    if isinstance(layer, (layers.GlobalPooling2DLayer,
+                          cc_layers.Unpooling2DLayer)):
+        return _per_sample_size(layer.input_layer)
+    return 0
+
+
+def _backward_flops(layer, forward_flops):
+    # Layers with weights compute the gradient for their input and for
+    # their weights, each about as expensive as the forward pass.
+    if getattr(layer, 'trainable', False) and _param_count(layer):
+        return 2 * forward_flops
+    return forward_flops
+
+
+def summarize(model):
+    """One dict per layer, input first, with the keys name, output_shape,
+    params, activation_bytes (per sample), forward_flops and
+    backward_flops (per sample) and trainable_params.
+    """
+    rows = []
+    for layer in _unique_layers(model._get_output_layer()):
+        forward = _forward_flops(layer)
+        params = _param_count(layer)
+        rows.append({
+            'name': type(layer).__name__,
+            'output_shape': tuple(layer.get_output_shape()),
+            'params': params,
+            'trainable_params': (params if getattr(layer, 'trainable', False)
+                                 else 0),
+            'activation_bytes': _per_sample_size(layer) * _FLOAT_BYTES,
+            'forward_flops': forward,
+            'backward_flops': _backward_flops(layer, forward)})
+    return rows
+
+
+def _optimizer_slots(model):
+    optimizer = getattr(model, 'optimizer', None)
+    return getattr(optimizer, 'n_slots', 1)
+
+
+def estimate_training_memory(model, batch_size, n_slots=None):
+    """Estimated peak device memory in bytes of a training step: the
+    parameters, their gradients and optimizer slots, every activation of
+    the batch (kept for the backward pass) and the gradients of the two
+    largest activations alive during backpropagation.
+    """
+    if n_slots is None:
+        n_slots = _optimizer_slots(model)
+    rows = summarize(model)
+    params = sum(row['params'] for row in rows)
+    trainable = sum(row['trainable_params'] for row in rows)
+    fixed = (params + trainable * (1 + n_slots)) * _FLOAT_BYTES
+
+    activations = sorted(row['activation_bytes'] for row in rows)
+    per_sample = sum(activations) + sum(activations[-2:])
+    return fixed + batch_size * per_sample
+
+
+def plan_batch_size(model, memory_budget, multiple_of=None,
+                    max_batch_size=65536, n_slots=None):
+    """Largest batch size whose estimated training memory fits in
+    memory_budget bytes, or None if not even the smallest one does.
+    Batch sizes are multiples of multiple_of (default 32 for models with
+    cuda-convnet layers, which need it, 1 otherwise).
+    """
+    if multiple_of is None:
+        multiple_of = 1
+        if layers.has_fixed_batch_size(model._get_output_layer()):
+            multiple_of = 32
+
+    # The estimate is linear in the batch size.
+    fixed = estimate_training_memory(model, 0, n_slots)
+    per_sample = estimate_training_memory(model, 1, n_slots) - fixed
+    if per_sample <= 0:
+        return max_batch_size
+    batch_size = int((memory_budget - fixed) // per_sample)
+    batch_size = min(batch_size, max_batch_size)
+    batch_size -= batch_size % multiple_of
+    if batch_size <= 0:
+        return None
+    return batch_size
+
+
+def _format_bytes(n):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if abs(n) < 1024.0:
+            return '%.1f%s' % (n, unit)
+        n /= 1024.0
+    return '%.1fTB' % n
+
+
+def print_summary(model, batch_size=None):
+    rows = summarize(model)
+    print '%-28s %-22s %12s %10s %12s %12s' % (
+        'Layer', 'Output shape', 'Params', 'Act/sample', 'Fwd MFLOPs',
+        'Bwd MFLOPs')
+    for row in rows:
+        print '%-28s %-22s %12d %10s %12.2f %12.2f' % (
+            row['name'], row['output_shape'], row['params'],
+            _format_bytes(row['activation_bytes']),
+            row['forward_flops'] / 1e6, row['backward_flops'] / 1e6)
+
+    print 'Total params: %d (%d trainable)' % (
+        sum(row['params'] for row in rows),
+        sum(row['trainable_params'] for row in rows))
+    forward = sum(row['forward_flops'] for row in rows)
+    backward = sum(row['backward_flops'] for row in rows)
+    print 'MFLOPs per sample: %.2f forward, %.2f training step' % (
+        forward / 1e6, (forward + backward) / 1e6)
+    if batch_size is not None:
+        print 'Estimated training memory at batch size %d: %s' % (
+            batch_size,
+            _format_bytes(estimate_training_memory(model, batch_size)))